@@ -0,0 +1,228 @@
+"""
+This module resolves the ad_aclk tokens of seller and product results to ad URLs with
+the sellers/ad_url endpoint. Tokens repeat across products and runs, so resolved URLs
+are kept in an in-memory LRU that reads through to a SQLite file on a miss, concurrent
+lookups of the same token share a single call and the number of calls in flight is limited.
+
+resolve_ad_urls fills in the URL of the items that only have a token while the results
+are read, e.g. with ``analyze --resolve-ads``. The fraction of the lookups answered
+without a call of their own is exported as the ad_url_hit_rate gauge.
+
+Example:
+    results = resolve_ad_urls(iter_results_json(RESULTS_FILE), session.ad_urls)
+    write_outputs(iter_products(results, matcher), id_keyword)
+"""
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from typing import Dict, Iterable, Iterator, List, Optional
+import sqlite3
+
+
+SUCCESS_STATUS_CODE = 20000
+
+AD_URL_PATH = "/v3/merchant/google/sellers/ad_url/"
+
+AD_URL_CACHE_FILE = "ad_url_cache.db"
+
+# Number of resolved URLs kept in memory
+LRU_SIZE = 10000
+
+# Number of ad_url calls in flight at the same time
+MAX_CONCURRENT = 8
+
+
+def _token(item: Dict) -> Optional[str]:
+    return item.get("shop_ad_aclk") or item.get("ad_aclk")
+
+
+def ad_tokens(task: Dict, without_url: bool = False) -> List[str]:
+    """ Returns the distinct shop_ad_aclk tokens of the items of a finished
+    products or sellers task, only of the items without a URL if without_url is True.
+    """
+    # A dict keeps the order of the tokens and finds the repeated ones in O(1)
+    tokens: Dict[str, None] = dict()
+    for data in task.get("result") or []:
+        for item in data.get("items") or []:
+            token = _token(item)
+            if token and not (without_url and item.get("url")):
+                tokens[token] = None
+    return list(tokens)
+
+
+class AdUrlResolver:
+    """ Memoizing resolver for ad_aclk tokens.
+
+    Args:
+        client (RestClient): The client used for the ad_url calls.
+        cache_file (Optional[str]): SQLite file persisting resolved URLs between runs,
+                                    None to keep them in memory only.
+        lru_size (int): Number of URLs kept in memory.
+        max_concurrent (int): Maximum number of ad_url calls in flight.
+        metrics (Optional[Metrics]): Registry for the hit/miss counters.
+    """
+
+    def __init__(self, client, cache_file: Optional[str] = AD_URL_CACHE_FILE, lru_size: int = LRU_SIZE,
+                 max_concurrent: int = MAX_CONCURRENT, metrics=None):
+        self.client = client
+        self.cache_file = cache_file
+        self.lru_size = lru_size
+        self.max_concurrent = max_concurrent
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._lru: "OrderedDict[str, str]" = OrderedDict()
+        self._dirty = False
+        self._in_flight: Dict[str, Future] = dict()
+        self._lock = Lock()
+        self._semaphore = BoundedSemaphore(max_concurrent)
+        self._db: Optional[sqlite3.Connection] = None
+        if cache_file:
+            # Only the LRU is in memory, the misses read through to the file
+            self._db = sqlite3.connect(cache_file, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS ad_urls (token TEXT PRIMARY KEY, url TEXT)")
+            self._db.commit()
+
+    def _count(self, result: str) -> None:
+        if self.metrics is not None:
+            self.metrics.inc("ad_url_lookups_total", result=result)
+
+    def _remember(self, token: str, url: str) -> None:
+        # Called with the lock held
+        self._lru[token] = url
+        self._lru.move_to_end(token)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _stored(self, token: str) -> Optional[str]:
+        # Called with the lock held
+        if self._db is None:
+            return None
+        row = self._db.execute("SELECT url FROM ad_urls WHERE token = ?", (token,)).fetchone()
+        return row[0] if row else None
+
+    def _store(self, token: str, url: str) -> None:
+        # Called with the lock held, the row is committed by save()
+        if self._db is not None:
+            self._db.execute("INSERT OR REPLACE INTO ad_urls (token, url) VALUES (?, ?)", (token, url))
+            self._dirty = True
+
+    def _fetch(self, token: str) -> Optional[str]:
+        response = self.client.get(AD_URL_PATH + token)
+        if response["status_code"] != SUCCESS_STATUS_CODE:
+            print(f"Error. Code: {response['status_code']} Message: {response['status_message']}")
+            return None
+        for task in response["tasks"]:
+            if task["status_code"] != SUCCESS_STATUS_CODE:
+                print(f"Error. Code: {task['status_code']} Message: {task['status_message']}")
+                continue
+            for item in task.get("result") or []:
+                url = item.get("ad_url") or item.get("url")
+                if url:
+                    return url
+        return None
+
+    def resolve(self, token: str) -> Optional[str]:
+        """ Returns the ad URL of token, or None if it could not be resolved. Failed
+        lookups are not cached.
+        """
+        with self._lock:
+            url = self._lru.get(token)
+            if url is None:
+                url = self._stored(token)
+            if url is not None:
+                self.hits += 1
+                self._remember(token, url)
+                owner = False
+                future = None
+            else:
+                future = self._in_flight.get(token)
+                owner = future is None
+                if owner:
+                    self.misses += 1
+                    future = self._in_flight[token] = Future()
+                else:
+                    self.coalesced += 1
+        if future is None:
+            self._count("hit")
+            return url
+        if not owner:
+            self._count("coalesced")
+            return future.result()
+        self._count("miss")
+        try:
+            with self._semaphore:
+                url = self._fetch(token)
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(token, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._in_flight.pop(token, None)
+            if url is not None:
+                self._remember(token, url)
+                self._store(token, url)
+        future.set_result(url)
+        return url
+
+    def resolve_many(self, tokens: Iterable[str], pool: Optional[ThreadPoolExecutor] = None) -> Dict[str, Optional[str]]:
+        """ Resolves a batch of tokens concurrently, each distinct token at most once.
+
+        Args:
+            tokens (Iterable[str]): The ad_aclk tokens, duplicates are allowed.
+            pool (Optional[ThreadPoolExecutor]): The pool to run the calls on, a pool with
+                                                 max_concurrent threads is used if it is None.
+        Returns:
+            Dict[str, Optional[str]]: The tokens mapped to their URLs.
+        """
+        unique = list(dict.fromkeys(tokens))
+        if pool is None:
+            with ThreadPoolExecutor(self.max_concurrent) as own_pool:
+                urls = dict(zip(unique, own_pool.map(self.resolve, unique)))
+        else:
+            urls = dict(zip(unique, pool.map(self.resolve, unique)))
+        if self.metrics is not None:
+            self.metrics.set_gauge("ad_url_hit_rate", self.hit_rate())
+        return urls
+
+    def hit_rate(self) -> float:
+        """ Returns the fraction of lookups answered without a call of their own. """
+        total = self.hits + self.misses + self.coalesced
+        return (self.hits + self.coalesced) / total if total else 0.0
+
+    def save(self) -> None:
+        """ Commits the URLs resolved since the last save to cache_file. """
+        with self._lock:
+            if self._db is None or not self._dirty:
+                return
+            self._db.commit()
+            self._dirty = False
+
+    def close(self) -> None:
+        """ Saves the new URLs and closes cache_file. """
+        self.save()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+def resolve_ad_urls(results: Iterable[Dict], resolver: AdUrlResolver,
+                    pool: Optional[ThreadPoolExecutor] = None) -> Iterator[Dict]:
+    """ Yields the task_get responses with the url of their items that have an ad token but
+    no URL filled in from the token, see AdUrlResolver.resolve_many. The tokens of each
+    task are resolved together before it is yielded.
+    """
+    for response in results:
+        for task in response.get("tasks") or []:
+            tokens = ad_tokens(task, without_url=True)
+            if not tokens:
+                continue
+            urls = resolver.resolve_many(tokens, pool)
+            for data in task.get("result") or []:
+                for item in data.get("items") or []:
+                    if not item.get("url") and urls.get(_token(item)):
+                        item["url"] = urls[_token(item)]
+        yield response
@@ -0,0 +1,86 @@
+"""
+This module packs tasks into task_post batches. A batch holds at most
+MAX_TASKS_PER_POST tasks and MAX_BODY_BYTES of JSON, only contains tasks of one
+endpoint and priority (high priority batches are sent first), and is serialized once
+so that the same bytes are used for the request, retries and logging. Both limits are
+set by the "run" table of the configuration (see task_post.configure).
+"""
+from typing import Dict, Iterable, List, Optional
+import json
+
+
+# Each task_post call cannot exceed 100 tasks
+MAX_TASKS_PER_POST = 100
+
+# Upper bound for the size of a request body
+MAX_BODY_BYTES = 1024 * 1024
+
+
+class Batch:
+    """ The tasks of one task_post call and their serialized JSON array.
+
+    Args:
+        endpoint (str): The merchant endpoint, e.g. "products".
+        priority (Optional[int]): The priority shared by all the tasks.
+        tasks (List[Dict]): The tasks of the batch.
+        body (bytes): The JSON array of the tasks.
+    """
+
+    __slots__ = ("endpoint", "priority", "tasks", "body")
+
+    def __init__(self, endpoint: str, priority: Optional[int], tasks: List[Dict], body: bytes):
+        self.endpoint = endpoint
+        self.priority = priority
+        self.tasks = tasks
+        self.body = body
+
+    def __len__(self) -> int:
+        return len(self.tasks)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+
+def pack_batches(tasks: Iterable[Dict], endpoint: str = "products", max_tasks: Optional[int] = None,
+                 max_bytes: Optional[int] = None) -> List[Batch]:
+    """ Groups tasks by priority and packs each group into as few batches as possible.
+
+    Args:
+        tasks (Iterable[Dict]): The tasks, each serialized exactly once.
+        endpoint (str): The endpoint the tasks are posted to.
+        max_tasks (Optional[int]): Maximum number of tasks per batch, defaults to MAX_TASKS_PER_POST.
+        max_bytes (Optional[int]): Maximum size of a batch body, a single larger task gets a batch
+                                   of its own. Defaults to MAX_BODY_BYTES.
+
+    Returns:
+        List[Batch]: The batches, highest priority first.
+    """
+    # The limits are read at every call, they can be configured after the import
+    max_tasks = max_tasks or MAX_TASKS_PER_POST
+    max_bytes = max_bytes or MAX_BODY_BYTES
+    # Per priority: the tasks, their encoded JSON and the size of the body so far
+    open_batches: Dict[Optional[int], List] = dict()
+    batches: List[Batch] = list()
+
+    def close(priority: Optional[int]) -> None:
+        group_tasks, encoded, _ = open_batches.pop(priority)
+        batches.append(Batch(endpoint, priority, group_tasks, b"[" + b",".join(encoded) + b"]"))
+
+    for task in tasks:
+        priority = task.get("priority")
+        data = json.dumps(task, separators=(",", ":")).encode("utf-8")
+        group = open_batches.get(priority)
+        if group is not None and (len(group[0]) >= max_tasks or group[2] + len(data) + 1 > max_bytes):
+            close(priority)
+            group = None
+        if group is None:
+            # The two brackets of the array, minus the comma the first task does not need
+            group = open_batches[priority] = [list(), list(), 1]
+        group[0].append(task)
+        group[1].append(data)
+        # One byte for the separating comma
+        group[2] += len(data) + 1
+    for priority in list(open_batches):
+        close(priority)
+    batches.sort(key=lambda batch: -(batch.priority or 0))
+    return batches
@@ -0,0 +1,130 @@
+"""
+Benchmarks of the pipeline.
+
+    decode: the analysis of the results file with the responses decoded in the main
+            process and in 1..N worker processes (see decoding.py). The file is replayed
+            N times to simulate a large run.
+    hedge:  the latency of task_get calls to the local stub server (see stub_server.py),
+            whose slow tail is cut by hedged requests (see client.RestClient).
+    concurrency: the throughput of task_get calls to a stub server that throttles the
+            calls beyond its capacity, with a fixed number of workers and with the
+            adaptive limit of concurrency.py.
+
+Example:
+    python benchmarks.py decode --replay 50 --workers 1 2 4 8
+    python benchmarks.py hedge --calls 2000
+    python benchmarks.py concurrency --capacity 8 --workers 32
+"""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, repeat
+from time import perf_counter
+from typing import List
+import argparse
+import os
+
+from client import RestClient
+from concurrency import AdaptiveLimiter, THROTTLED_STATUS_CODE
+from decoding import analyze_raw_results, iter_raw_results
+from stub_server import StubServer, SLOW_FRACTION
+from task_post import RESULTS_FILE
+
+TASK_GET_PATH = "/v3/merchant/google/products/task_get/advanced/09100422-3160-0179-0000-009a2fdef23a"
+
+
+def replay(file_name: str, times: int) -> List[str]:
+    """ Returns the documents of the results file, repeated times times. """
+    return list(chain.from_iterable(repeat(list(iter_raw_results(file_name)), times)))
+
+
+def percentile(latencies: List[float], q: float) -> float:
+    latencies = sorted(latencies)
+    return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def fetch_latencies(client: RestClient, calls: int) -> List[float]:
+    latencies = list()
+    for _ in range(calls):
+        start = perf_counter()
+        client.get(TASK_GET_PATH)
+        latencies.append(perf_counter() - start)
+    return latencies
+
+
+def benchmark_hedge(args: argparse.Namespace) -> None:
+    for hedge in (False, True):
+        with StubServer(slow_fraction=args.slow_fraction, seed=args.seed) as server:
+            client = RestClient("login", "password", keep_alive=True, hedge=hedge, domain=server.address,
+                                secure=False)
+            latencies = fetch_latencies(client, args.calls)
+            client.close()
+        print(f"hedge={hedge}: p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+              f"p95 {percentile(latencies, 0.95) * 1000:.1f} ms, p99 {percentile(latencies, 0.99) * 1000:.1f} ms, "
+              f"max {max(latencies) * 1000:.1f} ms, {client._hedged_calls} hedged calls")
+
+
+def benchmark_concurrency(args: argparse.Namespace) -> None:
+    runs = [("fixed 1 worker", 1, None), (f"fixed {args.workers} workers", args.workers, None),
+            (f"adaptive, up to {args.workers}", args.workers, AdaptiveLimiter(max_limit=args.workers))]
+    for name, workers, limiter in runs:
+        with StubServer(slow_fraction=0, capacity=args.capacity, seed=args.seed) as server:
+            client = RestClient("login", "password", keep_alive=True, domain=server.address, secure=False,
+                                concurrency=limiter)
+            start = perf_counter()
+            with ThreadPoolExecutor(workers) as pool:
+                responses = list(pool.map(client.get, repeat(TASK_GET_PATH, args.calls)))
+            elapsed = perf_counter() - start
+            client.close()
+        throttled = sum(r["status_code"] == THROTTLED_STATUS_CODE for r in responses)
+        limit = f", final limit {limiter.limit(TASK_GET_PATH.rsplit('/', 1)[0]):.1f}" if limiter else ""
+        print(f"{name}: {(len(responses) - throttled) / elapsed:.0f} calls/s, "
+              f"{throttled / len(responses):.1%} throttled{limit}")
+
+
+def benchmark_decode(args: argparse.Namespace) -> None:
+    documents = replay(args.file, args.replay)
+    size = sum(len(d) for d in documents) / 1e6
+    print(f"{len(documents)} documents, {size:.1f} MB, {os.cpu_count()} CPUs")
+
+    start = perf_counter()
+    expected = analyze_raw_results(documents)
+    baseline = perf_counter() - start
+    n_offers = sum(len(v) for v in expected.values())
+    print(f"main process: {baseline:.2f} s ({size / baseline:.1f} MB/s), {n_offers} offers")
+
+    for workers in sorted(set(args.workers)):
+        with ProcessPoolExecutor(workers) as pool:
+            # Start the workers before timing
+            pool.submit(int).result()
+            start = perf_counter()
+            price_dict = analyze_raw_results(documents, pool)
+            elapsed = perf_counter() - start
+        assert price_dict == expected
+        print(f"{workers} workers: {elapsed:.2f} s ({size / elapsed:.1f} MB/s), speedup {baseline / elapsed:.2f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    decode = commands.add_parser("decode", help="Decoding in worker processes")
+    decode.add_argument("--file", default=RESULTS_FILE, help="The results file")
+    decode.add_argument("--replay", type=int, default=20, help="Number of times the file is replayed")
+    decode.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1],
+                        help="Numbers of worker processes")
+    decode.set_defaults(run=benchmark_decode)
+    hedge = commands.add_parser("hedge", help="Hedged requests against the stub server")
+    hedge.add_argument("--calls", type=int, default=1000, help="Number of task_get calls")
+    hedge.add_argument("--slow-fraction", type=float, default=SLOW_FRACTION, help="Fraction of slow calls")
+    hedge.add_argument("--seed", type=int, default=1, help="Seed of the latencies of the stub")
+    hedge.set_defaults(run=benchmark_hedge)
+    concurrency = commands.add_parser("concurrency", help="Adaptive concurrency against a throttling stub server")
+    concurrency.add_argument("--calls", type=int, default=2000, help="Number of task_get calls")
+    concurrency.add_argument("--capacity", type=int, default=8, help="Calls in flight the stub server accepts")
+    concurrency.add_argument("--workers", type=int, default=32, help="Threads making the calls")
+    concurrency.add_argument("--seed", type=int, default=1, help="Seed of the latencies of the stub")
+    concurrency.set_defaults(run=benchmark_concurrency)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+"""
+This module guards the account balance. The Budget is a metrics hook (see metrics.py):
+it sees the cost of every API call through the api_cost_total counter, sums it per
+endpoint in memory and adds it to the spend table of the ledger every few seconds, so
+that the daily spend includes the other runs of the day.
+
+Before posting, a batch plan is checked against the caps:
+    soft cap: high priority tasks are posted with normal priority (half the cost),
+    hard cap: the batches that would exceed it are not posted, send_post saves them to
+              DEFERRED_FILE for a later run instead of failing in the middle of the run.
+
+Example dataforseo.toml:
+
+    [budget]
+    daily_cap = 5.0
+    run_cap = 2.0
+    soft_fraction = 0.8
+"""
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+import json
+import time
+
+from batching import Batch, pack_batches
+from scheduler import NORMAL_PRIORITY, TASK_COST
+
+
+# Fraction of a cap above which tasks are degraded to normal priority
+SOFT_FRACTION = 0.8
+
+# Seconds between two writes of the spend to the ledger
+FLUSH_INTERVAL = 5.0
+
+# Tasks that were not posted because of the hard cap
+DEFERRED_FILE = "deferred_tasks.json"
+
+OK = "ok"
+SOFT = "soft"
+HARD = "hard"
+
+
+def today() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+def estimate_cost(batches: List[Batch], task_cost: Dict[int, float] = TASK_COST) -> float:
+    """ Returns the cost of posting the batches, from the priority of their tasks. """
+    return sum(task_cost.get(batch.priority, task_cost[NORMAL_PRIORITY]) * len(batch) for batch in batches)
+
+
+def degrade(batch: Batch) -> Batch:
+    """ Returns the batch with its tasks set to normal priority. """
+    if batch.priority is None or batch.priority == NORMAL_PRIORITY:
+        return batch
+    # The priorities are single digits, so the body keeps its size and fits in one batch
+    tasks = [dict(task, priority=NORMAL_PRIORITY) for task in batch.tasks]
+    return pack_batches(tasks, batch.endpoint)[0]
+
+
+class Budget:
+    """ Spend tracker with soft and hard caps.
+
+    Args:
+        ledger (Optional[Ledger]): Persists the spend, without it only the spend of this
+                                   process is known.
+        daily_cap (Optional[float]): Maximum spend (USD) per UTC day, over all runs.
+        run_cap (Optional[float]): Maximum spend (USD) of this run.
+        soft_fraction (float): Fraction of the caps above which tasks are degraded.
+        task_cost (Dict[int, float]): Cost of a task by priority, for the estimates.
+        flush_interval (float): Seconds between two writes to the ledger.
+    """
+
+    def __init__(self, ledger=None, daily_cap: Optional[float] = None, run_cap: Optional[float] = None,
+                 soft_fraction: float = SOFT_FRACTION, task_cost: Dict[int, float] = TASK_COST,
+                 flush_interval: float = FLUSH_INTERVAL):
+        self.ledger = ledger
+        self.daily_cap = daily_cap
+        self.run_cap = run_cap
+        self.soft_fraction = soft_fraction
+        self.task_cost = task_cost
+        self.flush_interval = flush_interval
+        self.day = today()
+        # Spend of the other runs of the day, read once
+        self.day_base = self._ledger_day_spend()
+        self.run_spent = 0.0
+        # Spend of this run since the start of the UTC day
+        self.day_spent = 0.0
+        self.by_endpoint: Dict[str, List[float]] = dict()
+        # Spend not written to the ledger yet, by endpoint: [cost, calls]
+        self._pending: Dict[str, List[float]] = dict()
+        self._flushed_at = time.monotonic()
+        self._lock = Lock()
+
+    @classmethod
+    def from_config(cls, config: Dict, ledger=None) -> Optional["Budget"]:
+        """ Returns the budget of the "budget" table of a configuration, None if it has no cap. """
+        if config.get("daily_cap") is None and config.get("run_cap") is None:
+            return None
+        return cls(ledger, config.get("daily_cap"), config.get("run_cap"),
+                   config.get("soft_fraction", SOFT_FRACTION))
+
+    def _ledger_day_spend(self) -> float:
+        if self.ledger is None:
+            return 0.0
+        return sum(cost for cost, _ in self.ledger.spent(self.day).values())
+
+    def on_measurement(self, kind: str, name: str, value: float, labels: Dict[str, object]) -> None:
+        # Called for every measurement of the metrics, only two names matter
+        if name == "api_cost_total":
+            self.add(str(labels.get("endpoint", "")), value, calls=0)
+        elif name == "api_status_total":
+            self.add(str(labels.get("endpoint", "")), 0.0, calls=1)
+
+    def add(self, endpoint: str, cost: float, calls: int = 1) -> None:
+        """ Adds the cost of calls to an endpoint. """
+        if today() != self.day:
+            # The spend of the previous day is written to it before counting the new one
+            self.flush()
+        flush = False
+        with self._lock:
+            total = self.by_endpoint.setdefault(endpoint, [0.0, 0])
+            total[0] += cost
+            total[1] += calls
+            pending = self._pending.setdefault(endpoint, [0.0, 0])
+            pending[0] += cost
+            pending[1] += calls
+            self.run_spent += cost
+            self.day_spent += cost
+            if time.monotonic() - self._flushed_at >= self.flush_interval:
+                flush = True
+        if flush:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Adds the spend since the last flush to the ledger. """
+        with self._lock:
+            pending, self._pending = self._pending, dict()
+            self._flushed_at = time.monotonic()
+            day = self.day
+            if today() != day:
+                # New UTC day, the spend of this run and of the other runs starts from 0 again
+                self.day = today()
+                self.day_base = self._ledger_day_spend()
+                self.day_spent = 0.0
+        if self.ledger is not None and pending:
+            self.ledger.add_spend(day, {e: (cost, int(calls)) for e, (cost, calls) in pending.items()})
+
+    def spent_today(self) -> float:
+        return self.day_base + self.day_spent
+
+    def remaining(self) -> float:
+        """ Returns how much can still be spent before reaching one of the caps. """
+        remaining = float("inf")
+        if self.daily_cap is not None:
+            remaining = min(remaining, self.daily_cap - self.spent_today())
+        if self.run_cap is not None:
+            remaining = min(remaining, self.run_cap - self.run_spent)
+        return remaining
+
+    def state(self, extra: float = 0.0) -> str:
+        """ Returns OK, SOFT or HARD for the current spend plus extra. """
+        state = OK
+        for cap, spent in ((self.daily_cap, self.spent_today()), (self.run_cap, self.run_spent)):
+            if cap is None:
+                continue
+            if spent + extra > cap:
+                return HARD
+            if spent + extra > cap * self.soft_fraction:
+                state = SOFT
+        return state
+
+    def admit(self, batch: Batch) -> Optional[Batch]:
+        """ Returns the batch to post instead of batch, degraded to normal priority above
+        the soft cap, or None if it would exceed the hard cap.
+        """
+        if self.state(estimate_cost([batch], self.task_cost)) == OK:
+            return batch
+        batch = degrade(batch)
+        return batch if self.state(estimate_cost([batch], self.task_cost)) != HARD else None
+
+    def plan(self, batches: List[Batch]) -> Tuple[List[Batch], List[Batch]]:
+        """ Checks a batch plan before posting it.
+
+        Args:
+            batches (List[Batch]): The batches, in the order they will be posted.
+
+        Returns:
+            Tuple[List[Batch], List[Batch]]: The batches to post, degraded to normal priority
+            if the plan exceeds the soft cap, and the batches that would exceed the hard cap.
+        """
+        estimate = estimate_cost(batches, self.task_cost)
+        if self.state(estimate) != OK:
+            batches = [degrade(batch) for batch in batches]
+        admitted: List[Batch] = list()
+        deferred: List[Batch] = list()
+        planned = 0.0
+        for batch in batches:
+            cost = estimate_cost([batch], self.task_cost)
+            if deferred or self.state(planned + cost) == HARD:
+                deferred.append(batch)
+            else:
+                admitted.append(batch)
+                planned += cost
+        return admitted, deferred
+
+    def report(self) -> Dict[str, object]:
+        with self._lock:
+            by_endpoint = {e: dict(cost=c, calls=int(n)) for e, (c, n) in self.by_endpoint.items()}
+        return dict(day=self.day, spent_today=self.spent_today(), run_spent=self.run_spent,
+                    daily_cap=self.daily_cap, run_cap=self.run_cap, by_endpoint=by_endpoint)
+
+    def print_report(self) -> None:
+        r = self.report()
+        print(f"Spend: run {r['run_spent']:.4f} (cap {r['run_cap']}), "
+              f"today {r['spent_today']:.4f} (cap {r['daily_cap']})")
+        for endpoint, spend in sorted(r["by_endpoint"].items()):
+            print(f"  {endpoint}: {spend['cost']:.4f} in {spend['calls']} calls")
+
+
+def save_deferred(batches: List[Batch], file_name: str = DEFERRED_FILE) -> None:
+    """ Writes the tasks of batches that were not posted, load them with load_deferred. """
+    with open(file_name, 'w', encoding="utf-8") as file:
+        json.dump([dict(endpoint=b.endpoint, tasks=b.tasks) for b in batches], file)
+
+
+def load_deferred(file_name: str = DEFERRED_FILE) -> List[Batch]:
+    with open(file_name, 'r', encoding="utf-8") as file:
+        saved = json.load(file)
+    return [batch for entry in saved for batch in pack_batches(entry["tasks"], entry["endpoint"])]
@@ -0,0 +1,477 @@
+"""
+Non-interactive command line interface for the pipeline in task_post.py. The
+credentials, PARAMETERS and file names come from the config file and the environment
+(see config.py), so nothing is prompted and the commands can run from cron.
+
+Usage:
+    python cli.py post [--data-file FILE] [--keep-files] [--market LOCATION:LANGUAGE ...] [--deferred] [--changed]
+    python cli.py poll
+    python cli.py fetch
+    python cli.py analyze [--data-file FILE] [--max-offers N] [--workers N] [--market LOCATION:LANGUAGE ...]
+                          [--export FILE ...] [--sellers] [--resolve-ads]
+    python cli.py sellers [--data-file FILE] [--by seller|domain] [--top N] [--min-offers N] [--rebuild]
+    python cli.py show (--task-id ID | --keyword KEYWORD | --product-id ID) [--data-file FILE] [--offers]
+    python cli.py report [--data-file FILE] [--out DIR] [--workers N] [--force]
+    python cli.py run [--data-file FILE] [--resume] [--market LOCATION:LANGUAGE ...] [--changed]
+    python cli.py worker [--queue URL] [--kind post|fetch|analyze ...] [--once]
+    python cli.py coordinate [--data-file FILE] [--queue URL] [--run-id ID] [--work] [--merge-only]
+    python cli.py daemon [--data-file FILE] [--tasks-per-minute N]
+    python cli.py dag [--data-file FILE] [--market LOCATION:LANGUAGE ...] [--max-wait SECONDS]
+
+The markets default to the [markets] table of the config file, see markets.py.
+
+The poll and fetch commands never import pandas, so they start quickly.
+
+With --profile [DIR], every stage of the command is profiled and the summary, flame
+graph and speedscope files are written to DIR, see profiling.py.
+
+The worker and coordinate commands share a run between several processes or machines
+through the queue of the [queue] table of the config file, see jobqueue.py.
+
+The dag command also posts the sellers and product_info tasks of the products found,
+see orchestrator.py.
+"""
+from typing import List, Optional
+import argparse
+import json
+import os
+import sys
+import task_post
+from config import load_config
+from markets import parse_market
+from metrics import PrometheusTextHook, JsonLogHook
+
+
+# Exit code of poll when some of the tasks are not ready yet
+NOT_READY_EXIT_CODE = 2
+
+MARKET_HELP = "Run in this market, e.g. \"Canada:French\", can be repeated"
+
+
+def cmd_post(args: argparse.Namespace) -> int:
+    if not args.keep_files:
+        task_post.cleanup()
+    markets = args.market or task_post.MARKETS
+    if markets:
+        markets = task_post.validate_markets(markets, task_post.get_locations(args.session),
+                                             task_post.get_languages(args.session))
+    sched = task_post.default_scheduler()
+    store = task_post.snapshot_store() if args.changed and not args.deferred else None
+    with task_post.METRICS.stage("read"):
+        if args.deferred:
+            # The tasks that were not posted because of the budget, see budget.py
+            from budget import load_deferred
+            data_list = load_deferred(task_post.DEFERRED_FILE)
+        else:
+            data_list, _ = task_post.set_task(args.data_file or task_post.DATA_FILE, sched, markets, store)
+    with task_post.METRICS.stage("post"):
+        created = task_post.send_post(data_list, sched, args.session)
+    if store is not None:
+        store.commit(created)
+    print(f"Task IDs written to file {task_post.TASK_IDS_FILE}")
+    return 0
+
+
+def cmd_poll(args: argparse.Namespace) -> int:
+    with open(task_post.TASK_IDS_FILE, 'r', encoding="utf-8") as file:
+        ids = {line.strip() for line in file if line.strip()}
+    response = args.session.get("/v3/merchant/google/products/tasks_ready")
+    if response["status_code"] != task_post.SUCCESS_STATUS_CODE:
+        print(f"Error. Code: {response['status_code']} Message: {response['status_message']}")
+        return 1
+    ready = {info["id"] for task in response["tasks"] for info in task.get("result") or []}
+    n_ready = len(ids & ready)
+    print(f"{n_ready} of {len(ids)} tasks ready")
+    return 0 if n_ready == len(ids) else NOT_READY_EXIT_CODE
+
+
+def cmd_fetch(args: argparse.Namespace) -> int:
+    with task_post.METRICS.stage("fetch"):
+        results = task_post.iter_task_results(task_post.TASK_IDS_FILE, session=args.session)
+        task_post.write_results_json(results, task_post.RESULTS_FILE)
+    print(f"Wrote the results to {task_post.RESULTS_FILE}")
+    return 0
+
+
+def cmd_analyze(args: argparse.Namespace) -> int:
+    with task_post.METRICS.stage("read"):
+        _, id_keyword = task_post.read_xlsx(args.data_file or task_post.DATA_FILE)
+    matcher = task_post.build_matcher(id_keyword)
+    exports = args.export or None
+    index = None
+    if args.sellers:
+        from seller_index import SellerIndex
+        index = SellerIndex(id_keyword)
+    if args.resolve_ads and args.workers:
+        print("--resolve-ads can not be used with --workers")
+        return 2
+    market_offers = None
+    with task_post.METRICS.stage("analyze"):
+        if args.market or task_post.MARKETS:
+            # The markets of each task are in the results, they are not validated again
+            results = _results(args)
+            market_offers, comparison = task_post.analyze_markets(results, matcher, max_offers=args.max_offers)
+            price_dict = None
+        elif args.workers:
+            # The responses are decoded in worker processes
+            from concurrent.futures import ProcessPoolExecutor
+            from decoding import analyze_raw_results, iter_raw_results
+            with ProcessPoolExecutor(args.workers) as pool:
+                price_dict = analyze_raw_results(iter_raw_results(task_post.RESULTS_FILE), pool, matcher,
+                                                 max_offers=args.max_offers)
+        elif args.max_offers:
+            results = _results(args)
+            price_dict = task_post.analyze_results(results, matcher, max_offers=args.max_offers)
+        else:
+            # Nothing to aggregate, the products are written while the results are read
+            results = _results(args)
+            task_post.write_outputs(_indexed(task_post.iter_products(results, matcher), index), id_keyword, exports)
+            price_dict = None
+    if price_dict is not None:
+        with task_post.METRICS.stage("write_output"):
+            task_post.write_outputs(_indexed(price_dict.items(), index), id_keyword, exports)
+    if market_offers is not None:
+        # Each market is written to its own files, the offers are in different currencies
+        with task_post.METRICS.stage("write_output"):
+            for market, offers in market_offers.items():
+                task_post.write_outputs(_indexed(offers.items(), index), id_keyword, exports, market)
+                print(f"Wrote the output of {market} to {task_post.market_file_name(task_post.OUTPUT_FILE, market)}")
+            task_post.write_market_csv(comparison, id_keyword)
+        print(f"Wrote the market comparison to {task_post.MARKETS_OUTPUT_FILE}")
+    else:
+        print(f"Wrote the output to {task_post.OUTPUT_FILE}")
+    if index is not None:
+        from seller_index import SELLER_INDEX_FILE
+        index.save(SELLER_INDEX_FILE)
+        print(f"Wrote the index of {len(index)} offers by seller to {SELLER_INDEX_FILE}")
+    if args.resolve_ads:
+        print(f"Ad URL hit rate: {args.session.ad_urls.hit_rate():.0%}")
+    return 0
+
+
+def _results(args: argparse.Namespace):
+    """ Reads the results of the last run, with the URLs of the ads resolved if asked for. """
+    results = task_post.iter_results_json(task_post.RESULTS_FILE)
+    if args.resolve_ads:
+        from ad_url import resolve_ad_urls
+        results = resolve_ad_urls(results, args.session.ad_urls)
+    return results
+
+
+def _indexed(products, index):
+    """ Fills the seller index with the products on their way to the output, if there is one. """
+    if index is None:
+        return products
+    from seller_index import index_products
+    return index_products(products, index)
+
+
+def cmd_sellers(args: argparse.Namespace) -> int:
+    from seller_index import SELLER_INDEX_FILE, SellerIndex, print_sellers
+    if args.rebuild or not os.path.exists(SELLER_INDEX_FILE):
+        # Same offers as analyze: parsed from the results and matched to the products
+        with task_post.METRICS.stage("read"):
+            _, id_keyword = task_post.read_xlsx(args.data_file or task_post.DATA_FILE)
+        with task_post.METRICS.stage("analyze"):
+            index = SellerIndex(id_keyword)
+            results = task_post.iter_results_json(task_post.RESULTS_FILE)
+            for keyword, offers in task_post.iter_products(results, task_post.build_matcher(id_keyword)):
+                index.add(keyword, offers)
+            index.save(SELLER_INDEX_FILE)
+    else:
+        index = SellerIndex.load(SELLER_INDEX_FILE)
+    print_sellers(index.undercutters(args.by, args.top, args.min_offers), args.by)
+    return 0
+
+
+def cmd_report(args: argparse.Namespace) -> int:
+    from report import build_report
+    with task_post.METRICS.stage("read"):
+        _, id_keyword = task_post.read_xlsx(args.data_file or task_post.DATA_FILE)
+    with task_post.METRICS.stage("analyze"):
+        results = task_post.iter_results_json(task_post.RESULTS_FILE)
+        price_dict = task_post.analyze_results(results, task_post.build_matcher(id_keyword))
+    with task_post.METRICS.stage("report"):
+        drawn = build_report(price_dict, id_keyword, args.out, args.workers, args.force)
+    print(f"Drew {drawn} charts, the report is in {args.out}")
+    return 0
+
+
+def cmd_show(args: argparse.Namespace) -> int:
+    from result_index import ResultIndex
+    # Only the responses asked for are read from the results file
+    with ResultIndex(task_post.RESULTS_FILE) as index:
+        if args.task_id:
+            response = index.get(args.task_id)
+            responses = [response] if response is not None else []
+        elif args.keyword:
+            responses = index.by_keyword(args.keyword)
+        else:
+            _, id_keyword = task_post.read_xlsx(args.data_file or task_post.DATA_FILE)
+            responses = index.by_product(args.product_id, id_keyword)
+    if not responses:
+        print(f"No results in {task_post.RESULTS_FILE}")
+        return 1
+    if not args.offers:
+        for response in responses:
+            print(json.dumps(response, indent=4))
+        return 0
+    for keyword, offers in task_post.iter_products(responses):
+        print(keyword)
+        for offer in offers:
+            print(f"  {offer.price} {offer.currency or ''} {offer.seller or ''} {offer.url or ''}")
+    return 0
+
+
+def cmd_run(args: argparse.Namespace) -> int:
+    if not args.resume and not args.keep_files:
+        task_post.cleanup()
+    task_post.run_pipeline(args.data_file, resume=args.resume, session=args.session, markets=args.market,
+                           changed=args.changed)
+    return 0
+
+
+def _worker(args: argparse.Namespace, queue, kinds=None):
+    from jobqueue import JOB_KINDS, VISIBILITY_TIMEOUT, Worker
+    return Worker(queue, args.session, kinds or JOB_KINDS,
+                  visibility_timeout=task_post.QUEUE.get("visibility_timeout", VISIBILITY_TIMEOUT),
+                  task_wait=task_post.TASK_WAIT)
+
+
+def cmd_worker(args: argparse.Namespace) -> int:
+    from jobqueue import open_queue
+    queue = open_queue(args.queue or task_post.QUEUE.get("url"))
+    try:
+        succeeded = _worker(args, queue, args.kind).run(once=args.once)
+    finally:
+        queue.close()
+    print(f"Ran {succeeded} jobs")
+    return 0
+
+
+def cmd_coordinate(args: argparse.Namespace) -> int:
+    from jobqueue import Coordinator, DEAD, PENDING, open_queue
+    if args.merge_only and not args.run_id:
+        print("--merge-only needs the --run-id of the run to merge")
+        return 1
+    queue = open_queue(args.queue or task_post.QUEUE.get("url"))
+    try:
+        coordinator = Coordinator(queue, args.run_id)
+        with task_post.METRICS.stage("read"):
+            data_list, id_keyword = task_post.set_task(args.data_file or task_post.DATA_FILE)
+        if not args.merge_only:
+            added = coordinator.submit(data_list)
+            print(f"Run {coordinator.run_id}: queued {added} of {len(data_list)} batches")
+        with task_post.METRICS.stage("wait"):
+            counts = coordinator.wait(worker=_worker(args, queue) if args.work else None,
+                                      deadline=args.session.deadline)
+        if counts[PENDING] or counts[DEAD]:
+            print(f"{counts[PENDING]} jobs are still pending and {counts[DEAD]} failed, merging the others")
+        with task_post.METRICS.stage("analyze"):
+            price_dict = coordinator.merge(task_post.build_matcher(id_keyword), task_post.RESULTS_FILE)
+        with task_post.METRICS.stage("write_output"):
+            task_post.write_outputs(price_dict.items(), id_keyword)
+    finally:
+        queue.close()
+    print(f"Wrote the output to {task_post.OUTPUT_FILE}")
+    return 0
+
+
+def cmd_daemon(args: argparse.Namespace) -> int:
+    from daemon import FreshnessPolicy, RepricingDaemon, TASKS_PER_MINUTE
+    from ledger import Ledger
+    from scheduler import scheduler_from_config
+    config = task_post.DAEMON
+    policy = FreshnessPolicy(**{k: config[k] for k in ("min_ttl", "max_ttl", "base_ttl", "target_change")
+                                if k in config})
+    # The daemon never finishes, the deadline of the scheduler only applies to full runs
+    scheduler = scheduler_from_config({k: v for k, v in task_post.SCHEDULER.items() if k != "deadline"},
+                                      task_post.OUTPUT_FILE, task_post.CONFIGURED_PRIORITY)
+    ledger = Ledger()
+    try:
+        daemon = RepricingDaemon(args.session, ledger, args.data_file or task_post.DATA_FILE, policy,
+                                 args.tasks_per_minute or config.get("tasks_per_minute", TASKS_PER_MINUTE),
+                                 scheduler=scheduler)
+        daemon.run()
+    finally:
+        ledger.close()
+    return 0
+
+
+def cmd_dag(args: argparse.Namespace) -> int:
+    from concurrent.futures import ThreadPoolExecutor
+    from ledger import Ledger
+    from orchestrator import DAG_RESULTS_FILE, MAX_WAIT, Orchestrator, tag_tasks
+    markets = args.market or task_post.MARKETS
+    if markets:
+        markets = task_post.validate_markets(markets, task_post.get_locations(args.session),
+                                             task_post.get_languages(args.session))
+    with task_post.METRICS.stage("read"):
+        data_list, id_keyword = task_post.set_task(args.data_file or task_post.DATA_FILE,
+                                                   task_post.default_scheduler(), markets)
+    ledger = Ledger()
+    try:
+        with task_post.METRICS.stage("dag"), ThreadPoolExecutor(args.session.concurrency.max_limit) as pool:
+            orchestrator = Orchestrator(args.session.client, ledger, pool, metrics=args.session.metrics,
+                                        max_wait=args.max_wait or MAX_WAIT, budget=args.session.budget)
+            results = orchestrator.run(tag_tasks(data_list, id_keyword))
+    finally:
+        ledger.close()
+    if orchestrator.deferred:
+        from budget import save_deferred
+        save_deferred(orchestrator.deferred, task_post.DEFERRED_FILE)
+        print(f"{sum(len(b) for b in orchestrator.deferred)} tasks were saved to {task_post.DEFERRED_FILE} "
+              "instead of being posted")
+    with open(DAG_RESULTS_FILE, 'w', encoding="utf-8") as file:
+        json.dump(results, file, indent=4)
+    print(", ".join(f"{len(tasks)} {stage}" for stage, tasks in results.items() if tasks)
+          + f" tasks written to {DAG_RESULTS_FILE}")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Competitor prices from the DataForSEO Merchant API")
+    parser.add_argument("--config", help="TOML config file (default: $DATAFORSEO_CONFIG or dataforseo.toml)")
+    parser.add_argument("--prom-file", help="Write the metrics to this Prometheus text file")
+    parser.add_argument("--metrics-log", help="Append the metrics to this JSON log file")
+    parser.add_argument("--profile", nargs="?", const="profile", metavar="DIR",
+                        help="Profile the stages of the command and write the results to DIR (default: profile)")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="With --profile, also trace the peak memory of each stage (slower)")
+    parser.add_argument("--profile-cprofile", action="store_true",
+                        help="With --profile, also write the cProfile statistics of each stage")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    post = commands.add_parser("post", help="Create the tasks for the products in the data file")
+    post.add_argument("--data-file", help="The xlsx data file")
+    post.add_argument("--market", action="append", type=parse_market, help=MARKET_HELP)
+    post.add_argument("--deferred", action="store_true",
+                      help="Post the tasks that were deferred by the budget of a previous run")
+    post.add_argument("--changed", action="store_true",
+                      help="Only post the products that are new, changed or stale since the last post")
+    post.add_argument("--keep-files", action="store_true", help="Do not remove the files of the last run")
+    post.set_defaults(func=cmd_post)
+
+    poll = commands.add_parser("poll", help="Check how many posted tasks are ready, exits with "
+                                            f"{NOT_READY_EXIT_CODE} if some are not")
+    poll.set_defaults(func=cmd_poll)
+
+    fetch = commands.add_parser("fetch", help="Fetch the results of the posted tasks")
+    fetch.set_defaults(func=cmd_fetch)
+
+    analyze = commands.add_parser("analyze", help="Write the output file from the fetched results")
+    analyze.add_argument("--data-file", help="The xlsx data file")
+    analyze.add_argument("--max-offers", type=int,
+                         help="Keep only the lowest MAX_OFFERS prices of each product")
+    analyze.add_argument("--workers", type=int, help="Decode the results in WORKERS processes")
+    analyze.add_argument("--market", action="append", type=parse_market, help=MARKET_HELP)
+    analyze.add_argument("--export", action="append",
+                         help="Also write one row per offer to this .csv, .parquet or .xlsx file, "
+                              "can be repeated (default: the exports of the config file)")
+    analyze.add_argument("--sellers", action="store_true",
+                         help="Also index the offers by seller and domain for the sellers command")
+    analyze.add_argument("--resolve-ads", action="store_true",
+                         help="Resolve the ad tokens of the offers without a URL with the ad_url endpoint")
+    analyze.set_defaults(func=cmd_analyze)
+
+    sellers = commands.add_parser("sellers", help="List the sellers with the most offers below our prices")
+    sellers.add_argument("--data-file", help="The xlsx data file, to build the index when there is none")
+    sellers.add_argument("--by", choices=["seller", "domain"], default="seller", help="Group the offers by")
+    sellers.add_argument("--top", type=int, default=20, help="Number of sellers listed")
+    sellers.add_argument("--min-offers", type=int, default=3,
+                         help="Leave out the sellers with fewer offers of our products")
+    sellers.add_argument("--rebuild", action="store_true", help="Build the index again from the results")
+    sellers.set_defaults(func=cmd_sellers)
+
+    report = commands.add_parser("report", help="Draw the price distribution of each product to an HTML report")
+    report.add_argument("--data-file", help="The xlsx data file")
+    report.add_argument("--out", default="report", help="The directory of the report")
+    report.add_argument("--workers", type=int, help="Number of processes drawing the charts")
+    report.add_argument("--force", action="store_true", help="Draw the charts that did not change too")
+    report.set_defaults(func=cmd_report)
+
+    show = commands.add_parser("show", help="Print the fetched response of a task, keyword or product")
+    key = show.add_mutually_exclusive_group(required=True)
+    key.add_argument("--task-id", help="The id of the task")
+    key.add_argument("--keyword", help="The keyword of the tasks, i.e. the title of the product")
+    key.add_argument("--product-id", help="The ID of the product in the data file")
+    show.add_argument("--data-file", help="The xlsx data file, for --product-id")
+    show.add_argument("--offers", action="store_true", help="Print the offers instead of the responses")
+    show.set_defaults(func=cmd_show)
+
+    run = commands.add_parser("run", help="post, wait, fetch and analyze")
+    run.add_argument("--data-file", help="The xlsx data file")
+    run.add_argument("--resume", action="store_true", help="Only fetch the tasks of the previous call")
+    run.add_argument("--keep-files", action="store_true", help="Do not remove the files of the last run")
+    run.add_argument("--market", action="append", type=parse_market, help=MARKET_HELP)
+    run.add_argument("--changed", action="store_true",
+                     help="Only post the products that are new, changed or stale since the last post")
+    run.set_defaults(func=cmd_run)
+
+    queue_help = "The job queue, sqlite:///FILE or redis://HOST:PORT/DB (default: the url of the [queue] table)"
+    worker = commands.add_parser("worker", help="Run the post, fetch and analyze jobs of the queue")
+    worker.add_argument("--queue", help=queue_help)
+    worker.add_argument("--kind", action="append", choices=["post", "fetch", "analyze"],
+                        help="Only run this kind of jobs, can be repeated")
+    worker.add_argument("--once", action="store_true", help="Stop when no job is ready instead of waiting")
+    worker.set_defaults(func=cmd_worker)
+
+    coordinate = commands.add_parser("coordinate", help="Queue the tasks of the data file for the workers, "
+                                                        "wait for them and write the output file")
+    coordinate.add_argument("--data-file", help="The xlsx data file")
+    coordinate.add_argument("--queue", help=queue_help)
+    coordinate.add_argument("--run-id", help="Id of the run, to wait for or merge a run that was already queued")
+    coordinate.add_argument("--work", action="store_true", help="Also run jobs while waiting")
+    coordinate.add_argument("--merge-only", action="store_true", help="Do not queue the tasks, only merge the run")
+    coordinate.set_defaults(func=cmd_coordinate)
+
+    daemon = commands.add_parser("daemon", help="Keep refreshing the stale products at a steady rate")
+    daemon.add_argument("--data-file", help="The xlsx data file, read again when it changes")
+    daemon.add_argument("--tasks-per-minute", type=float,
+                        help="Posting rate (default: tasks_per_minute of the [daemon] table)")
+    daemon.set_defaults(func=cmd_daemon)
+
+    dag = commands.add_parser("dag", help="Post the products tasks and then the sellers and product_info "
+                                          "tasks of the products found")
+    dag.add_argument("--data-file", help="The xlsx data file")
+    dag.add_argument("--market", action="append", type=parse_market, help=MARKET_HELP)
+    dag.add_argument("--max-wait", type=float,
+                     help="Seconds to wait for the tasks, the pending ones are then marked failed "
+                          "(default: 3600)")
+    dag.set_defaults(func=cmd_dag)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    args = build_parser().parse_args(argv)
+    task_post.configure(load_config(args.config))
+    if args.prom_file:
+        task_post.METRICS.add_hook(PrometheusTextHook(args.prom_file))
+    if args.metrics_log:
+        task_post.METRICS.add_hook(JsonLogHook(args.metrics_log))
+    if args.profile:
+        from profiling import Profiler
+        task_post.METRICS.profiler = Profiler(args.profile, memory=args.profile_memory,
+                                                deterministic=args.profile_cprofile)
+    try:
+        return _run(args)
+    finally:
+        if task_post.METRICS.profiler is not None:
+            print(f"Wrote the profile to {task_post.METRICS.profiler.close()}")
+
+
+def _run(args: argparse.Namespace) -> int:
+    if args.command in ("analyze", "report", "sellers", "show") and not getattr(args, "resolve_ads", False):
+        # Works on the files of the last run only, no session needed
+        args.session = None
+        try:
+            return args.func(args)
+        finally:
+            task_post.METRICS.flush()
+    # The session flushes the metrics and caches when it is closed
+    with task_post.open_session() as args.session:
+        return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
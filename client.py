@@ -1,33 +1,318 @@
-from http.client import HTTPSConnection
+from http.client import HTTPConnection, HTTPSConnection, RemoteDisconnected
 from base64 import b64encode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from json import loads
 from json import dumps
+from time import perf_counter, monotonic, sleep
+from threading import Lock, local
+
+from concurrency import is_throttled, raw_status_code
+from metrics import endpoint_name
+
+
+# Seconds allowed to open a connection and to wait for the response of a call
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+
+# Shortest read timeout, when the deadline of the run is about to pass
+MIN_READ_TIMEOUT = 0.01
+
+# GET calls without side effects, a second copy is sent when they are slow (see RestClient.hedge)
+HEDGED_ENDPOINTS = frozenset(("task_get", "tasks_ready", "locations", "languages"))
+
+# Quantile of the recent latencies of an endpoint after which a call is hedged
+HEDGE_QUANTILE = 0.95
+
+# Latencies kept per endpoint, and how many are needed before hedging
+LATENCY_WINDOW = 256
+MIN_LATENCY_SAMPLES = 20
+
+# Hedged copies allowed, as a fraction of the hedgeable calls, so that a slow API does not get twice the load
+MAX_HEDGE_RATIO = 0.1
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class Deadline:
+    """ Point in time by which the whole run must finish. Every call of the client is
+    limited to the time that is left, and the stages of the pipeline stop starting new
+    work once it has passed.
+
+    Args:
+        seconds (float): Time from now until the deadline.
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.at = monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.at - monotonic())
+
+    def expired(self):
+        return monotonic() >= self.at
+
+    def timeout(self, timeout):
+        """ Returns timeout limited to the time left. """
+        return min(timeout, self.remaining())
+
+    def check(self, what="the run"):
+        if self.expired():
+            raise DeadlineExceeded(f"Deadline of {self.seconds:g} s exceeded before {what}")
+
+
+class RateLimiter:
+    """ Token bucket shared by all the clients and threads of a run. The API allows
+    2000 calls per minute, calls beyond that are delayed until a token is available.
+    """
+
+    def __init__(self, calls_per_minute=2000, burst=None):
+        self.rate = calls_per_minute / 60.0
+        self.capacity = burst or max(1, calls_per_minute // 60)
+        self.tokens = float(self.capacity)
+        self.updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+class LatencyWindow:
+    """ The last latencies of each endpoint, for the hedging delay. """
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self.size = size
+        self._latencies = dict()
+        self._lock = Lock()
+
+    def add(self, endpoint, latency):
+        with self._lock:
+            window = self._latencies.get(endpoint)
+            if window is None:
+                window = self._latencies[endpoint] = deque(maxlen=self.size)
+            window.append(latency)
+
+    def quantile(self, endpoint, q, min_samples=MIN_LATENCY_SAMPLES):
+        """ Returns the q-th quantile of the latencies of endpoint, None if there are fewer than min_samples. """
+        with self._lock:
+            window = self._latencies.get(endpoint)
+            if window is None or len(window) < min_samples:
+                return None
+            latencies = sorted(window)
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
 
 class RestClient:
     domain = "api.dataforseo.com"
 
-    def __init__(self, username, password):
+    def __init__(self, username, password, metrics=None, rate_limiter=None, keep_alive=False,
+                 connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, deadline=None, hedge=False,
+                 domain=None, secure=True, concurrency=None):
         self.username = username
         self.password = password
+        # Optional concurrency.AdaptiveLimiter of the calls in flight per endpoint, shared with other clients
+        self.concurrency = concurrency
+        # Seconds to open a connection and to wait for each read of the response
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # Optional Deadline of the run, no call is started after it. The time left when a
+        # call starts limits each read of its response, not the whole call, so a call may
+        # end somewhat after the deadline
+        self.deadline = deadline
+        # Send a second copy of the idempotent GET calls (HEDGED_ENDPOINTS) that take
+        # longer than the HEDGE_QUANTILE of their recent latencies, the first answer wins
+        self.hedge = hedge
+        self.latencies = LatencyWindow()
+        self._hedge_pool = None
+        self._hedge_lock = Lock()
+        self._hedgeable_calls = 0
+        self._hedged_calls = 0
+        # Another host, e.g. the local stub server of the benchmarks (secure=False for plain HTTP)
+        if domain is not None:
+            self.domain = domain
+        self.secure = secure
+        # Optional metrics.Metrics registry that records every call
+        self.metrics = metrics
+        # Optional RateLimiter shared with other clients
+        self.rate_limiter = rate_limiter
+        # Reuse one connection per thread instead of opening a socket for every call
+        self.keep_alive = keep_alive
+        self._local = local()
+        self._connections = []
+        self._connections_lock = Lock()
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = self._new_connection()
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _new_connection(self):
+        connection_class = HTTPSConnection if self.secure else HTTPConnection
+        return connection_class(self.domain, timeout=self.connect_timeout)
 
-    def request(self, path, method, data=None):
-        connection = HTTPSConnection(self.domain)
+    def _read_timeout(self, path):
+        if self.deadline is None:
+            return self.read_timeout
+        self.deadline.check(path)
+        return self.deadline.timeout(self.read_timeout)
+
+    def _drop_connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+            with self._connections_lock:
+                self._connections.remove(connection)
+
+    def close(self):
+        """ Closes the connections kept open by keep_alive. """
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        if self._hedge_pool is not None:
+            # The losing copies of hedged calls are not waited for
+            self._hedge_pool.shutdown(wait=False)
+            self._hedge_pool = None
+
+    def request(self, path, method, data=None, decode=True):
+        if self.hedge and method == 'GET' and not HEDGED_ENDPOINTS.isdisjoint(endpoint_name(path).split("/")):
+            return self._hedged_request(path, decode)
+        return self._request(path, method, data, decode)
+
+    def _hedged_request(self, path, decode):
+        """ Sends a GET call, and a second copy of it on another connection if the first
+        takes longer than the HEDGE_QUANTILE of the recent latencies of the endpoint.
+        Returns the first answer, the other copy is left to finish in the background.
+        """
+        endpoint = endpoint_name(path)
+        delay = self.latencies.quantile(endpoint, HEDGE_QUANTILE)
+        with self._hedge_lock:
+            self._hedgeable_calls += 1
+            allowed = delay is not None and self._hedged_calls < MAX_HEDGE_RATIO * self._hedgeable_calls
+            if allowed and self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(thread_name_prefix="hedge")
+        if not allowed:
+            return self._request(path, 'GET', None, decode)
+        first = self._hedge_pool.submit(self._request, path, 'GET', None, decode)
+        done, _ = wait([first], timeout=delay)
+        if done:
+            return first.result()
+        with self._hedge_lock:
+            self._hedged_calls += 1
+        if self.metrics is not None:
+            self.metrics.inc("request_hedges_total", endpoint=endpoint)
+        second = self._hedge_pool.submit(self._request, path, 'GET', None, decode)
+        pending = {first, second}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # An error only counts if the other copy failed too, both may be done by now
+            answered = [future for future in (first, second) if future in done and future.exception() is None]
+            if answered:
+                if answered[0] is second and self.metrics is not None:
+                    self.metrics.inc("request_hedge_wins_total", endpoint=endpoint)
+                return answered[0].result()
+        return first.result()
+
+    def _request(self, path, method, data=None, decode=True):
+        timeout = self._read_timeout(path)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+            # The wait for a token may have used up the time that was left
+            timeout = self._read_timeout(path)
+        endpoint = endpoint_name(path)
+        started = None
+        if self.concurrency is not None:
+            started = self.concurrency.acquire(endpoint, None if self.deadline is None else self.deadline.remaining())
+            if started is None:
+                raise DeadlineExceeded(f"Deadline of {self.deadline.seconds:g} s exceeded before {path}")
+            timeout = self._read_timeout(path)
+        start = perf_counter()
+        http_status = 0
+        raw = b""
+        result = None
+        timed_out = False
+        connection = None
         try:
+            reused = self.keep_alive and getattr(self._local, "connection", None) is not None
+            connection = self._connection() if self.keep_alive else self._new_connection()
             base64_bytes = b64encode(
                 ("%s:%s" % (self.username, self.password)).encode("ascii")
                 ).decode("ascii")
             headers = {'Authorization' : 'Basic %s' %  base64_bytes, 'Content-Encoding' : 'gzip'}
-            connection.request(method, path, headers=headers, body=data)
-            response = connection.getresponse()
-            return loads(response.read().decode())
+            try:
+                self._send(connection, timeout, method, path, headers, data)
+                response = connection.getresponse()
+            except (RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                if not reused:
+                    raise
+                # The server closed the idle connection before reading the request
+                connection.close()
+                if self.metrics is not None:
+                    self.metrics.record_retry(path)
+                self._send(connection, timeout, method, path, headers, data)
+                response = connection.getresponse()
+            http_status = response.status
+            raw = response.read()
+            if not decode:
+                # The caller decodes the body, e.g. in a worker process (see decoding.py)
+                return raw
+            result = loads(raw.decode())
+            return result
+        except BaseException as e:
+            timed_out = isinstance(e, TimeoutError)
+            if self.keep_alive:
+                self._drop_connection()
+            raise
         finally:
-            connection.close()
+            if not self.keep_alive and connection is not None:
+                connection.close()
+            latency = perf_counter() - start
+            if http_status:
+                self.latencies.add(endpoint, latency)
+            if result is None and raw:
+                # The body of decode=False calls is only searched for its status code
+                result = dict(status_code=raw_status_code(raw))
+            if started is not None:
+                self.concurrency.release(endpoint, started, latency, is_throttled(http_status, result, timed_out))
+            if self.metrics is not None:
+                self.metrics.record_request(path, method, http_status, latency,
+                                            len(data) if data else 0, len(raw), result)
+
+    def _send(self, connection, timeout, method, path, headers, data):
+        if connection.sock is None:
+            # Opened with the connect timeout of the connection
+            connection.connect()
+        # Each read of the response may wait up to timeout. A timeout of 0 would make the
+        # socket non-blocking instead of failing the reads at once
+        connection.sock.settimeout(max(timeout, MIN_READ_TIMEOUT))
+        connection.request(method, path, headers=headers, body=data)
 
     def get(self, path):
         return self.request(path, 'GET')
 
+    def get_raw(self, path):
+        """ Returns the undecoded body of a GET request. """
+        return self.request(path, 'GET', decode=False)
+
     def post(self, path, data):
-        if isinstance(data, str):
+        # Already serialized bodies (e.g. batching.Batch.body) are sent as they are
+        if isinstance(data, (str, bytes)):
             data_str = data
         else:
             data_str = dumps(data)
@@ -0,0 +1,180 @@
+"""
+This module adapts the number of calls in flight to what the API can take, per endpoint,
+with the AIMD rule of TCP congestion control:
+
+    additive increase:       every healthy call whose endpoint was at its limit raises
+                             the limit by 1 / limit, so about 1 per round of calls,
+    multiplicative decrease: a throttled call (API status 40202, HTTP 429 or 5xx, or a
+                             timeout) cuts the limit by BACKOFF, once per round.
+
+A call is healthy if it succeeded and its latency is at most LATENCY_TOLERANCE times the
+lowest recent latency of its endpoint, slower calls keep the limit where it is. The
+limit of each endpoint is exported as the concurrency_limit gauge.
+
+Example:
+    limiter = AdaptiveLimiter(metrics=metrics)
+    client = RestClient(login, password, concurrency=limiter)
+    with ThreadPoolExecutor(limiter.max_limit) as pool:
+        ...
+"""
+from collections import deque
+from threading import Condition
+from typing import Dict, Optional
+import re
+import time
+
+
+# Limit of a new endpoint, and the bounds of the limits
+INITIAL_LIMIT = 1
+MIN_LIMIT = 1
+MAX_LIMIT = 32
+
+# Factor applied to the limit when a call is throttled
+BACKOFF = 0.5
+
+# Calls slower than this many times the lowest recent latency do not raise the limit
+LATENCY_TOLERANCE = 2.0
+
+# Latencies kept per endpoint for the lowest recent latency
+LATENCY_WINDOW = 100
+
+THROTTLED_STATUS_CODE = 40202
+
+# The status code of a response body, the API writes it before the tasks (see raw_status_code)
+STATUS_CODE = re.compile(rb'"status_code"\s*:\s*(\d+)')
+
+# Bytes of an undecoded body searched for its status code
+STATUS_CODE_BYTES = 256
+
+# Attempts of a task_get call that failed (a connection error or a timeout) before its
+# task is left for a later run
+FETCH_ATTEMPTS = 4
+
+# Seconds before the first retry of such a call, doubled for each further attempt
+RETRY_DELAY = 1.0
+
+
+def is_throttled(http_status: int, response: Optional[Dict] = None, timed_out: bool = False) -> bool:
+    """ Returns whether a call shows that the API is overloaded. """
+    if timed_out or http_status == 429 or http_status >= 500:
+        return True
+    return bool(response) and response.get("status_code") == THROTTLED_STATUS_CODE
+
+
+def raw_status_code(raw: bytes) -> Optional[int]:
+    """ Returns the status code of an undecoded response body, without decoding the tasks,
+    None if it is not at the start of the body.
+    """
+    match = STATUS_CODE.search(raw, 0, STATUS_CODE_BYTES)
+    return int(match.group(1)) if match else None
+
+
+def retry_delay(attempt: int, base: float = RETRY_DELAY) -> float:
+    """ Returns the time to wait before retrying a call that failed attempt times (1, 2, ...). """
+    return base * 2 ** (attempt - 1)
+
+
+def sleep_then(delay: float, call, *args, deadline=None):
+    """ Waits delay (at most until deadline, a client.Deadline) then returns call(*args),
+    e.g. to retry a call in a thread pool after backing off.
+    """
+    if delay > 0:
+        time.sleep(delay if deadline is None else deadline.timeout(delay))
+    return call(*args)
+
+
+class EndpointLimit:
+    __slots__ = ("limit", "in_flight", "latencies", "cut_at")
+
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.latencies: "deque[float]" = deque(maxlen=LATENCY_WINDOW)
+        # Calls started before the last cut do not cut the limit again
+        self.cut_at = 0.0
+
+
+class AdaptiveLimiter:
+    """ Per-endpoint AIMD limit of the calls in flight, shared by the threads of a run.
+
+    Args:
+        initial (float): Limit of an endpoint before its first call.
+        min_limit (float): Lowest limit.
+        max_limit (int): Highest limit, the thread pools do not need more workers than this.
+        backoff (float): Factor applied to the limit on throttling.
+        latency_tolerance (float): See LATENCY_TOLERANCE.
+        metrics (Optional[Metrics]): Registry for the concurrency_limit and concurrency_in_flight gauges.
+    """
+
+    def __init__(self, initial: float = INITIAL_LIMIT, min_limit: float = MIN_LIMIT, max_limit: int = MAX_LIMIT,
+                 backoff: float = BACKOFF, latency_tolerance: float = LATENCY_TOLERANCE, metrics=None):
+        self.initial = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.metrics = metrics
+        self._endpoints: Dict[str, EndpointLimit] = dict()
+        self._condition = Condition()
+
+    def _endpoint(self, endpoint: str) -> EndpointLimit:
+        state = self._endpoints.get(endpoint)
+        if state is None:
+            state = self._endpoints[endpoint] = EndpointLimit(min(max(self.initial, self.min_limit), self.max_limit))
+        return state
+
+    def limit(self, endpoint: str) -> float:
+        with self._condition:
+            return self._endpoint(endpoint).limit
+
+    def acquire(self, endpoint: str, timeout: Optional[float] = None) -> Optional[float]:
+        """ Waits until endpoint is below its limit and counts a call in flight.
+
+        Args:
+            endpoint (str): The endpoint of the call, see metrics.endpoint_name.
+            timeout (Optional[float]): Seconds to wait at most, no limit if it is None.
+
+        Returns:
+            Optional[float]: When the call started, to pass to release, or None on timeout.
+        """
+        with self._condition:
+            state = self._endpoint(endpoint)
+            if not self._condition.wait_for(lambda: state.in_flight < int(state.limit), timeout):
+                return None
+            state.in_flight += 1
+            in_flight = state.in_flight
+        if self.metrics is not None:
+            self.metrics.set_gauge("concurrency_in_flight", in_flight, endpoint=endpoint)
+        return time.monotonic()
+
+    def release(self, endpoint: str, started: float, latency: float, throttled: bool) -> None:
+        """ Ends a call counted by acquire and adapts the limit of its endpoint.
+
+        Args:
+            endpoint (str): The endpoint of the call.
+            started (float): The value returned by acquire.
+            latency (float): The latency of the call.
+            throttled (bool): Whether the call was throttled, see is_throttled.
+        """
+        with self._condition:
+            state = self._endpoint(endpoint)
+            # The limit was in use if the call could not have started with a lower one
+            saturated = state.in_flight >= int(state.limit)
+            state.in_flight -= 1
+            if throttled:
+                if started >= state.cut_at:
+                    state.limit = max(self.min_limit, state.limit * self.backoff)
+                    state.cut_at = time.monotonic()
+            else:
+                state.latencies.append(latency)
+                if saturated and latency <= min(state.latencies) * self.latency_tolerance:
+                    state.limit = min(self.max_limit, state.limit + 1 / state.limit)
+            limit, in_flight = state.limit, state.in_flight
+            self._condition.notify_all()
+        if self.metrics is not None:
+            self.metrics.set_gauge("concurrency_limit", limit, endpoint=endpoint)
+            self.metrics.set_gauge("concurrency_in_flight", in_flight, endpoint=endpoint)
+
+    def report(self) -> Dict[str, float]:
+        with self._condition:
+            return {endpoint: state.limit for endpoint, state in self._endpoints.items()}
@@ -0,0 +1,111 @@
+"""
+This module loads the configuration of a run from a TOML file and the environment, so
+that task_post.py can run without prompting for anything, e.g. from cron.
+
+Example dataforseo.toml:
+
+    [credentials]
+    login = "someone@example.com"
+    password = "api-password"
+
+    [parameters]
+    location_name = "Canada"
+    language_name = "English"
+    priority = 1
+
+    [files]
+    data_file = "product_data.xlsx"
+    output_file = "results.csv"
+    exports = ["offers.xlsx"]
+
+    [run]
+    task_wait = 360
+    deadline = 1800
+    hedge = true
+    max_concurrency = 32
+    max_tasks_per_post = 100
+    max_body_bytes = 1048576
+
+    [markets]
+    locations = ["Canada", "United States"]
+    languages = ["English"]
+
+    [budget]
+    daily_cap = 5.0
+    run_cap = 2.0
+
+    [queue]
+    url = "sqlite:///jobs.db"
+    visibility_timeout = 300
+
+    [daemon]
+    tasks_per_minute = 20
+    min_ttl = 3600
+    max_ttl = 604800
+
+    [snapshot]
+    file = "catalog_snapshot.npz"
+    offers = "catalog_offers.csv"
+    max_age = 604800
+
+    [scheduler]
+    deadline = 3600
+    ids = [1234, 5678]
+    tags = ["Best Seller"]
+    thresholds = {"Variant Inventory Qty" = 50}
+    price_changed = true
+
+Environment variables take precedence over the file: DATAFORSEO_LOGIN and
+DATAFORSEO_PASSWORD for the credentials, DATAFORSEO_PARAM_<NAME> for the entries of
+PARAMETERS (e.g. DATAFORSEO_PARAM_LOCATION_NAME) and DATAFORSEO_CONFIG for the path of
+the file.
+"""
+from typing import Dict, Optional, Union
+import os
+
+
+CONFIG_FILE = "dataforseo.toml"
+
+ENV_PREFIX = "DATAFORSEO_"
+PARAM_PREFIX = ENV_PREFIX + "PARAM_"
+
+
+def _env_value(value: str) -> Union[str, int, float]:
+    """ Converts numeric environment values, e.g. "2" for priority. """
+    for convert in (int, float):
+        try:
+            return convert(value)
+        except ValueError:
+            pass
+    return value
+
+
+def load_config(file_name: Optional[str] = None) -> Dict[str, Dict]:
+    """ Loads the configuration file (if it exists) and applies the environment.
+
+    Args:
+        file_name (Optional[str]): The TOML file, defaults to $DATAFORSEO_CONFIG or CONFIG_FILE.
+
+    Returns:
+        Dict[str, Dict]: The "credentials", "parameters", "files", "run", "markets", "budget", "queue", "daemon", "snapshot" and "scheduler" tables.
+    """
+    file_name = file_name or os.environ.get(ENV_PREFIX + "CONFIG", CONFIG_FILE)
+    config: Dict[str, Dict] = dict(credentials={}, parameters={}, files={}, run={}, markets={}, budget={}, queue={},
+                                   daemon={}, snapshot={}, scheduler={})
+    if os.path.isfile(file_name):
+        try:
+            import tomllib
+        except ImportError:
+            # Python < 3.11
+            import tomli as tomllib
+        with open(file_name, 'rb') as file:
+            for table, values in tomllib.load(file).items():
+                config.setdefault(table, {}).update(values)
+    if os.environ.get(ENV_PREFIX + "LOGIN"):
+        config["credentials"]["login"] = os.environ[ENV_PREFIX + "LOGIN"]
+    if os.environ.get(ENV_PREFIX + "PASSWORD"):
+        config["credentials"]["password"] = os.environ[ENV_PREFIX + "PASSWORD"]
+    for key, value in os.environ.items():
+        if key.startswith(PARAM_PREFIX):
+            config["parameters"][key[len(PARAM_PREFIX):].lower()] = _env_value(value)
+    return config
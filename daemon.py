@@ -0,0 +1,376 @@
+"""
+This module keeps the competitor prices of the catalog fresh without full runs. Every
+product has a freshness deadline: when its results come back, the next refresh is
+scheduled after a time to live that is shorter for products whose lowest competitor price
+moved a lot between refreshes and longer for stable ones (see FreshnessPolicy). The
+products are kept in a min-heap by deadline, and the daemon posts the stale ones at a
+steady rate (tasks_per_minute) instead of the whole spreadsheet at once, so the spend is
+spread over the day and stays within the quota and the budget.
+
+The freshness is saved in the ledger, so a restarted daemon continues where it stopped.
+The health and lag of the daemon are exported as metrics (daemon_* gauges) and written to
+HEALTH_FILE for the monitoring.
+
+Example dataforseo.toml:
+
+    [daemon]
+    tasks_per_minute = 20
+    min_ttl = 3600
+    max_ttl = 604800
+
+Example:
+    python cli.py daemon
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+import heapq
+import json
+import os
+import threading
+import time
+
+from batching import pack_batches
+import batching
+from client import DeadlineExceeded
+from drain import Drainer
+from ledger import Ledger
+from models import Offer
+from scheduler import TASK_TURNAROUND, NORMAL_PRIORITY, Scheduler
+import task_post
+from urls import reset_urls, share_url
+
+
+HEALTH_FILE = "daemon_health.json"
+
+# Steady posting rate, 20 tasks per minute refresh about 29000 products a day
+TASKS_PER_MINUTE = 20.0
+
+# Bounds and default of the time (seconds) between two refreshes of a product
+MIN_TTL = 3600.0
+MAX_TTL = 7 * 24 * 3600.0
+BASE_TTL = 24 * 3600.0
+
+# Relative change of the lowest competitor price per refresh at which BASE_TTL is used,
+# products that move twice as much are refreshed twice as often
+TARGET_CHANGE = 0.05
+
+# Weight of the last change in the volatility (exponential moving average)
+VOLATILITY_ALPHA = 0.3
+
+# Seconds between two loops of the daemon, and between two polls of the ready tasks
+TICK_INTERVAL = 1.0
+POLL_INTERVAL = 60.0
+
+# Seconds between two writes of the output files and of the freshness to the ledger
+OUTPUT_INTERVAL = 600.0
+
+# A posted product whose results did not come back after this many turnarounds is posted again
+IN_FLIGHT_TURNAROUNDS = 2
+
+# The daemon is unhealthy if the oldest stale product waited longer than this
+MAX_LAG = 6 * 3600.0
+
+
+class FreshnessPolicy:
+    """ Time to live of the results of a product from the volatility of its price.
+
+    Args:
+        min_ttl (float): Shortest time between two refreshes.
+        max_ttl (float): Longest time between two refreshes.
+        base_ttl (float): Time between two refreshes of a product whose price changes by target_change.
+        target_change (float): See TARGET_CHANGE.
+        alpha (float): See VOLATILITY_ALPHA.
+    """
+
+    def __init__(self, min_ttl: float = MIN_TTL, max_ttl: float = MAX_TTL, base_ttl: float = BASE_TTL,
+                 target_change: float = TARGET_CHANGE, alpha: float = VOLATILITY_ALPHA):
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.base_ttl = base_ttl
+        self.target_change = target_change
+        self.alpha = alpha
+
+    def volatility(self, volatility: Optional[float], previous: Optional[float], current: Optional[float]) -> float:
+        """ Returns the volatility after a refresh whose lowest price went from previous to current. """
+        if previous is None or current is None or previous <= 0:
+            return volatility if volatility is not None else self.target_change
+        change = abs(current - previous) / previous
+        return change if volatility is None else self.alpha * change + (1 - self.alpha) * volatility
+
+    def ttl(self, volatility: float) -> float:
+        if volatility <= 0:
+            return self.max_ttl
+        return min(self.max_ttl, max(self.min_ttl, self.base_ttl * self.target_change / volatility))
+
+
+class ProductState:
+    __slots__ = ("keyword", "product", "refreshed_at", "due_at", "volatility", "min_price", "in_flight")
+
+    def __init__(self, keyword: str, product: Dict, refreshed_at: Optional[float] = None, due_at: float = 0.0,
+                 volatility: Optional[float] = None, min_price: Optional[float] = None):
+        self.keyword = keyword
+        self.product = product
+        self.refreshed_at = refreshed_at
+        self.due_at = due_at
+        self.volatility = volatility
+        self.min_price = min_price
+        self.in_flight = False
+
+
+def min_offer_price(offers: List[Offer]) -> Optional[float]:
+    prices = [o.price for o in offers if isinstance(o.price, (int, float)) and o.price > 0]
+    return min(prices) if prices else None
+
+
+class RepricingDaemon:
+    """ Posts the stale products continuously and refreshes their deadlines from the results.
+
+    Args:
+        session (Session): The session of the daemon, its budget (if any) caps the spend.
+        ledger (Ledger): Records the posted tasks and the freshness of the products.
+        data_file (str): The xlsx data file, read again when it changes.
+        policy (Optional[FreshnessPolicy]): The time to live of the products.
+        tasks_per_minute (float): The steady posting rate.
+        poll_interval (float): Seconds between two polls of the ready tasks.
+        output_interval (float): Seconds between two writes of the output files.
+        health_file (Optional[str]): Where the health is written at every loop.
+        scheduler (Optional[Scheduler]): Assigns the priority of the tasks, a scheduler with
+                                         the configured priority if it is None.
+    """
+
+    def __init__(self, session, ledger: Ledger, data_file: str, policy: Optional[FreshnessPolicy] = None,
+                 tasks_per_minute: float = TASKS_PER_MINUTE, poll_interval: float = POLL_INTERVAL,
+                 output_interval: float = OUTPUT_INTERVAL, health_file: Optional[str] = HEALTH_FILE,
+                 scheduler: Optional[Scheduler] = None):
+        self.session = session
+        self.ledger = ledger
+        self.data_file = data_file
+        self.policy = policy or FreshnessPolicy()
+        self.rate = tasks_per_minute / 60.0
+        self.poll_interval = poll_interval
+        self.output_interval = output_interval
+        self.health_file = health_file
+        self.scheduler = scheduler if scheduler is not None else Scheduler(priority=task_post.CONFIGURED_PRIORITY)
+        self.metrics = task_post.METRICS
+        self.products: Dict[str, ProductState] = dict()
+        self.id_keyword: Dict[str, Tuple] = dict()
+        # (due_at, keyword), entries whose due_at is not the one of the product are stale
+        self._heap: List[Tuple[float, str]] = list()
+        self.offers: Dict[str, List[Offer]] = dict()
+        self.matcher = None
+        self._data_mtime = None
+        self._tokens = 0.0
+        self._updated = time.monotonic()
+        self._polled_at = 0.0
+        self._output_at = time.monotonic()
+        self._dirty: Dict[str, ProductState] = dict()
+        self._lock = threading.Lock()
+        self.last_post = None
+        self.last_result = None
+        self.started = time.time()
+        self.errors = 0
+
+    def _push(self, state: ProductState) -> None:
+        heapq.heappush(self._heap, (state.due_at, state.keyword))
+
+    def load_catalog(self) -> bool:
+        """ Reads the data file if it changed since the last time, new products are due now.
+        Returns whether it was read.
+        """
+        mtime = os.path.getmtime(self.data_file)
+        if mtime == self._data_mtime:
+            return False
+        self._data_mtime = mtime
+        product_data, id_keyword = task_post.read_xlsx(self.data_file)
+        saved = self.ledger.load_freshness()
+        products: Dict[str, ProductState] = dict()
+        for product in product_data:
+            if product["Variant Barcode"] == '' or not product["Variant Barcode"]:
+                continue
+            keyword = task_post.normalize_keyword(str(product["Title"]))
+            state = self.products.get(keyword)
+            if state is None:
+                refreshed_at, due_at, volatility, min_price = saved.get(keyword, (None, 0.0, None, None))
+                state = ProductState(keyword, product, refreshed_at, due_at, volatility, min_price)
+            state.product = product
+            products[keyword] = state
+        with self._lock:
+            self.products = products
+            self.id_keyword = id_keyword
+            self.matcher = task_post.build_matcher(id_keyword)
+            self._heap = [(state.due_at, state.keyword) for state in products.values()]
+            heapq.heapify(self._heap)
+        print(f"Loaded {len(products)} products from {self.data_file}")
+        return True
+
+    def pop_due(self, now: float, limit: int) -> List[ProductState]:
+        """ Returns up to limit products whose deadline has passed, most overdue first. """
+        due: List[ProductState] = list()
+        with self._lock:
+            while self._heap and len(due) < limit and self._heap[0][0] <= now:
+                due_at, keyword = heapq.heappop(self._heap)
+                state = self.products.get(keyword)
+                if state is not None and state.due_at == due_at:
+                    due.append(state)
+        return due
+
+    def post_due(self, now: float) -> int:
+        """ Posts the stale products the rate allows, returns the number of tasks posted. """
+        elapsed = time.monotonic() - self._updated
+        self._updated += elapsed
+        # At most one full batch of tokens is saved up, the rate stays steady after a pause
+        self._tokens = min(batching.MAX_TASKS_PER_POST, self._tokens + elapsed * self.rate)
+        if self._tokens < 1:
+            return 0
+        due = self.pop_due(now, int(self._tokens))
+        if not due:
+            return 0
+        priorities = {state.keyword: self.scheduler.priority_for(state.product) for state in due}
+        batches = pack_batches([task_post.product_task(state.product, priorities[state.keyword]) for state in due])
+        posted = 0
+        posted_keywords = set()
+        budget = self.session.budget
+        for batch in batches:
+            if budget is not None:
+                admitted = budget.admit(batch)
+                if admitted is None:
+                    print("Budget cap reached, the stale products are posted again when it allows")
+                    break
+                batch = admitted
+            response = self.session.client.post("/v3/merchant/google/products/task_post", batch.body)
+            if response["status_code"] != task_post.SUCCESS_STATUS_CODE:
+                print(f"Error. Code: {response['status_code']} Message: {response['status_message']}")
+                self.errors += 1
+                break
+            for task in response["tasks"]:
+                if task["status_code"] == task_post.TASK_CREATED_CODE:
+                    self.ledger.record_posted(task["id"], "products", None, task.get("cost") or 0)
+                    posted += 1
+            posted_keywords.update(t["keyword"] for t in batch.tasks)
+        self._tokens -= len(due)
+        self.last_post = now
+        with self._lock:
+            for state in due:
+                if state.keyword in posted_keywords:
+                    # Until the results come back, the product is due again when they should have arrived
+                    turnaround = TASK_TURNAROUND.get(priorities[state.keyword], TASK_TURNAROUND[NORMAL_PRIORITY])
+                    state.in_flight = True
+                    state.due_at = now + IN_FLIGHT_TURNAROUNDS * turnaround
+                else:
+                    # Not posted because of the budget or an error, tried again later
+                    state.due_at = now + self.poll_interval
+                self._push(state)
+        self.metrics.inc("daemon_tasks_posted_total", posted)
+        return posted
+
+    def handle(self, endpoint: str, task_id: str, response: Dict) -> None:
+        """ Updates the freshness of the products of a task_get response, see drain.ResultHandler. """
+        now = time.time()
+        for keyword, offers in task_post.iter_products([response], self.matcher):
+            with self._lock:
+                state = self.products.get(keyword)
+                if state is None:
+                    # Removed from the data file since it was posted
+                    continue
+                price = min_offer_price(offers)
+                state.volatility = self.policy.volatility(state.volatility, state.min_price, price)
+                state.min_price = price if price is not None else state.min_price
+                state.refreshed_at = now
+                state.due_at = now + self.policy.ttl(state.volatility)
+                state.in_flight = False
+                self._push(state)
+                for offer in offers:
+                    offer.url = share_url(offer.url)
+                self.offers[keyword] = offers
+                self._dirty[keyword] = state
+            self.metrics.inc("daemon_products_refreshed_total")
+        self.last_result = now
+
+    def poll(self, pool: ThreadPoolExecutor) -> int:
+        drainer = Drainer(self.session.client, self.ledger, pool, self.handle, endpoints=("products",),
+                          only_known=True, metrics=self.metrics)
+        return drainer.drain()
+
+    def save(self) -> None:
+        """ Writes the freshness of the refreshed products to the ledger and the output files,
+        and resets the URL table to the URLs of the current offers (see urls.py).
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, dict()
+            offers = list(self.offers.items())
+            id_keyword = self.id_keyword
+        if dirty:
+            self.ledger.save_freshness([(s.keyword, s.refreshed_at, s.due_at, s.volatility or 0.0, s.min_price)
+                                        for s in dirty.values()])
+        if offers:
+            task_post.write_outputs(offers, id_keyword)
+        # The URLs of the offers that were replaced since the last output are dropped
+        reset_urls(offer.url for _, product_offers in offers for offer in product_offers if offer.url)
+
+    def health(self, now: Optional[float] = None) -> Dict[str, object]:
+        """ Returns the health of the daemon: the number of stale products and how late the
+        oldest one is (lag), when the last post and result happened, and "healthy" if the
+        lag is below MAX_LAG.
+        """
+        now = now or time.time()
+        with self._lock:
+            states = list(self.products.values())
+        stale = [s.due_at for s in states if s.due_at <= now and not s.in_flight]
+        # Products that were already stale when the daemon started are late since then
+        lag = now - max(min(stale), self.started) if stale else 0.0
+        health = dict(
+            time=now, products=len(states), stale=len(stale), in_flight=sum(s.in_flight for s in states),
+            never_refreshed=sum(s.refreshed_at is None for s in states), lag_seconds=lag,
+            last_post=self.last_post, last_result=self.last_result, errors=self.errors,
+            tasks_per_minute=self.rate * 60, healthy=lag <= MAX_LAG)
+        return health
+
+    def report_health(self, now: Optional[float] = None) -> Dict[str, object]:
+        health = self.health(now)
+        self.metrics.set_gauge("daemon_products", health["products"])
+        self.metrics.set_gauge("daemon_stale_products", health["stale"])
+        self.metrics.set_gauge("daemon_in_flight_products", health["in_flight"])
+        self.metrics.set_gauge("daemon_lag_seconds", health["lag_seconds"])
+        self.metrics.set_gauge("daemon_healthy", int(health["healthy"]))
+        self.metrics.set_gauge("daemon_heartbeat_timestamp", health["time"])
+        if self.health_file:
+            tmp_name = self.health_file + ".tmp"
+            with open(tmp_name, 'w', encoding="utf-8") as file:
+                json.dump(health, file)
+            os.replace(tmp_name, self.health_file)
+        return health
+
+    def step(self, pool: ThreadPoolExecutor) -> None:
+        """ One loop: posts the stale products, polls the ready tasks and writes the outputs when it is time. """
+        now = time.time()
+        try:
+            self.load_catalog()
+            self.post_due(now)
+            if time.monotonic() - self._polled_at >= self.poll_interval:
+                self._polled_at = time.monotonic()
+                self.poll(pool)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            # The daemon keeps running, the lag and errors show in the health
+            self.errors += 1
+            print(f"Error in the daemon loop: {e!r}")
+        if time.monotonic() - self._output_at >= self.output_interval:
+            self._output_at = time.monotonic()
+            self.save()
+            self.metrics.flush()
+        self.report_health()
+
+    def run(self, stop: Optional[threading.Event] = None, tick: float = TICK_INTERVAL) -> None:
+        """ Runs until stop is set, the deadline of the session passes or the process is interrupted. """
+        stop = stop or threading.Event()
+        deadline = self.session.deadline
+        with ThreadPoolExecutor(self.session.concurrency.max_limit) as pool:
+            try:
+                while not stop.is_set() and (deadline is None or not deadline.expired()):
+                    self.step(pool)
+                    stop.wait(tick)
+            except (KeyboardInterrupt, DeadlineExceeded):
+                pass
+            finally:
+                self.save()
@@ -0,0 +1,131 @@
+"""
+This module decodes task_get responses in worker processes. Decoding the JSON and
+walking the items is CPU-bound and runs on one core in the main process, so with many
+results the raw bodies (RestClient.get_raw or the documents of the results file) are sent
+to a ProcessPoolExecutor whose workers return only the compact offer rows.
+
+Example:
+    with ProcessPoolExecutor() as pool:
+        price_dict = analyze_raw_results(iter_raw_results(RESULTS_FILE), pool, matcher)
+"""
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import json
+import re
+
+from matching import TitleMatcher, normalize_keyword
+from models import Offer, SUCCESS_STATUS_CODE, parse_response
+from task_post import ANALYZE_CHUNK_SIZE, READ_BLOCK_SIZE, RESULTS_FILE, aggregate_offers
+
+
+# Number of documents sent to a worker at a time
+WORKER_CHUNK_SIZE = 8
+
+# Chunks submitted ahead of the one being aggregated, bounds the documents held in memory
+MAX_PENDING_CHUNKS = 16
+
+# write_results_json writes the documents with indent=4, so the only closing brace at
+# the start of a line is the one that ends a document
+DOCUMENT_END = re.compile(r"^}", re.MULTILINE)
+
+# keyword, title, price, url, currency, domain, seller, rank
+OfferRow = Tuple[str, str, Optional[float], Optional[str], Optional[str], Optional[str], Optional[str], Optional[int]]
+
+
+def extract_offers(raw: Union[str, bytes]) -> Tuple[Optional[int], List[OfferRow]]:
+    """ Decodes a task_get response and returns its offers, runs in the worker processes.
+
+    Args:
+        raw (Union[str, bytes]): The body of the response.
+
+    Returns:
+        Tuple[Optional[int], List[OfferRow]]: The status code of the response if the call
+        failed (None otherwise) and the offer rows of the successful tasks.
+    """
+    return response_offers(json.loads(raw))
+
+
+def response_offers(response: Dict) -> Tuple[Optional[int], List[OfferRow]]:
+    """ Same as extract_offers for a decoded response. """
+    if response.get("status_code") != SUCCESS_STATUS_CODE:
+        return response.get("status_code"), []
+    rows: List[OfferRow] = list()
+    for task in parse_response(response):
+        if task.ok:
+            keyword = normalize_keyword(task.task.keyword)
+            for item in task.items:
+                rows.append((keyword, item.title or "", item.price, item.url, item.currency, item.domain,
+                             item.seller, item.rank))
+    return None, rows
+
+
+def extract_offers_many(raws: List[Union[str, bytes]]) -> List[Tuple[Optional[int], List[OfferRow]]]:
+    return [extract_offers(raw) for raw in raws]
+
+
+def decode_in_pool(raw_results: Iterable[Union[str, bytes]], pool: ProcessPoolExecutor,
+                   chunk_size: int = WORKER_CHUNK_SIZE,
+                   max_pending: int = MAX_PENDING_CHUNKS) -> Iterator[Tuple[Optional[int], List[OfferRow]]]:
+    """ Yields extract_offers of each document in order. Unlike pool.map, documents are
+    only read from raw_results when there is room for them in the pool.
+    """
+    iterator = iter(raw_results)
+    pending: "deque[Future]" = deque()
+    while True:
+        while len(pending) < max_pending:
+            chunk = list(islice(iterator, chunk_size))
+            if not chunk:
+                break
+            pending.append(pool.submit(extract_offers_many, chunk))
+        if not pending:
+            return
+        yield from pending.popleft().result()
+
+
+def iter_raw_results(file_name: str = RESULTS_FILE, block_size: int = READ_BLOCK_SIZE) -> Iterator[str]:
+    """ Yields the undecoded documents of a file written by write_results_json. """
+    with open(file_name, 'r', encoding="utf-8") as file:
+        text = ""
+        while True:
+            block = file.read(block_size)
+            text += block
+            start = 0
+            for match in DOCUMENT_END.finditer(text):
+                yield text[start:match.end()]
+                start = match.end()
+            text = text[start:]
+            if not block:
+                if text.strip():
+                    raise ValueError(f"Incomplete document at the end of {file_name}")
+                return
+
+
+def row_offers(decoded: Iterable[Tuple[Optional[int], List[OfferRow]]]) -> Iterator[Tuple[str, str, Offer]]:
+    for status_code, rows in decoded:
+        if status_code is not None:
+            print(f"ERROR: Status code {status_code} when trying to fetch results")
+        for keyword, title, price, url, currency, domain, seller, rank in rows:
+            # The URLs are canonical already, aggregate_offers shares the ones it keeps between the products
+            yield keyword, title, Offer(price, url or None, currency, domain, seller, rank)
+
+
+def analyze_raw_results(raw_results: Iterable[Union[str, bytes]], pool: Optional[ProcessPoolExecutor] = None,
+                        matcher: Optional[TitleMatcher] = None, chunk_size: int = ANALYZE_CHUNK_SIZE,
+                        max_offers: Optional[int] = None) -> Dict[str, List[Offer]]:
+    """ Same as task_post.analyze_results for undecoded responses, which are decoded in
+    the processes of pool. Without a pool they are decoded in this process.
+
+    Args:
+        raw_results (Iterable[Union[str, bytes]]): The bodies of the task_get responses.
+        pool (Optional[ProcessPoolExecutor]): The worker processes.
+        matcher (Optional[TitleMatcher]): Drops the offers that are not the product of the keyword.
+        chunk_size (int): Number of offers matched at a time.
+        max_offers (Optional[int]): Keeps only the max_offers lowest prices of each product.
+
+    Returns:
+        Dict[str, List[Offer]]: The offers of each keyword.
+    """
+    decoded = map(extract_offers, raw_results) if pool is None else decode_in_pool(raw_results, pool)
+    return aggregate_offers(row_offers(decoded), matcher, chunk_size, max_offers)
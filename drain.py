@@ -0,0 +1,194 @@
+"""
+This module drains the tasks_ready queues of the merchant endpoints. Every round polls
+all the endpoints' ready lists, skips the ids the ledger already has results for and
+fans the task_get calls out to a thread pool, until every queue is empty or the deadline
+of the client has passed. A task_get call that fails with a connection error or a timeout,
+or that is throttled, is retried after backing off (see concurrency.retry_delay), up to FETCH_ATTEMPTS times,
+after which its task is left pending for the next drain.
+"""
+from concurrent.futures import ThreadPoolExecutor, Future, FIRST_COMPLETED, wait
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from client import DeadlineExceeded, RestClient
+from concurrency import is_throttled, retry_delay, sleep_then, FETCH_ATTEMPTS
+from ledger import Ledger, POSTED, FETCHED, FAILED
+
+
+SUCCESS_STATUS_CODE = 20000
+
+MERCHANT_API = "/v3/merchant/google/"
+
+MERCHANT_ENDPOINTS = ("products", "sellers", "product_info", "product_spec")
+
+# tasks_ready returns at most this many ids per call, a full list means there are more
+READY_LIMIT = 1000
+
+# Called with the endpoint, the task id and the task_get response
+ResultHandler = Callable[[str, str, Dict], None]
+
+
+class Drainer:
+    """ Fetches every ready task of the given endpoints.
+
+    Args:
+        client (RestClient): The client used for all calls.
+        ledger (Ledger): Used to skip tasks that were already fetched.
+        pool (ThreadPoolExecutor): Runs the tasks_ready and task_get calls.
+        handle (ResultHandler): Called in the calling thread with each task_get response,
+                                after the tasks in it were marked in the ledger.
+        endpoints (Iterable[str]): The merchant endpoints to drain.
+        only_known (bool): Only fetch tasks that are pending in the ledger, otherwise tasks
+                           posted by other tools are added to the ledger and fetched too.
+        metrics (Optional[Metrics]): Registry for the ready/fetched counters and queue depth.
+        fetched (Optional[Callable[[str], bool]]): Returns whether the result of a task id was
+                                                   already saved, e.g. ResultIndex.contains,
+                                                   those tasks are skipped like the ones the
+                                                   ledger has results for.
+    """
+
+    def __init__(self, client: RestClient, ledger: Ledger, pool: ThreadPoolExecutor,
+                 handle: ResultHandler, endpoints: Iterable[str] = MERCHANT_ENDPOINTS,
+                 only_known: bool = False, metrics=None, fetched: Optional[Callable[[str], bool]] = None):
+        self.client = client
+        self.ledger = ledger
+        self.pool = pool
+        self.handle = handle
+        self.endpoints = tuple(endpoints)
+        self.only_known = only_known
+        self.metrics = metrics
+        self.fetched = fetched
+        self._in_flight: Set[str] = set()
+        self._errors: Set[str] = set()
+        # Failed task_get calls of each task in this drain
+        self._attempts: Dict[str, int] = dict()
+
+    def _ready(self, endpoint: str) -> Tuple[str, List[Dict]]:
+        response = self.client.get(MERCHANT_API + endpoint + "/tasks_ready")
+        if response["status_code"] != SUCCESS_STATUS_CODE:
+            print(f"Error. Code: {response['status_code']} Message: {response['status_message']}")
+            return endpoint, []
+        infos = list()
+        for task in response["tasks"]:
+            infos.extend(task.get("result") or [])
+        return endpoint, infos
+
+    def _wanted(self, endpoint: str, info: Dict) -> bool:
+        task_id = info.get("id")
+        if not task_id or task_id in self._in_flight or task_id in self._errors:
+            return False
+        if self.fetched is not None and self.fetched(task_id):
+            return False
+        status = self.ledger.status(task_id)
+        if status is None and not self.only_known:
+            self.ledger.record_posted(task_id, endpoint, info.get("tag"))
+            return True
+        return status == POSTED
+
+    def _fetch(self, endpoint: str, info: Dict) -> Tuple[str, str, Dict]:
+        path = info.get("endpoint_advanced") or (MERCHANT_API + endpoint + "/task_get/advanced/" + info["id"])
+        return endpoint, info["id"], self.client.get(path)
+
+    def _submit_fetch(self, endpoint: str, info: Dict) -> Future:
+        attempts = self._attempts.get(info["id"], 0)
+        return self.pool.submit(sleep_then, retry_delay(attempts) if attempts else 0, self._fetch, endpoint, info,
+                                deadline=self.client.deadline)
+
+    def _failed(self, endpoint: str, info: Dict, error: str) -> bool:
+        """ Counts a task_get call that failed or was throttled and returns whether to retry it. """
+        task_id = info["id"]
+        self._attempts[task_id] = self._attempts.get(task_id, 0) + 1
+        if self._attempts[task_id] < FETCH_ATTEMPTS and not self._expired():
+            print(f"ERROR: {error} when fetching {task_id}, retrying")
+            return True
+        # Left pending for the next drain
+        print(f"ERROR: {error} when fetching {task_id}")
+        self._in_flight.discard(task_id)
+        self._errors.add(task_id)
+        return False
+
+    def _record(self, task_id: str, response: Dict) -> None:
+        if response["status_code"] != SUCCESS_STATUS_CODE:
+            # Left pending for the next drain, but not fetched again in this one
+            print(f"ERROR: Status code {response['status_code']} when trying to fetch {task_id}")
+            self._errors.add(task_id)
+            return
+        for task in response["tasks"]:
+            status = FETCHED if task["status_code"] == SUCCESS_STATUS_CODE else FAILED
+            self.ledger.mark(task["id"], status, task.get("cost") or 0)
+
+    def _expired(self) -> bool:
+        return self.client.deadline is not None and self.client.deadline.expired()
+
+    def drain(self) -> int:
+        """ Polls and fetches until every endpoint's ready list is empty. Endpoints are
+        polled again while their fetches are still running if their last list was full.
+        Once the deadline of the client has passed, nothing new is started and the tasks
+        that were not fetched are left pending in the ledger.
+
+        Returns:
+            int: The number of fetched tasks.
+        """
+        fetched = 0
+        self._errors = set()
+        self._attempts = dict()
+        active: Set[str] = set()
+        # The endpoint and ready info of each fetch, to retry it
+        fetches: Dict[Future, Tuple[str, Dict]] = dict()
+        polls: Set[Future] = {self.pool.submit(self._ready, e) for e in self.endpoints}
+        while polls or fetches:
+            done, _ = wait(polls | fetches.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                error = future.exception()
+                if isinstance(error, DeadlineExceeded):
+                    polls.discard(future)
+                    fetches.pop(future, None)
+                    continue
+                if future in polls:
+                    polls.discard(future)
+                    if isinstance(error, OSError):
+                        # The endpoint is polled again by the next drain
+                        print(f"ERROR: {error!r} when polling the ready tasks")
+                        if self.metrics is not None:
+                            self.metrics.inc("poll_errors_total")
+                        continue
+                    endpoint, infos = future.result()
+                    new = [info for info in infos if self._wanted(endpoint, info)]
+                    if self.metrics is not None:
+                        self.metrics.set_gauge("queue_depth", len(infos), stage=endpoint)
+                        self.metrics.inc("tasks_ready_total", len(new), endpoint=endpoint)
+                    if self._expired():
+                        continue
+                    for info in new:
+                        self._in_flight.add(info["id"])
+                        fetches[self._submit_fetch(endpoint, info)] = endpoint, info
+                    if len(infos) >= READY_LIMIT:
+                        polls.add(self.pool.submit(self._ready, endpoint))
+                    elif new:
+                        active.add(endpoint)
+                else:
+                    endpoint, info = fetches.pop(future)
+                    if isinstance(error, OSError):
+                        if self.metrics is not None:
+                            self.metrics.inc("fetch_errors_total", endpoint=endpoint)
+                        if self._failed(endpoint, info, repr(error)):
+                            fetches[self._submit_fetch(endpoint, info)] = endpoint, info
+                        continue
+                    endpoint, task_id, response = future.result()
+                    if is_throttled(0, response):
+                        # Not a result, the handler does not get it
+                        if self.metrics is not None:
+                            self.metrics.inc("fetch_throttled_total", endpoint=endpoint)
+                        if self._failed(endpoint, info, f"Status code {response['status_code']}"):
+                            fetches[self._submit_fetch(endpoint, info)] = endpoint, info
+                        continue
+                    self._in_flight.discard(task_id)
+                    fetched += 1
+                    if self.metrics is not None:
+                        self.metrics.inc("tasks_fetched_total", endpoint=endpoint)
+                    self._record(task_id, response)
+                    self.handle(endpoint, task_id, response)
+            if not polls and not fetches and active and not self._expired():
+                # Poll the endpoints that had new tasks once more, tasks may have
+                # finished while the last round was being fetched
+                polls = {self.pool.submit(self._ready, e) for e in active}
+                active = set()
+        return fetched
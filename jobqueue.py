@@ -0,0 +1,675 @@
+"""
+This module spreads a catalog run over several processes or machines through a job
+queue. The coordinator puts one post job per batch in the queue, and the workers pull
+the jobs, wherever they run:
+
+    post:    posts a batch and adds a fetch job for each task it created, visible after TASK_WAIT,
+    fetch:   gets the result of a task (retried later while the task is not ready) and adds an analyze job,
+    analyze: extracts the offers of the result, see decoding.response_offers.
+
+The coordinator then merges the results of the run into RESULTS_FILE and the output files.
+
+A job that is handed to a worker is invisible to the others for the visibility timeout.
+If the worker does not acknowledge it in time (e.g. it crashed), the job is handed out
+again, so every job runs at least once and may run twice. The job ids make that harmless:
+putting a job whose id is already in the queue does nothing, the fetch and analyze jobs
+are keyed by the task id, and only the first result of a job is kept. The batches are
+keyed by their content, so resubmitting a run does not post them again. A post job that
+is handed out again may have created its tasks before the worker failed (e.g. the call
+timed out after the API created them), so the tasks are tagged with the id of the job
+(the tasks the caller tagged keep their tag, which should identify them) and a marker is recorded in the queue before each POST. A job with a marker looks for
+its tasks in the tasks_ready list instead of posting again, and only posts again once
+the tasks of the last POST would have been ready (POST_WINDOW).
+
+Two backends are available, selected by the url of the "queue" table of the config file:
+
+    sqlite:///jobs.db           a SQLite file, for the processes of one host,
+    redis://host:6379/0         a Redis server (or anything that speaks its protocol),
+                                shared by several hosts.
+
+Example dataforseo.toml:
+
+    [queue]
+    url = "redis://10.0.0.5:6379/0"
+    visibility_timeout = 300
+
+Example:
+    python cli.py worker                 (on every machine)
+    python cli.py coordinate             (on one of them)
+"""
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+from urllib.parse import urlparse
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+from batching import Batch, pack_batches
+from client import DeadlineExceeded
+from concurrency import is_throttled
+from decoding import response_offers, row_offers
+from matching import TitleMatcher
+from models import Offer
+from scheduler import TASK_TURNAROUND
+from task_post import aggregate_offers, write_results_json
+
+
+QUEUE_FILE = "jobs.db"
+
+# Seconds a job handed to a worker stays invisible to the other workers
+VISIBILITY_TIMEOUT = 300.0
+
+# Deliveries of a failing job before it is given up
+MAX_ATTEMPTS = 5
+
+# Seconds before a failed job, or a fetch job whose task is not ready, is handed out again
+RETRY_DELAY = 30.0
+
+# Seconds a worker waits when there is no visible job
+POLL_INTERVAL = 2.0
+
+# Seconds after a POST before a post job that was handed out again posts its batch again,
+# if its tasks are not in the tasks_ready list by then the POST did not create them
+POST_WINDOW = float(max(TASK_TURNAROUND.values()))
+
+POST = "post"
+FETCH = "fetch"
+ANALYZE = "analyze"
+JOB_KINDS = (POST, FETCH, ANALYZE)
+
+# Markers of the POST calls of the post jobs, never handed to a worker and outside of the
+# runs, their result is the time of the call
+POSTED = "posted"
+
+PENDING = "pending"
+DONE = "done"
+DEAD = "dead"
+
+SUCCESS_STATUS_CODE = 20000
+TASK_CREATED_CODE = 20100
+
+# task_get status codes of the tasks that are not finished yet
+TASK_NOT_READY_CODES = (40601, 40602)
+
+
+class Job:
+    """ A unit of work of the queue.
+
+    Args:
+        id (str): Unique id, "<kind>:<key>", a job whose id is already in the queue is not added again.
+        kind (str): POST, FETCH or ANALYZE.
+        payload (Dict): The arguments of the job, JSON serializable.
+        run_id (str): The run the job belongs to.
+        attempts (int): How many times the job was handed to a worker, including this time.
+    """
+
+    __slots__ = ("id", "kind", "payload", "run_id", "attempts")
+
+    def __init__(self, id: str, kind: str, payload: Dict, run_id: str = "", attempts: int = 0):
+        self.id = id
+        self.kind = kind
+        self.payload = payload
+        self.run_id = run_id
+        self.attempts = attempts
+
+    def __repr__(self) -> str:
+        return f"Job({self.id!r}, attempts={self.attempts})"
+
+
+def job_id(kind: str, key: str) -> str:
+    return f"{kind}:{key}"
+
+
+def batch_key(batch: Batch) -> str:
+    """ Returns the key of the post job of a batch, the same for the same tasks. """
+    return hashlib.sha1(batch.endpoint.encode("utf-8") + b"\n" + batch.body).hexdigest()[:20]
+
+
+class JobQueue:
+    """ Base class of the backends. """
+
+    def put(self, job: Job, delay: float = 0) -> bool:
+        """ Adds a job, visible after delay seconds.
+
+        Returns:
+            bool: False if a job with the same id was already added, it is left as it is.
+        """
+        raise NotImplementedError
+
+    def get(self, kinds: Sequence[str], worker: str, visibility_timeout: float = VISIBILITY_TIMEOUT) -> Optional[Job]:
+        """ Hands out the visible job of one of kinds that has waited longest, None if there
+        is none. The job is invisible for visibility_timeout seconds.
+        """
+        raise NotImplementedError
+
+    def ack(self, job: Job, result=None) -> None:
+        """ Marks a job as done with its result (JSON serializable). Only the first result
+        of a job is kept.
+        """
+        raise NotImplementedError
+
+    def retry(self, job: Job, delay: float, error: str = "", dead: bool = False) -> None:
+        """ Hands a job out again after delay seconds, or gives it up if dead is True. Does
+        nothing if the job was handed to another worker since.
+        """
+        raise NotImplementedError
+
+    def result(self, id: str):
+        """ Returns the result of a done job, None if it is not done. """
+        raise NotImplementedError
+
+    def results(self, kind: str, run_id: str) -> Iterator[Tuple[str, object]]:
+        """ Yields the id and result of each done job of kind in a run. """
+        raise NotImplementedError
+
+    def counts(self, run_id: str) -> Dict[str, int]:
+        """ Returns the number of PENDING (queued or handed out), DONE and DEAD jobs of a run. """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class SqliteQueue(JobQueue):
+    """ Queue in a SQLite file, shared by the processes of one host.
+
+    Args:
+        file_name (str): The SQLite file.
+    """
+
+    def __init__(self, file_name: str = QUEUE_FILE):
+        self.file_name = file_name
+        self._lock = threading.Lock()
+        # Waits for the other processes instead of failing when the file is locked
+        self._db = sqlite3.connect(file_name, timeout=60, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, run_id TEXT, kind TEXT, payload TEXT, status TEXT, visible_at REAL,"
+            " attempts INTEGER DEFAULT 0, worker TEXT, result TEXT, error TEXT, updated_at REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_visible ON jobs (kind, status, visible_at)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_run ON jobs (run_id, status)")
+
+    def put(self, job: Job, delay: float = 0) -> bool:
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO jobs (id, run_id, kind, payload, status, visible_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job.id, job.run_id, job.kind, json.dumps(job.payload), PENDING, now + delay, now))
+        return cursor.rowcount == 1
+
+    def get(self, kinds: Sequence[str], worker: str, visibility_timeout: float = VISIBILITY_TIMEOUT) -> Optional[Job]:
+        now = time.time()
+        marks = ", ".join("?" * len(kinds))
+        with self._lock:
+            # One statement, so two processes cannot take the same job
+            row = self._db.execute(
+                "UPDATE jobs SET visible_at = ?, attempts = attempts + 1, worker = ?, updated_at = ?"
+                " WHERE id = (SELECT id FROM jobs WHERE status = ? AND kind IN (" + marks + ") AND visible_at <= ?"
+                " ORDER BY visible_at LIMIT 1)"
+                " RETURNING id, kind, payload, run_id, attempts",
+                (now + visibility_timeout, worker, now, PENDING, *kinds, now)).fetchone()
+        if row is None:
+            return None
+        return Job(row[0], row[1], json.loads(row[2]), row[3], row[4])
+
+    def ack(self, job: Job, result=None) -> None:
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, updated_at = ? WHERE id = ? AND status != ?",
+                (DONE, json.dumps(result), time.time(), job.id, DONE))
+
+    def retry(self, job: Job, delay: float, error: str = "", dead: bool = False) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET status = ?, visible_at = ?, error = ?, updated_at = ?"
+                " WHERE id = ? AND status = ? AND attempts = ?",
+                (DEAD if dead else PENDING, now + delay, error, now, job.id, PENDING, job.attempts))
+
+    def result(self, id: str):
+        with self._lock:
+            row = self._db.execute("SELECT result FROM jobs WHERE id = ? AND status = ?", (id, DONE)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def results(self, kind: str, run_id: str) -> Iterator[Tuple[str, object]]:
+        with self._lock:
+            ids = [row[0] for row in self._db.execute(
+                "SELECT id FROM jobs WHERE run_id = ? AND kind = ? AND status = ?", (run_id, kind, DONE))]
+        # The results are read one at a time, they can be large
+        for id in ids:
+            yield id, self.result(id)
+
+    def counts(self, run_id: str) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs WHERE run_id = ? GROUP BY status", (run_id,))
+            counts = dict(rows.fetchall())
+        return {status: counts.get(status, 0) for status in (PENDING, DONE, DEAD)}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+
+class RespError(RuntimeError):
+    pass
+
+
+class RespConnection:
+    """ Minimal client of the Redis protocol (RESP2), enough for RedisQueue.
+
+    Args:
+        host (str): The server.
+        port (int): Its port.
+        db (int): The database number.
+        password (Optional[str]): The password, if the server needs one.
+        timeout (float): Seconds to connect and to wait for a reply.
+    """
+
+    def __init__(self, host: str = "localhost", port: int = 6379, db: int = 0, password: Optional[str] = None,
+                 timeout: float = 30.0):
+        self._lock = threading.Lock()
+        self._socket = socket.create_connection((host, port), timeout=timeout)
+        self._file = self._socket.makefile("rb")
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    @staticmethod
+    def _encode(args: Sequence) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = (repr(arg) if isinstance(arg, float) else str(arg)).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(parts)
+
+    def _read(self):
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("The Redis server closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            # Raised by execute, after the rest of a transaction's replies were read
+            return RespError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            if rest == b"-1":
+                return None
+            data = self._file.read(int(rest) + 2)
+            return data[:-2].decode("utf-8")
+        if kind == b"*":
+            if rest == b"-1":
+                return None
+            return [self._read() for _ in range(int(rest))]
+        raise RespError(f"Unexpected reply {line!r}")
+
+    def execute(self, *args):
+        """ Sends a command and returns its reply. """
+        with self._lock:
+            self._socket.sendall(self._encode(args))
+            reply = self._read()
+        if isinstance(reply, RespError):
+            raise reply
+        return reply
+
+    def transaction(self, *commands: Sequence) -> List:
+        """ Runs the commands in a MULTI/EXEC block and returns their replies. """
+        with self._lock:
+            self._socket.sendall(b"".join(self._encode(args) for args in
+                                          [("MULTI",), *commands, ("EXEC",)]))
+            replies = [self._read() for _ in range(len(commands) + 2)]
+        errors = [reply for reply in replies if isinstance(reply, RespError)]
+        if errors:
+            raise errors[0]
+        return replies[-1]
+
+    def close(self) -> None:
+        with self._lock:
+            self._file.close()
+            self._socket.close()
+
+
+class RedisQueue(JobQueue):
+    """ Queue in a Redis server, shared by several hosts. The visible jobs of each kind are
+    a sorted set scored by the time they become visible. A worker takes a job by setting a
+    claim key for the job and its current score with NX, so only one worker gets it, and a
+    worker that crashes before moving the job releases it when its claim expires.
+
+    The hosts should have their clocks synchronized (e.g. NTP), the visibility of the jobs
+    is compared to the clock of each worker.
+
+    Args:
+        connection (RespConnection): The connection to the server.
+        prefix (str): Prefix of the keys of the queue.
+    """
+
+    def __init__(self, connection: RespConnection, prefix: str = "dataforseo:"):
+        self.connection = connection
+        self.prefix = prefix
+
+    def _key(self, *parts: str) -> str:
+        return self.prefix + ":".join(parts)
+
+    def put(self, job: Job, delay: float = 0) -> bool:
+        job_key = self._key("job", job.id)
+        if not self.connection.execute("HSETNX", job_key, "kind", job.kind):
+            return False
+        self.connection.transaction(
+            ("HSET", job_key, "run_id", job.run_id, "payload", json.dumps(job.payload), "status", PENDING,
+             "attempts", 0),
+            ("SADD", self._key("run", job.run_id, "all"), job.id),
+            ("ZADD", self._key("visible", job.kind), time.time() + delay, job.id))
+        return True
+
+    def get(self, kinds: Sequence[str], worker: str, visibility_timeout: float = VISIBILITY_TIMEOUT) -> Optional[Job]:
+        now = time.time()
+        for kind in kinds:
+            visible = self._key("visible", kind)
+            candidates = self.connection.execute("ZRANGEBYSCORE", visible, "-inf", now, "WITHSCORES", "LIMIT", 0, 8)
+            for id, score in zip(candidates[::2], candidates[1::2]):
+                claim = self._key("claim", id, score)
+                if self.connection.execute("SET", claim, worker, "NX", "PX", int(visibility_timeout * 1000)) is None:
+                    # Taken by another worker
+                    continue
+                # XX: the job may have been acknowledged since it was listed
+                if not self.connection.execute("ZADD", visible, "XX", "CH", now + visibility_timeout, id):
+                    continue
+                job_key = self._key("job", id)
+                attempts = self.connection.execute("HINCRBY", job_key, "attempts", 1)
+                run_id, payload = self.connection.execute("HMGET", job_key, "run_id", "payload")
+                return Job(id, kind, json.loads(payload), run_id or "", attempts)
+        return None
+
+    def ack(self, job: Job, result=None) -> None:
+        job_key = self._key("job", job.id)
+        if self.connection.execute("HSETNX", job_key, "result", json.dumps(result)):
+            self.connection.transaction(
+                ("HSET", job_key, "status", DONE),
+                ("ZREM", self._key("visible", job.kind), job.id),
+                ("SADD", self._key("run", job.run_id, DONE), job.id))
+
+    def retry(self, job: Job, delay: float, error: str = "", dead: bool = False) -> None:
+        job_key = self._key("job", job.id)
+        status, attempts = self.connection.execute("HMGET", job_key, "status", "attempts")
+        if status != PENDING or int(attempts or 0) != job.attempts:
+            return
+        if dead:
+            self.connection.transaction(
+                ("HSET", job_key, "status", DEAD, "error", error),
+                ("ZREM", self._key("visible", job.kind), job.id),
+                ("SADD", self._key("run", job.run_id, DEAD), job.id))
+        else:
+            self.connection.transaction(
+                ("HSET", job_key, "error", error),
+                ("ZADD", self._key("visible", job.kind), "XX", time.time() + delay, job.id))
+
+    def result(self, id: str):
+        status, result = self.connection.execute("HMGET", self._key("job", id), "status", "result")
+        return json.loads(result) if status == DONE and result is not None else None
+
+    def results(self, kind: str, run_id: str) -> Iterator[Tuple[str, object]]:
+        for id in self.connection.execute("SMEMBERS", self._key("run", run_id, DONE)):
+            if id.startswith(kind + ":"):
+                yield id, self.result(id)
+
+    def counts(self, run_id: str) -> Dict[str, int]:
+        total = self.connection.execute("SCARD", self._key("run", run_id, "all"))
+        done = self.connection.execute("SCARD", self._key("run", run_id, DONE))
+        dead = self.connection.execute("SCARD", self._key("run", run_id, DEAD))
+        return {PENDING: total - done - dead, DONE: done, DEAD: dead}
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+def open_queue(url: Optional[str] = None) -> JobQueue:
+    """ Opens the queue of a url, "sqlite:///<file>" or "redis://[:password@]host[:port][/db]".
+    A plain file name is a SQLite file, the default is QUEUE_FILE.
+    """
+    url = url or QUEUE_FILE
+    parsed = urlparse(url)
+    if parsed.scheme == "redis":
+        db = int(parsed.path.strip("/") or 0)
+        return RedisQueue(RespConnection(parsed.hostname or "localhost", parsed.port or 6379, db, parsed.password))
+    if parsed.scheme == "sqlite":
+        return SqliteQueue(parsed.path[1:] if parsed.path.startswith("//") else parsed.path.lstrip("/") or QUEUE_FILE)
+    if parsed.scheme in ("", "file"):
+        return SqliteQueue(parsed.path or url)
+    raise ValueError(f"Unknown queue {url!r}, expected sqlite:///FILE or redis://HOST:PORT/DB")
+
+
+class TaskNotReady(Exception):
+    pass
+
+
+class OverBudget(Exception):
+    pass
+
+
+class Worker:
+    """ Pulls jobs from a queue and runs them with the client of a session.
+
+    Args:
+        queue (JobQueue): The queue.
+        session (Session): The session whose client makes the calls.
+        kinds (Sequence[str]): The kinds of jobs this worker runs.
+        name (Optional[str]): Identifies the worker in the queue, defaults to host:pid.
+        visibility_timeout (float): See VISIBILITY_TIMEOUT, should be longer than the longest job.
+        task_wait (float): Seconds after a post before its fetch jobs are visible.
+        post_window (float): See POST_WINDOW.
+    """
+
+    def __init__(self, queue: JobQueue, session, kinds: Sequence[str] = JOB_KINDS, name: Optional[str] = None,
+                 visibility_timeout: float = VISIBILITY_TIMEOUT, task_wait: float = 0.0,
+                 max_attempts: int = MAX_ATTEMPTS, retry_delay: float = RETRY_DELAY,
+                 post_window: float = POST_WINDOW):
+        self.queue = queue
+        self.session = session
+        self.kinds = tuple(kinds)
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.visibility_timeout = visibility_timeout
+        self.task_wait = task_wait
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.post_window = post_window
+        self.handlers = {POST: self.post, FETCH: self.fetch, ANALYZE: self.analyze}
+
+    def post(self, job: Job):
+        endpoint = job.payload["endpoint"]
+        # The tag finds the tasks of the job in the tasks_ready list, the tags of the caller are kept
+        tasks = [task if task.get("tag") else dict(task, tag=job.id) for task in json.loads(job.payload["body"])]
+        tags = {task["tag"] for task in tasks}
+        batches = pack_batches(tasks, endpoint)
+        if self.session.budget is not None:
+            # Degraded to normal priority above the soft cap, like task_post.send_post
+            batches = [self.session.budget.admit(batch) for batch in batches]
+            if any(batch is None for batch in batches):
+                raise OverBudget(f"Posting {job.id} would exceed the hard cap of the budget")
+        n = 1
+        while self.queue.result(job_id(POSTED, f"{job.id}:{n}")) is not None:
+            n += 1
+        if n > 1:
+            task_ids = self._ready_tasks(endpoint, tags)
+            if task_ids:
+                print(f"{job.id} was posted before, {len(task_ids)} of its tasks are ready")
+                self._add_fetch_jobs(job, task_ids, delay=0)
+                return dict(task_ids=task_ids)
+            if time.time() - self.queue.result(job_id(POSTED, f"{job.id}:{n - 1}"))["at"] < self.post_window:
+                # The tasks of the last POST may still be in the queue of the API
+                raise TaskNotReady(job.id)
+        marker = Job(job_id(POSTED, f"{job.id}:{n}"), POSTED, dict(), "")
+        if not self.queue.put(marker):
+            # Another worker is posting the job
+            raise TaskNotReady(job.id)
+        self.queue.ack(marker, dict(at=time.time()))
+        task_ids = list()
+        for batch in batches:
+            response = self.session.client.post("/v3/merchant/google/" + endpoint + "/task_post", batch.body)
+            if response["status_code"] != SUCCESS_STATUS_CODE:
+                raise RuntimeError(f"Code: {response['status_code']} Message: {response['status_message']}")
+            created = list()
+            for task in response["tasks"]:
+                if task["status_code"] == TASK_CREATED_CODE:
+                    created.append(task["id"])
+                else:
+                    print(f"Error. Code: {task['status_code']} Message: {task['status_message']}")
+            self._add_fetch_jobs(job, created, delay=self.task_wait)
+            task_ids.extend(created)
+        return dict(task_ids=task_ids)
+
+    def _ready_tasks(self, endpoint: str, tags: Set[str]) -> List[str]:
+        """ Returns the ids of the tasks with one of tags that are ready and were not fetched yet. """
+        response = self.session.client.get("/v3/merchant/google/" + endpoint + "/tasks_ready")
+        if response["status_code"] != SUCCESS_STATUS_CODE:
+            raise RuntimeError(f"Code: {response['status_code']} Message: {response['status_message']}")
+        return [info["id"] for task in response["tasks"] for info in task.get("result") or []
+                if info.get("tag") in tags]
+
+    def _add_fetch_jobs(self, job: Job, task_ids: List[str], delay: float) -> None:
+        for task_id in task_ids:
+            self.queue.put(Job(job_id(FETCH, task_id), FETCH, dict(task_id=task_id, endpoint=job.payload["endpoint"]),
+                               job.run_id), delay=delay)
+
+    def fetch(self, job: Job):
+        raw = self.session.client.get_raw(
+            "/v3/merchant/google/" + job.payload["endpoint"] + "/task_get/advanced/" + job.payload["task_id"])
+        response = json.loads(raw)
+        if is_throttled(0, response):
+            # Fetched again after backing off, like a task that is not ready
+            raise TaskNotReady(job.payload["task_id"])
+        if response.get("status_code") != SUCCESS_STATUS_CODE:
+            raise RuntimeError(f"Code: {response.get('status_code')} Message: {response.get('status_message')}")
+        tasks = response.get("tasks") or []
+        if tasks and tasks[0].get("status_code") in TASK_NOT_READY_CODES:
+            raise TaskNotReady(job.payload["task_id"])
+        self.queue.put(Job(job_id(ANALYZE, job.payload["task_id"]), ANALYZE,
+                           dict(fetch_job=job.id), job.run_id))
+        return response
+
+    def analyze(self, job: Job):
+        response = self.queue.result(job.payload["fetch_job"])
+        if response is None:
+            raise RuntimeError(f"No result for {job.payload['fetch_job']}")
+        status_code, rows = response_offers(response)
+        return dict(status_code=status_code, rows=rows)
+
+    def run_job(self, job: Job) -> bool:
+        """ Runs a job and acknowledges or retries it. Returns whether it succeeded. """
+        try:
+            result = self.handlers[job.kind](job)
+        except TaskNotReady:
+            # Not a failure, the task is still in the queue of the API
+            self.queue.retry(job, self.retry_delay)
+            return False
+        except OverBudget as e:
+            # Posting it later the same day would exceed the cap too
+            print(f"{e}, giving up")
+            self.queue.retry(job, self.retry_delay, repr(e), dead=True)
+            return False
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            dead = job.attempts >= self.max_attempts
+            print(f"Error in {job.id} (attempt {job.attempts}): {e!r}" + (", giving up" if dead else ""))
+            self.queue.retry(job, self.retry_delay, repr(e), dead=dead)
+            return False
+        self.queue.ack(job, result)
+        return True
+
+    def run(self, once: bool = False, poll_interval: float = POLL_INTERVAL) -> int:
+        """ Runs jobs until the deadline of the session passes, or until no job is visible if once is True.
+
+        Returns:
+            int: The number of jobs that succeeded.
+        """
+        succeeded = 0
+        deadline = self.session.deadline
+        while deadline is None or not deadline.expired():
+            job = self.queue.get(self.kinds, self.name, self.visibility_timeout)
+            if job is None:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+            try:
+                succeeded += self.run_job(job)
+            except DeadlineExceeded:
+                # Handed out again after its visibility timeout
+                break
+        return succeeded
+
+
+class Coordinator:
+    """ Submits the batches of a run to a queue and merges the results of the workers.
+
+    Args:
+        queue (JobQueue): The queue.
+        run_id (Optional[str]): Identifies the run, defaults to the start time. A run can
+                                be merged again, or waited for from another process, with the same id.
+    """
+
+    def __init__(self, queue: JobQueue, run_id: Optional[str] = None):
+        self.queue = queue
+        self.run_id = run_id or time.strftime("%Y%m%d-%H%M%S")
+
+    def submit(self, batches: Iterable[Batch]) -> int:
+        """ Adds a post job per batch, returns the number of new jobs. """
+        added = 0
+        for batch in batches:
+            added += self.queue.put(Job(job_id(POST, batch_key(batch)), POST,
+                                        dict(endpoint=batch.endpoint, body=batch.body.decode("utf-8")), self.run_id))
+        return added
+
+    def wait(self, poll_interval: float = POLL_INTERVAL, worker: Optional[Worker] = None,
+             deadline=None) -> Dict[str, int]:
+        """ Waits until no job of the run is pending or deadline (a client.Deadline) passes,
+        running the jobs with worker if one is given.
+
+        Returns:
+            Dict[str, int]: The counts of the jobs, see JobQueue.counts.
+        """
+        while True:
+            counts = self.queue.counts(self.run_id)
+            if not counts[PENDING] or (deadline is not None and deadline.expired()):
+                return counts
+            print(f"{counts[PENDING]} jobs pending, {counts[DONE]} done, {counts[DEAD]} failed")
+            if worker is None or not worker.run(once=True):
+                time.sleep(poll_interval)
+
+    def iter_responses(self) -> Iterator[Dict]:
+        """ Yields the task_get responses of the run. """
+        for _, response in self.queue.results(FETCH, self.run_id):
+            yield response
+
+    def iter_offers(self) -> Iterator[Tuple[str, str, Offer]]:
+        """ Yields the offers of the analyze jobs of the run, as task_post.iter_offers does. """
+        for _, result in self.queue.results(ANALYZE, self.run_id):
+            if result["status_code"] is None:
+                yield from row_offers([(None, result["rows"])])
+            else:
+                print(f"ERROR: Status code {result['status_code']} when trying to fetch results")
+
+    def merge(self, matcher: Optional[TitleMatcher] = None, results_file: Optional[str] = None,
+              max_offers: Optional[int] = None) -> Dict[str, List[Offer]]:
+        """ Merges the results of the run.
+
+        Args:
+            matcher (Optional[TitleMatcher]): Drops the offers that are not the product of the keyword.
+            results_file (Optional[str]): Also writes the responses to this file, as write_results_json does.
+            max_offers (Optional[int]): Keeps only the max_offers lowest prices of each product.
+
+        Returns:
+            Dict[str, List[Offer]]: The offers of each keyword, see task_post.analyze_results.
+        """
+        if results_file:
+            write_results_json(self.iter_responses(), results_file)
+        return aggregate_offers(self.iter_offers(), matcher, max_offers=max_offers)
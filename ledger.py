@@ -0,0 +1,141 @@
+"""
+This module keeps track of every task posted to DataForSEO in a SQLite file, so that
+the different stages of a run (and later runs) know which tasks are still pending,
+which results were already fetched and what each task cost. It also keeps the spend
+of each day, run and endpoint (see budget.py) and the freshness of each product (see
+daemon.py).
+"""
+from typing import Dict, List, Optional, Tuple
+import sqlite3
+import threading
+import time
+
+
+LEDGER_FILE = "ledger.db"
+
+POSTED = "posted"
+FETCHED = "fetched"
+FAILED = "failed"
+
+
+class Ledger:
+    """ Thread-safe record of the tasks of one or more runs.
+
+    Args:
+        file_name (str): The SQLite file, ":memory:" for a ledger that is not persisted.
+        run_id (Optional[str]): Identifies the current run, defaults to the start time.
+    """
+
+    def __init__(self, file_name: str = LEDGER_FILE, run_id: Optional[str] = None):
+        self.file_name = file_name
+        self.run_id = run_id or time.strftime("%Y%m%d-%H%M%S")
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(file_name, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " id TEXT PRIMARY KEY, run_id TEXT, stage TEXT, tag TEXT, status TEXT,"
+            " posted_at REAL, fetched_at REAL, cost REAL DEFAULT 0)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (stage, status)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spend ("
+            " day TEXT, run_id TEXT, endpoint TEXT, cost REAL DEFAULT 0, calls INTEGER DEFAULT 0,"
+            " PRIMARY KEY (day, run_id, endpoint))")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS freshness ("
+            " keyword TEXT PRIMARY KEY, refreshed_at REAL, due_at REAL, volatility REAL, min_price REAL)")
+
+    def record_posted(self, task_id: str, stage: str, tag: Optional[str] = None, cost: float = 0) -> None:
+        """ Adds a task that was created by a task_post call. """
+        with self._lock:
+            self._db.execute(
+                "INSERT OR IGNORE INTO tasks (id, run_id, stage, tag, status, posted_at, cost)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (task_id, self.run_id, stage, tag, POSTED, time.time(), cost))
+
+    def mark(self, task_id: str, status: str, cost: float = 0) -> None:
+        """ Sets the status of a task, adding the cost of the call that changed it. """
+        with self._lock:
+            self._db.execute(
+                "UPDATE tasks SET status = ?, fetched_at = ?, cost = cost + ? WHERE id = ?",
+                (status, time.time(), cost, task_id))
+
+    def status(self, task_id: str) -> Optional[str]:
+        """ Returns the status of a task or None if it is not in the ledger. """
+        with self._lock:
+            row = self._db.execute("SELECT status FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return row[0] if row else None
+
+    def is_pending(self, task_id: str) -> bool:
+        return self.status(task_id) == POSTED
+
+    def pending(self, stage: Optional[str] = None, run_only: bool = True) -> List[str]:
+        """ Returns the ids of the tasks that were posted but not fetched yet. """
+        query = "SELECT id FROM tasks WHERE status = ?"
+        args: List[str] = [POSTED]
+        if stage is not None:
+            query += " AND stage = ?"
+            args.append(stage)
+        if run_only:
+            query += " AND run_id = ?"
+            args.append(self.run_id)
+        with self._lock:
+            return [row[0] for row in self._db.execute(query, args)]
+
+    def counts(self) -> Dict[str, Dict[str, int]]:
+        """ Returns the number of tasks of the current run by stage and status. """
+        result: Dict[str, Dict[str, int]] = dict()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT stage, status, COUNT(*) FROM tasks WHERE run_id = ? GROUP BY stage, status",
+                (self.run_id,)).fetchall()
+        for stage, status, n in rows:
+            result.setdefault(stage, dict())[status] = n
+        return result
+
+    def add_spend(self, day: str, spend: Dict[str, Tuple[float, int]]) -> None:
+        """ Adds the cost and number of calls of each endpoint to the spend of the day
+        (YYYY-MM-DD, UTC) of the current run.
+        """
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT INTO spend (day, run_id, endpoint, cost, calls) VALUES (?, ?, ?, ?, ?)"
+                " ON CONFLICT (day, run_id, endpoint)"
+                " DO UPDATE SET cost = cost + excluded.cost, calls = calls + excluded.calls",
+                [(day, self.run_id, endpoint, cost, calls) for endpoint, (cost, calls) in spend.items()])
+            self._db.execute("COMMIT")
+
+    def spent(self, day: Optional[str] = None, run_only: bool = False) -> Dict[str, Tuple[float, int]]:
+        """ Returns the cost and number of calls by endpoint, of one day and/or of the current run. """
+        query = "SELECT endpoint, SUM(cost), SUM(calls) FROM spend WHERE 1"
+        args: List[str] = list()
+        if day is not None:
+            query += " AND day = ?"
+            args.append(day)
+        if run_only:
+            query += " AND run_id = ?"
+            args.append(self.run_id)
+        with self._lock:
+            rows = self._db.execute(query + " GROUP BY endpoint", args).fetchall()
+        return {endpoint: (cost, calls) for endpoint, cost, calls in rows}
+
+    def save_freshness(self, rows: List[Tuple[str, Optional[float], float, float, Optional[float]]]) -> None:
+        """ Saves the (keyword, refreshed_at, due_at, volatility, min_price) of products. """
+        with self._lock:
+            self._db.execute("BEGIN")
+            self._db.executemany(
+                "INSERT OR REPLACE INTO freshness (keyword, refreshed_at, due_at, volatility, min_price)"
+                " VALUES (?, ?, ?, ?, ?)", rows)
+            self._db.execute("COMMIT")
+
+    def load_freshness(self) -> Dict[str, Tuple[Optional[float], float, float, Optional[float]]]:
+        """ Returns the (refreshed_at, due_at, volatility, min_price) of each product by keyword. """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT keyword, refreshed_at, due_at, volatility, min_price FROM freshness").fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,189 @@
+"""
+This module runs the catalog in several markets (pairs of location and language) at
+once. The markets are validated against the locations and languages of the API, every
+product task is expanded into one task per market, and the results are compared per
+market and across the markets of each product. The offers of the markets are in
+different currencies, so each market gets its own output file (see market_file_name).
+
+Example dataforseo.toml, the markets are all the pairs of locations and languages:
+
+    [markets]
+    locations = ["Canada", "United States"]
+    languages = ["English"]
+"""
+from difflib import get_close_matches
+from statistics import median
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple
+import csv
+import os
+import re
+
+from matching import normalize_keyword
+from models import Offer, parse_response
+
+
+SUCCESS_STATUS_CODE = 20000
+
+MARKETS_OUTPUT_FILE = "markets.csv"
+
+
+class Market(NamedTuple):
+    location_name: str
+    language_name: str
+
+    def __str__(self) -> str:
+        return f"{self.location_name}:{self.language_name}"
+
+
+def parse_market(text: str) -> Market:
+    """ Parses "LOCATION:LANGUAGE", e.g. "Canada:French". """
+    location, sep, language = text.rpartition(":")
+    if not sep or not location.strip() or not language.strip():
+        raise ValueError(f"Invalid market {text!r}, expected LOCATION:LANGUAGE")
+    return Market(location.strip(), language.strip())
+
+
+def market_matrix(locations: Sequence[str], languages: Sequence[str]) -> List[Market]:
+    """ Returns every pair of the locations and languages. """
+    return [Market(location, language) for location in locations for language in languages]
+
+
+def markets_from_config(config: Dict[str, Dict]) -> List[Market]:
+    """ Returns the markets of the "markets" table of a configuration, none if it has no
+    locations or languages.
+    """
+    table = config.get("markets", {})
+    return market_matrix(table.get("locations", []), table.get("languages", []))
+
+
+def _canonical(name: str, known: Dict[str, str], kind: str) -> str:
+    canonical = known.get(name.lower())
+    if canonical is None:
+        suggestions = get_close_matches(name, list(known.values()), n=3)
+        hint = f", did you mean {' or '.join(suggestions)}?" if suggestions else ""
+        raise ValueError(f"Unknown {kind} {name!r}{hint}")
+    return canonical
+
+
+def market_file_name(file_name: str, market: Market) -> str:
+    """ Returns the file of a market for one of the output files, e.g.
+    results.Canada.French.csv for results.csv.
+    """
+    root, ext = os.path.splitext(file_name)
+    parts = [re.sub(r"\W+", "_", part).strip("_") for part in market]
+    return f"{root}.{'.'.join(parts)}{ext}"
+
+
+def validate_markets(markets: Iterable[Market], locations: List[Dict], languages: List[Dict]) -> List[Market]:
+    """ Checks the markets against the results of get_locations and get_languages.
+
+    Args:
+        markets (Iterable[Market]): The markets of the run.
+        locations (List[Dict]): The locations of the API, see task_post.get_locations.
+        languages (List[Dict]): The languages of the API, see task_post.get_languages.
+
+    Returns:
+        List[Market]: The distinct markets with the names spelled as the API does.
+
+    Raises:
+        ValueError: If a location or language is not supported.
+    """
+    known_locations = {l["location_name"].lower(): l["location_name"] for l in locations}
+    known_languages = {l["language_name"].lower(): l["language_name"] for l in languages}
+    validated: Dict[Market, None] = dict()
+    for market in markets:
+        location, language = market
+        if known_locations:
+            location = _canonical(location, known_locations, "location")
+        if known_languages:
+            language = _canonical(language, known_languages, "language")
+        validated[Market(location, language)] = None
+    if not known_locations or not known_languages:
+        print("Warning: the locations or languages could not be loaded, the markets are not validated")
+    return list(validated)
+
+
+def expand_markets(tasks: Iterable[Dict], markets: Sequence[Market]) -> List[Dict]:
+    """ Returns one copy of each task per market. The copies of a task are next to each
+    other, so every batch holds about the same number of tasks of each market and a
+    market does not wait for the batches of the others. The keyword and other values are
+    shared by the copies.
+    """
+    return [dict(task, location_name=market.location_name, language_name=market.language_name)
+            for task in tasks for market in markets]
+
+
+def iter_market_offers(results: Iterable[Dict]) -> Iterator[Tuple[Tuple[str, Market], str, Offer]]:
+    """ Same as task_post.iter_offers, keyed by (keyword, market) instead of the keyword. """
+    for r in results:
+        if r["status_code"] != SUCCESS_STATUS_CODE:
+            print(f"ERROR: Status code {r['status_code']} when trying to fetch results")
+            continue
+        for t in parse_response(r):
+            if t.ok:
+                key = normalize_keyword(t.task.keyword), Market(t.task.location_name, t.task.language_name)
+                for item in t.items:
+                    yield key, item.title or "", Offer.from_item(item)
+
+
+def split_markets(market_prices: Dict[Tuple[str, Market], List[Offer]]) -> Dict[Market, Dict[str, List[Offer]]]:
+    """ Returns the offers of each keyword and market grouped by market. """
+    by_market: Dict[Market, Dict[str, List[Offer]]] = dict()
+    for (keyword, market), offers in market_prices.items():
+        by_market.setdefault(market, dict())[keyword] = offers
+    return by_market
+
+
+def compare_markets(market_prices: Dict[Tuple[str, Market], List[Offer]]) -> Dict[str, List[Dict]]:
+    """ Summarizes the offers of each product in each market.
+
+    Args:
+        market_prices (Dict[Tuple[str, Market], List[Offer]]): The offers of each keyword and market.
+
+    Returns:
+        Dict[str, List[Dict]]: For each keyword, one row per market with the number of
+        offers, the minimum and median price and the currency, and "cheapest" set for the
+        market with the lowest price. Prices in different currencies are not compared.
+    """
+    rows: Dict[str, List[Dict]] = dict()
+    for (keyword, market), offers in market_prices.items():
+        prices = [o.price for o in offers if o.price is not None]
+        currencies = {o.currency for o in offers if o.currency}
+        rows.setdefault(keyword, []).append(dict(
+            market=market, offers=len(offers),
+            min_price=min(prices) if prices else None,
+            median_price=median(prices) if prices else None,
+            currency=currencies.pop() if len(currencies) == 1 else None,
+            cheapest=False))
+    for keyword_rows in rows.values():
+        by_currency: Dict[Optional[str], List[Dict]] = dict()
+        for row in keyword_rows:
+            if row["min_price"] is not None and row["currency"]:
+                by_currency.setdefault(row["currency"], []).append(row)
+        for same_currency in by_currency.values():
+            if len(same_currency) > 1:
+                min(same_currency, key=lambda row: row["min_price"])["cheapest"] = True
+    return rows
+
+
+def write_market_csv(comparison: Dict[str, List[Dict]], id_keyword: Dict[str, Tuple],
+                     file_name: str = MARKETS_OUTPUT_FILE) -> None:
+    """ Writes the result of compare_markets, one row per product and market.
+
+    Args:
+        comparison (Dict[str, List[Dict]]): The result of compare_markets.
+        id_keyword (Dict[str, Tuple]): Mapping of keywords to (ID, price, SKU), see task_post.read_xlsx.
+        file_name (str): The output file.
+    """
+    header = ['ID', 'Product Name', 'Current Price', 'Location', 'Language', 'Currency', 'Offers',
+              'Min Price', 'Median Price', 'Cheapest Market']
+    with open(file_name, 'w+', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for keyword, rows in comparison.items():
+            p_id, curr_price = id_keyword[keyword][:2] if keyword in id_keyword else ("", -1)
+            for row in sorted(rows, key=lambda row: row["market"]):
+                market = row["market"]
+                writer.writerow([p_id, keyword, curr_price, market.location_name, market.language_name,
+                                 row["currency"] or "", row["offers"], row["min_price"], row["median_price"],
+                                 "Y" if row["cheapest"] else ""])
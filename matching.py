@@ -0,0 +1,198 @@
+"""
+This module turns product titles into shopping keywords and checks whether the items
+returned for a keyword are the same product, so that unrelated offers (accessories,
+other models, ...) do not end up in the competitor prices.
+
+Example:
+    normalize_keyword("Abu Garcia Max X Spinning Reel - Clam Shell - MAXXSP40-C [1523255]")
+    # "Abu Garcia Max X Spinning Reel MAXXSP40-C"
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+import math
+import re
+
+
+# Offers scoring below this are treated as a different product
+MATCH_THRESHOLD = 0.6
+
+# Score of an offer whose title contains one of the model codes of the keyword
+CODE_MATCH_SCORE = 0.9
+
+# Trailing SKU in brackets, e.g. "[1523255]"
+SKU_PATTERN = re.compile(r"\s*\[([^\]]*)\]\s*$")
+
+# Packaging descriptions that do not help finding the product, quantities such as
+# "*Case of 12*" or "2-Pack" are kept (without the asterisks) since they change the price
+PACKAGING_PATTERN = re.compile(
+    r"\b(clam\s*shell|blister(\s*pack(ed)?)?|retail\s*pack(aging)?|boxed|bulk\s*pack(aged)?|"
+    r"bagged|polybag|display\s*box|carded)\b", re.IGNORECASE)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:\.[0-9]+)?")
+
+# Tokens with letters and digits that are units rather than model codes, e.g. "12v", "16oz"
+UNIT_PATTERN = re.compile(
+    r"^[0-9.]+(v|vdc|vac|a|ah|w|oz|lb|lbs|kg|g|mm|cm|m|in|ft|gal|l|ml|khz|mhz|ghz|hp|pk|pack|pc|x)$")
+
+# Words that say nothing about which product it is
+STOP_WORDS = frozenset(("a", "an", "and", "the", "for", "f", "w", "with", "of", "in", "on", "to", "by"))
+
+
+def sku(title: str) -> Optional[str]:
+    """ Returns the SKU in brackets at the end of a title, if there is one. """
+    match = SKU_PATTERN.search(title)
+    return match.group(1).strip() if match else None
+
+
+def normalize_keyword(title: str) -> str:
+    """ Builds the shopping keyword for a product title: removes the SKU in brackets,
+    packaging words, asterisks and the " - " separators.
+
+    Args:
+        title (str): The Title column of the product data.
+
+    Returns:
+        str: The keyword, or the stripped title if nothing would be left of it.
+    """
+    keyword = SKU_PATTERN.sub("", title)
+    keyword = PACKAGING_PATTERN.sub(" ", keyword)
+    keyword = keyword.replace("*", " ")
+    parts = [part.strip() for part in keyword.split(" - ")]
+    keyword = " ".join(" ".join(part for part in parts if part).split())
+    return keyword or title.strip()
+
+
+def tokens(text: str) -> List[str]:
+    """ Returns the distinct lower-case word tokens of a title, without stop words. """
+    seen: Dict[str, None] = dict()
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token not in STOP_WORDS:
+            seen[token] = None
+    return list(seen)
+
+
+def is_model_code(token: str) -> bool:
+    """ Returns True for tokens that look like model numbers, e.g. "dst810" or "maxxsp40". """
+    return (len(token) >= 4 and not token.isdigit() and not token.isalpha()
+            and UNIT_PATTERN.match(token) is None)
+
+
+def _squash(text: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", text.lower())
+
+
+class TitleMatcher:
+    """ Scores offer titles against product keywords.
+
+    The score of an offer is the IDF-weighted fraction of the keyword's tokens found in
+    the offer title, at least CODE_MATCH_SCORE if the title contains one of the model codes
+    of the keyword and 1 if it contains the product's SKU. Scoring works on
+    integer token ids in NumPy arrays, so all the offers of a run are scored at once.
+    If rapidfuzz is installed, scorer="rapidfuzz" uses its token_set_ratio instead.
+
+    Args:
+        keywords (Sequence[str]): The keywords of the catalog, used for the token weights.
+        skus (Optional[Dict[str, str]]): Keywords mapped to the SKU of their product.
+        threshold (float): Minimum score of a matching offer.
+        scorer (str): "tokens" or "rapidfuzz".
+    """
+
+    def __init__(self, keywords: Sequence[str], skus: Optional[Dict[str, str]] = None,
+                 threshold: float = MATCH_THRESHOLD, scorer: str = "tokens"):
+        self.threshold = threshold
+        self.scorer = scorer
+        self.skus = {k: _squash(v) for k, v in (skus or {}).items() if v and len(_squash(v)) >= 4}
+        self.vocabulary: Dict[str, int] = dict()
+        self._keyword_ids: Dict[str, List[int]] = dict()
+        document_frequency: Dict[int, int] = dict()
+        for keyword in keywords:
+            for token_id in self._token_ids(keyword):
+                document_frequency[token_id] = document_frequency.get(token_id, 0) + 1
+        self._n_documents = max(1, len(self._keyword_ids))
+        self._document_frequency = document_frequency
+
+    def _token_ids(self, keyword: str) -> List[int]:
+        ids = self._keyword_ids.get(keyword)
+        if ids is None:
+            ids = self._keyword_ids[keyword] = [self._token_id(t) for t in tokens(keyword)]
+        return ids
+
+    def _token_id(self, token: str) -> int:
+        token_id = self.vocabulary.get(token)
+        if token_id is None:
+            token_id = self.vocabulary[token] = len(self.vocabulary)
+        return token_id
+
+    def _weight(self, token_id: int) -> float:
+        # Smoothed IDF, tokens found in many products (brand names, "12V") count less
+        return math.log(1 + self._n_documents / self._document_frequency.get(token_id, 1))
+
+    def score_many(self, keywords: Sequence[str], titles: Sequence[str]):
+        """ Scores pairs of keywords and offer titles.
+
+        Args:
+            keywords (Sequence[str]): The keyword of each offer.
+            titles (Sequence[str]): The title of each offer.
+
+        Returns:
+            numpy.ndarray: The score of each offer, between 0 and 1.
+        """
+        if self.scorer == "rapidfuzz":
+            from rapidfuzz import fuzz, process
+            scores = process.cpdist(list(keywords), list(titles), scorer=fuzz.token_set_ratio,
+                                    workers=-1) / 100.0
+        else:
+            scores = self._token_scores(keywords, titles)
+        if self.skus:
+            for i, (keyword, title) in enumerate(zip(keywords, titles)):
+                code = self.skus.get(keyword)
+                if code and code in _squash(title):
+                    scores[i] = 1.0
+        return scores
+
+    def _token_scores(self, keywords: Sequence[str], titles: Sequence[str]):
+        import numpy as np
+        n = len(titles)
+        # One key per (keyword index, token id) so that all the memberships are checked at once
+        distinct: Dict[str, int] = dict()
+        keyword_index = np.fromiter((distinct.setdefault(k, len(distinct)) for k in keywords),
+                                    dtype=np.int64, count=n)
+        keyword_tokens: List[Tuple[int, int, float]] = [
+            (i, token_id, self._weight(token_id))
+            for keyword, i in distinct.items() for token_id in self._token_ids(keyword)]
+        names = list(self.vocabulary)
+        codes = np.array([is_model_code(names[token_id]) for _, token_id, _ in keyword_tokens], dtype=bool)
+        # Offer tokens that are not in the vocabulary cannot match, they get id -1
+        offer_rows: List[int] = list()
+        offer_ids: List[int] = list()
+        for row, title in enumerate(titles):
+            for token in tokens(title or ""):
+                offer_rows.append(row)
+                offer_ids.append(self.vocabulary.get(token, -1))
+        stride = len(self.vocabulary) + 1
+        total_weight = np.zeros(len(distinct))
+        if keyword_tokens:
+            kw_index, kw_ids, kw_weights = (np.array(c) for c in zip(*keyword_tokens))
+            np.add.at(total_weight, kw_index, kw_weights)
+            kw_keys = kw_index * stride + kw_ids
+            order = np.argsort(kw_keys)
+            kw_keys, kw_weights, codes = kw_keys[order], kw_weights[order], codes[order]
+        else:
+            kw_keys, kw_weights = np.zeros(0, dtype=np.int64), np.zeros(0)
+        rows = np.array(offer_rows, dtype=np.int64)
+        offer_keys = keyword_index[rows] * stride + np.array(offer_ids, dtype=np.int64)
+        found = np.isin(offer_keys, kw_keys) & (np.array(offer_ids, dtype=np.int64) >= 0)
+        weights = np.zeros(len(offer_keys))
+        code_found = np.zeros(len(offer_keys))
+        if found.any():
+            positions = np.searchsorted(kw_keys, offer_keys[found])
+            weights[found] = kw_weights[positions]
+            code_found[found] = codes[positions]
+        matched = np.bincount(rows, weights=weights, minlength=n)
+        has_code = np.bincount(rows, weights=code_found, minlength=n) > 0
+        totals = total_weight[keyword_index]
+        scores = np.divide(matched, totals, out=np.zeros(n), where=totals > 0)
+        return np.where(has_code, np.maximum(scores, CODE_MATCH_SCORE), scores)
+
+    def matches(self, keywords: Sequence[str], titles: Sequence[str]):
+        """ Returns a boolean array, True for the offers that are the same product. """
+        return self.score_many(keywords, titles) >= self.threshold
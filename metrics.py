@@ -0,0 +1,284 @@
+"""
+This module collects structured metrics from the RestClient and the pipeline stages in
+task_post.py (latency per endpoint, bytes in/out, status codes, task counts, API cost)
+and exposes them through pluggable hooks, e.g. a Prometheus text file, a JSON log or an
+OpenTelemetry-compatible callback.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple, IO
+import json
+import os
+import re
+import threading
+import time
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Task ids are uuid-like strings, e.g. 09100422-3160-0179-0000-009a2fdef23a
+TASK_ID_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def endpoint_name(path: str) -> str:
+    """ Reduces a request path to the endpoint it belongs to, so that
+    "/v3/merchant/google/products/task_get/advanced/<id>" and similar paths
+    are grouped under a single label.
+
+    Args:
+        path (str): The path of the request.
+
+    Returns:
+        str: The path without the query string, task id or ad_aclk token.
+    """
+    parts = path.split("?", 1)[0].rstrip("/").split("/")
+    if "ad_url" in parts:
+        parts = parts[:parts.index("ad_url") + 1]
+    elif parts and TASK_ID_PATTERN.match(parts[-1]):
+        parts = parts[:-1]
+    return "/".join(parts)
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Histogram:
+    """ A fixed-bucket histogram, cumulative in the same way as Prometheus histograms. """
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """ Returns the upper bound of the bucket containing the q-th quantile,
+        or 0 if nothing was observed yet.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    """ Thread-safe registry of counters, gauges and histograms.
+
+    Hooks receive every measurement as it happens through ``on_measurement`` (if they
+    define it) and the whole registry through ``export`` when ``flush`` is called.
+    """
+
+    def __init__(self, hooks: Optional[List[object]] = None):
+        self.hooks: List[object] = list(hooks or [])
+        self.counters: Dict[Tuple[str, Labels], float] = dict()
+        self.gauges: Dict[Tuple[str, Labels], float] = dict()
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = dict()
+        # A profiling.Profiler of the stages, only set by --profile
+        self.profiler = None
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook: object) -> None:
+        self.hooks.append(hook)
+
+    def _notify(self, kind: str, name: str, value: float, labels: Dict[str, object]) -> None:
+        for hook in self.hooks:
+            on_measurement = getattr(hook, "on_measurement", None)
+            if on_measurement is not None:
+                on_measurement(kind, name, value, labels)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        """ Adds value to the counter name with the given labels. """
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._notify("counter", name, value, labels)
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        """ Sets the gauge name with the given labels to value. """
+        with self._lock:
+            self.gauges[(name, _labels(labels))] = value
+        self._notify("gauge", name, value, labels)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """ Records value in the histogram name with the given labels. """
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+        self._notify("histogram", name, value, labels)
+
+    def record_request(self, path: str, method: str, http_status: int, latency: float,
+                       bytes_out: int, bytes_in: int, response: Optional[Dict] = None) -> None:
+        """ Records a single API call, used by RestClient.request.
+
+        Args:
+            path (str): The path of the request.
+            method (str): GET or POST.
+            http_status (int): The HTTP status of the response, 0 if there was no response.
+            latency (float): Time in seconds between sending the request and decoding the body.
+            bytes_out (int): Size of the request body.
+            bytes_in (int): Size of the response body.
+            response (Optional[Dict]): The decoded response, used for the API status code and cost.
+        """
+        endpoint = endpoint_name(path)
+        self.observe("request_latency_seconds", latency, endpoint=endpoint, method=method)
+        self.inc("request_bytes_out_total", bytes_out, endpoint=endpoint)
+        self.inc("request_bytes_in_total", bytes_in, endpoint=endpoint)
+        self.inc("http_status_total", endpoint=endpoint, code=http_status)
+        if response:
+            self.inc("api_status_total", endpoint=endpoint, code=response.get("status_code"))
+            cost = response.get("cost")
+            if cost:
+                self.inc("api_cost_total", cost, endpoint=endpoint)
+
+    def record_retry(self, path: str) -> None:
+        self.inc("request_retries_total", endpoint=endpoint_name(path))
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """ Times a pipeline stage, e.g. ``with metrics.stage("post"): ...`` """
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start_stage(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.stop_stage(name)
+            self.observe("stage_seconds", time.perf_counter() - start, stage=name)
+
+    def total(self, name: str, **labels) -> float:
+        """ Returns the sum of the counter name over all label sets matching labels. """
+        wanted = set(_labels(labels))
+        with self._lock:
+            return sum(v for (n, l), v in self.counters.items() if n == name and wanted <= set(l))
+
+    def snapshot(self) -> Dict[str, List[Dict]]:
+        """ Returns all metrics as plain JSON-serializable data. """
+        with self._lock:
+            return dict(
+                counters=[dict(name=n, labels=dict(l), value=v) for (n, l), v in self.counters.items()],
+                gauges=[dict(name=n, labels=dict(l), value=v) for (n, l), v in self.gauges.items()],
+                histograms=[dict(name=n, labels=dict(l), count=h.count, sum=h.sum,
+                                 buckets=dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts)))
+                            for (n, l), h in self.histograms.items()],
+            )
+
+    def flush(self) -> None:
+        """ Hands the registry to every hook that defines ``export``. """
+        for hook in self.hooks:
+            export = getattr(hook, "export", None)
+            if export is not None:
+                export(self)
+
+
+def _prom_labels(labels: Labels, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ""
+    return "{" + ",".join('%s="%s"' % (k, v.replace('"', '\\"')) for k, v in items) + "}"
+
+
+class PrometheusTextHook:
+    """ Writes the registry in the Prometheus text exposition format, e.g. for the
+    node_exporter textfile collector. The file is replaced atomically on every flush.
+    """
+
+    def __init__(self, file_name: str, prefix: str = "dataforseo_"):
+        self.file_name = file_name
+        self.prefix = prefix
+
+    def render(self, metrics: Metrics) -> str:
+        lines = list()
+        with metrics._lock:
+            counters = sorted(metrics.counters.items())
+            gauges = sorted(metrics.gauges.items())
+            histograms = sorted(metrics.histograms.items(), key=lambda kv: kv[0])
+        for kind, items in (("counter", counters), ("gauge", gauges)):
+            typed = set()
+            for (name, labels), value in items:
+                if name not in typed:
+                    lines.append(f"# TYPE {self.prefix}{name} {kind}")
+                    typed.add(name)
+                lines.append(f"{self.prefix}{name}{_prom_labels(labels)} {value}")
+        typed = set()
+        for (name, labels), h in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {self.prefix}{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, n in zip([str(b) for b in h.buckets] + ["+Inf"], h.counts):
+                cumulative += n
+                lines.append(f"{self.prefix}{name}_bucket{_prom_labels(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{self.prefix}{name}_sum{_prom_labels(labels)} {h.sum}")
+            lines.append(f"{self.prefix}{name}_count{_prom_labels(labels)} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, metrics: Metrics) -> None:
+        tmp_name = self.file_name + ".tmp"
+        with open(tmp_name, 'w', encoding="utf-8") as file:
+            file.write(self.render(metrics))
+        os.replace(tmp_name, self.file_name)
+
+
+class JsonLogHook:
+    """ Appends a JSON line with a snapshot of the registry on every flush and, if
+    events is set, one JSON line per measurement.
+    """
+
+    def __init__(self, file_name: Optional[str] = None, stream: Optional[IO[str]] = None,
+                 events: bool = False):
+        self.file_name = file_name
+        self.stream = stream
+        self.events = events
+        self._lock = threading.Lock()
+
+    def _write(self, record: Dict) -> None:
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            if self.stream is not None:
+                self.stream.write(line)
+            if self.file_name is not None:
+                with open(self.file_name, 'a+', encoding="utf-8") as file:
+                    file.write(line)
+
+    def on_measurement(self, kind: str, name: str, value: float, labels: Dict[str, object]) -> None:
+        if self.events:
+            self._write(dict(time=time.time(), kind=kind, name=name, value=value,
+                             labels={k: str(v) for k, v in labels.items()}))
+
+    def export(self, metrics: Metrics) -> None:
+        self._write(dict(time=time.time(), metrics=metrics.snapshot()))
+
+
+class CallbackHook:
+    """ Forwards every measurement to a callback with the signature
+    ``callback(kind, name, value, attributes)``. This maps directly onto OpenTelemetry
+    instruments, e.g. ``counter.add(value, attributes)`` for counters and
+    ``histogram.record(value, attributes)`` for histograms, without depending on the SDK.
+    """
+
+    def __init__(self, callback: Callable[[str, str, float, Dict[str, str]], None]):
+        self.callback = callback
+
+    def on_measurement(self, kind: str, name: str, value: float, labels: Dict[str, object]) -> None:
+        self.callback(kind, name, value, {k: str(v) for k, v in labels.items()})
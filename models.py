@@ -0,0 +1,147 @@
+"""
+This module has the compact models used instead of the raw response dicts. The
+constructors only copy the fields the pipeline uses, the rest of the payload (xpath,
+description, images, check_url, ...) is dropped when a response is parsed so that it can
+be freed right away.
+
+Example:
+    for result in parse_response(client.get("/v3/merchant/google/products/task_get/advanced/" + _id)):
+        for item in result.items:
+            print(item.title, item.price, item.currency)
+"""
+from typing import Dict, Iterator, List, Optional
+from urls import canonical_url
+
+
+SUCCESS_STATUS_CODE = 20000
+
+
+class Task:
+    """ The parameters of a products task, as posted with task_post.
+
+    Args:
+        keyword (str): The shopping keyword.
+        location_name (str): The location of the search, e.g. "Canada".
+        language_name (str): The language of the search, e.g. "English".
+        priority (Optional[int]): 1 (normal) or 2 (high).
+        sort_by (Optional[str]): The sort order, e.g. "price_low_to_high".
+        price_min (Optional[float]): Minimum price of the results.
+        tag (Optional[str]): User data returned with the results.
+    """
+
+    __slots__ = ("keyword", "location_name", "language_name", "priority", "sort_by", "price_min", "tag")
+
+    def __init__(self, keyword: str, location_name: str, language_name: str, priority: Optional[int] = None,
+                 sort_by: Optional[str] = None, price_min: Optional[float] = None, tag: Optional[str] = None):
+        self.keyword = keyword
+        self.location_name = location_name
+        self.language_name = language_name
+        self.priority = priority
+        self.sort_by = sort_by
+        self.price_min = price_min
+        self.tag = tag
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Task":
+        """ Creates the task from a task_post task or the "data" of a task_get task. """
+        return cls(data.get("keyword"), data.get("location_name"), data.get("language_name"),
+                   data.get("priority"), data.get("sort_by"), data.get("price_min"), data.get("tag"))
+
+    def as_dict(self) -> Dict:
+        """ Returns the task as posted with task_post, without the fields that are not set. """
+        return {name: getattr(self, name) for name in self.__slots__ if getattr(self, name) is not None}
+
+
+class ShoppingItem:
+    """ An item of the results of a products task. """
+
+    __slots__ = ("title", "price", "currency", "url", "domain", "seller", "rank", "product_id", "shop_ad_aclk")
+
+    def __init__(self, title: Optional[str], price: Optional[float], currency: Optional[str], url: Optional[str],
+                 domain: Optional[str], seller: Optional[str], rank: Optional[int],
+                 product_id: Optional[str] = None, shop_ad_aclk: Optional[str] = None):
+        self.title = title
+        self.price = price
+        self.currency = currency
+        self.url = url
+        self.domain = domain
+        self.seller = seller
+        self.rank = rank
+        self.product_id = product_id
+        self.shop_ad_aclk = shop_ad_aclk
+
+    @classmethod
+    def from_dict(cls, item: Dict) -> "ShoppingItem":
+        get = item.get
+        url = get("url")
+        # The URLs are canonical, the offers that are kept share them (see urls.share_url)
+        return cls(get("title"), get("price"), get("currency"), canonical_url(url) if url else None, get("domain"),
+                   get("seller"), get("rank_group"), get("product_id"), get("shop_ad_aclk"))
+
+
+class Offer:
+    """ A competitor price of a product, what the analysis keeps of a ShoppingItem. """
+
+    __slots__ = ("price", "currency", "url", "domain", "seller", "rank")
+
+    def __init__(self, price: Optional[float], url: Optional[str], currency: Optional[str] = None,
+                 domain: Optional[str] = None, seller: Optional[str] = None, rank: Optional[int] = None):
+        self.price = price
+        self.url = url
+        self.currency = currency
+        self.domain = domain
+        self.seller = seller
+        self.rank = rank
+
+    @classmethod
+    def from_item(cls, item: ShoppingItem) -> "Offer":
+        return cls(item.price, item.url, item.currency, item.domain, item.seller, item.rank)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Offer) and all(getattr(self, n) == getattr(other, n) for n in self.__slots__)
+
+    def __repr__(self) -> str:
+        return f"Offer({self.price!r}, {self.url!r})"
+
+
+class TaskResult:
+    """ A task of a task_get response.
+
+    Args:
+        id (str): The task id.
+        status_code (int): The status of the task, SUCCESS_STATUS_CODE if it has results.
+        status_message (str): The message of the status.
+        cost (float): The cost of the task.
+        task (Task): The parameters the task was posted with.
+        items (List[ShoppingItem]): The items of the results.
+    """
+
+    __slots__ = ("id", "status_code", "status_message", "cost", "task", "items")
+
+    def __init__(self, id: str, status_code: int, status_message: str, cost: float, task: Task,
+                 items: List[ShoppingItem]):
+        self.id = id
+        self.status_code = status_code
+        self.status_message = status_message
+        self.cost = cost
+        self.task = task
+        self.items = items
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code == SUCCESS_STATUS_CODE
+
+    @classmethod
+    def from_dict(cls, task: Dict) -> "TaskResult":
+        items = [ShoppingItem.from_dict(item) for data in task.get("result") or []
+                 for item in data.get("items") or []]
+        return cls(task.get("id"), task.get("status_code"), task.get("status_message"), task.get("cost") or 0,
+                   Task.from_dict(task.get("data") or {}), items)
+
+
+def parse_response(response: Dict) -> Iterator[TaskResult]:
+    """ Yields the tasks of a task_get response, nothing if the call failed. """
+    if response.get("status_code") != SUCCESS_STATUS_CODE:
+        return
+    for task in response.get("tasks") or []:
+        yield TaskResult.from_dict(task)
@@ -0,0 +1,281 @@
+"""
+This module chains the merchant endpoints of the DataForSEO API as a DAG. The products
+tasks created by task_post.set_task return Google Shopping items with a product_id,
+which are posted as sellers and product_info (or product_spec) tasks as soon as the
+products task is ready. All stages share the same thread pool, rate limiter and ledger,
+and every stage posts up to MAX_TASKS_PER_POST tasks per call.
+
+A run waits for its tasks until the deadline of the session or MAX_WAIT, the tasks that
+are still pending then are marked failed in the ledger. With a budget, each batch is
+admitted by it before it is posted (see budget.py), the batches above the hard cap are
+kept in deferred instead. The cli.py dag command runs it on the products of the data
+file and saves the deferred batches to DEFERRED_FILE.
+
+Example:
+    with ThreadPoolExecutor(8) as pool:
+        orchestrator = Orchestrator(connect(), Ledger(), pool)
+        orchestrator.run(products_tasks)
+"""
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from time import sleep
+from client import Deadline, RestClient
+from batching import Batch, pack_batches
+import batching
+from drain import Drainer
+from ledger import Ledger, FAILED
+
+
+SUCCESS_STATUS_CODE = 20000
+TASK_CREATED_CODE = 20100
+
+MERCHANT_API = "/v3/merchant/google/"
+
+# The finished tasks of every stage of the cli.py dag command
+DAG_RESULTS_FILE = "dag_results.json"
+
+# Seconds to wait between tasks_ready polls when no task was ready
+POLL_INTERVAL = 30
+
+# Seconds a run waits for its tasks, twice the turnaround of the normal priority (see scheduler.py)
+MAX_WAIT = 3600
+
+# Number of distinct product ids of a products task that are posted to the child stages
+MAX_CHILDREN = 5
+
+
+def product_ids(task: Dict, limit: int = MAX_CHILDREN) -> List[str]:
+    """ Returns the product ids of the items of a finished products task, in rank order.
+
+    Args:
+        task (Dict): A task from a products task_get response.
+        limit (int): The maximum number of product ids to return.
+    """
+    ids: List[str] = list()
+    for data in task.get("result") or []:
+        for item in data.get("items") or []:
+            pid = item.get("product_id")
+            if pid and pid not in ids:
+                ids.append(pid)
+                if len(ids) >= limit:
+                    return ids
+    return ids
+
+
+class Stage:
+    """ A merchant endpoint taking part in the DAG.
+
+    Args:
+        name (str): The endpoint name, e.g. "products" or "sellers".
+        children (Iterable[str]): Stages fed with the product ids of this stage's results.
+        max_children (int): Product ids per finished task that are passed to the children.
+    """
+
+    def __init__(self, name: str, children: Iterable[str] = (), max_children: int = MAX_CHILDREN):
+        self.name = name
+        self.children = tuple(children)
+        self.max_children = max_children
+        self.post_path = MERCHANT_API + name + "/task_post"
+        self.ready_path = MERCHANT_API + name + "/tasks_ready"
+        self.get_path = MERCHANT_API + name + "/task_get/advanced/"
+
+    def child_tasks(self, task: Dict) -> List[Dict]:
+        """ Builds the child tasks for a finished task of this stage, keeping the market,
+        priority and tag of the parent task.
+        """
+        data = task.get("data") or {}
+        children = list()
+        for pid in product_ids(task, self.max_children):
+            child = dict(
+                location_name=data.get("location_name"),
+                language_name=data.get("language_name"),
+                product_id=pid,
+            )
+            for key in ("priority", "tag"):
+                if data.get(key) is not None:
+                    child[key] = data[key]
+            children.append(child)
+        return children
+
+
+def default_stages() -> Dict[str, Stage]:
+    """ products -> product_id -> sellers / product_info """
+    return dict(
+        products=Stage("products", children=("sellers", "product_info")),
+        sellers=Stage("sellers"),
+        product_info=Stage("product_info"),
+        product_spec=Stage("product_spec"),
+    )
+
+
+class Orchestrator:
+    """ Posts tasks to the stages of the DAG, fetches them once they are ready and feeds
+    the results of a stage into its children.
+
+    Args:
+        client (RestClient): The client used for all calls, usually with a rate limiter.
+        ledger (Ledger): Records the posted and fetched tasks.
+        pool (ThreadPoolExecutor): Runs the POST and GET calls.
+        stages (Optional[Dict[str, Stage]]): The DAG, defaults to default_stages().
+        on_result (Optional[Callable[[str, Dict], None]]): Called with the stage name and each
+                                                           finished task, by default the tasks
+                                                           are collected in results.
+        poll_interval (float): Seconds to wait when no task was ready.
+        metrics (Optional[Metrics]): Registry for the task counters and queue depth.
+        deadline (Optional[Deadline]): The run stops waiting then, defaults to the deadline of client.
+        max_wait (Optional[float]): Seconds a run waits for its tasks, None to wait until the deadline.
+        budget (Optional[Budget]): Admits the batches before they are posted, see budget.py.
+    """
+
+    def __init__(self, client: RestClient, ledger: Ledger, pool: ThreadPoolExecutor,
+                 stages: Optional[Dict[str, Stage]] = None,
+                 on_result: Optional[Callable[[str, Dict], None]] = None,
+                 poll_interval: float = POLL_INTERVAL, metrics=None,
+                 deadline: Optional[Deadline] = None, max_wait: Optional[float] = MAX_WAIT, budget=None):
+        self.client = client
+        self.ledger = ledger
+        self.pool = pool
+        self.stages = stages or default_stages()
+        self.on_result = on_result or self._collect
+        self.poll_interval = poll_interval
+        self.metrics = metrics
+        self.deadline = deadline or client.deadline
+        self.max_wait = max_wait
+        self.budget = budget
+        # The batches that were not posted because of the hard cap of the budget
+        self.deferred: List[Batch] = list()
+        # The spend of a POST is known before the next batch is admitted
+        self._budget_lock = Lock()
+        self.results: Dict[str, List[Dict]] = {name: list() for name in self.stages}
+        self._buffers: Dict[str, List[Dict]] = {name: list() for name in self.stages}
+        self._posted_products: Dict[str, Set[Tuple]] = {name: set() for name in self.stages}
+        self._posts: List[Future] = list()
+        self.drainer = Drainer(client, ledger, pool, self.handle, endpoints=self.stages,
+                               only_known=True, metrics=metrics)
+
+    def _collect(self, stage: str, task: Dict) -> None:
+        self.results[stage].append(task)
+
+    def submit(self, stage: str, tasks: Iterable[Dict]) -> None:
+        """ Queues tasks for a stage and posts every full batch of MAX_TASKS_PER_POST. """
+        buffer = self._buffers[stage]
+        seen = self._posted_products[stage]
+        for task in tasks:
+            if "product_id" in task:
+                # The same product usually shows up for several keywords
+                key = (task["product_id"], task.get("location_name"), task.get("language_name"))
+                if key in seen:
+                    continue
+                seen.add(key)
+            buffer.append(task)
+            if len(buffer) >= batching.MAX_TASKS_PER_POST:
+                self._post_buffer(stage)
+                buffer = self._buffers[stage]
+
+    def flush(self) -> None:
+        """ Posts the partially filled batches and waits for all the POST calls. """
+        for stage, buffer in self._buffers.items():
+            if buffer:
+                self._post_buffer(stage)
+        posts, self._posts = self._posts, list()
+        wait(posts)
+        for post in posts:
+            post.result()
+
+    def _post_buffer(self, stage: str) -> None:
+        batches = pack_batches(self._buffers[stage], stage)
+        self._buffers[stage] = list()
+        for batch in batches:
+            self._posts.append(self.pool.submit(self._post, stage, batch))
+
+    def _post(self, stage: str, batch: Batch) -> None:
+        if self.budget is not None:
+            with self._budget_lock:
+                admitted = self.budget.admit(batch)
+                if admitted is None:
+                    print(f"{len(batch)} {stage} tasks would exceed the hard cap of the budget, deferred")
+                    self.deferred.append(batch)
+                    return
+                response = self.client.post(self.stages[stage].post_path, admitted.body)
+        else:
+            response = self.client.post(self.stages[stage].post_path, batch.body)
+        if response["status_code"] != SUCCESS_STATUS_CODE:
+            print(f"Error. Code: {response['status_code']} Message: {response['status_message']}")
+            return
+        for task in response["tasks"]:
+            if task["status_code"] == TASK_CREATED_CODE:
+                self.ledger.record_posted(task["id"], stage, (task.get("data") or {}).get("tag"),
+                                          task.get("cost") or 0)
+                if self.metrics is not None:
+                    self.metrics.inc("tasks_posted_total", endpoint=stage)
+            else:
+                print(f"Error. Code: {task['status_code']} Message: {task['status_message']}")
+
+    def handle(self, stage: str, task_id: str, response: Dict) -> None:
+        """ Passes the finished tasks of a task_get response to on_result and queues their
+        child tasks, the Drainer already recorded them in the ledger.
+        """
+        if response["status_code"] != SUCCESS_STATUS_CODE:
+            return
+        for task in response["tasks"]:
+            if task["status_code"] != SUCCESS_STATUS_CODE:
+                continue
+            self.on_result(stage, task)
+            for child in self.stages[stage].children:
+                self.submit(child, self.stages[stage].child_tasks(task))
+
+    def poll_once(self) -> int:
+        """ Fetches every ready task of every stage and posts the resulting child tasks.
+
+        Returns:
+            int: The number of fetched tasks.
+        """
+        fetched = self.drainer.drain()
+        self.flush()
+        return fetched
+
+    def run(self, tasks: Iterable[Dict], stage: str = "products") -> Dict[str, List[Dict]]:
+        """ Posts tasks to stage and runs the DAG until no task of this run is pending, or
+        until the deadline or max_wait, after which the pending tasks are marked failed.
+
+        Returns:
+            Dict[str, List[Dict]]: The finished tasks by stage (if on_result was not set).
+        """
+        deadlines = [d for d in (self.deadline, Deadline(self.max_wait) if self.max_wait is not None else None)
+                     if d is not None]
+        self.submit(stage, tasks)
+        self.flush()
+        while self.ledger.pending():
+            if any(d.expired() for d in deadlines):
+                print(f"{self.expire()} tasks were not ready in time, marked as failed")
+                break
+            if self.poll_once() == 0:
+                sleep(min([self.poll_interval] + [d.remaining() for d in deadlines]))
+        return self.results
+
+    def expire(self) -> int:
+        """ Marks the pending tasks of this run as failed.
+
+        Returns:
+            int: The number of tasks marked.
+        """
+        pending = self.ledger.pending()
+        for task_id in pending:
+            self.ledger.mark(task_id, FAILED)
+        if self.metrics is not None and pending:
+            self.metrics.inc("tasks_expired_total", len(pending))
+        return len(pending)
+
+
+def tag_tasks(data_list: List[Batch], id_keyword: Dict[str, Tuple]) -> List[Dict]:
+    """ Flattens the batches from task_post.set_task and tags each task with the product
+    ID, which is passed on to the child stages.
+    """
+    tasks = list()
+    for batch in data_list:
+        for task in batch.tasks:
+            if task["keyword"] in id_keyword:
+                task = dict(task, tag=str(id_keyword[task["keyword"]][0]))
+            tasks.append(task)
+    return tasks
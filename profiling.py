@@ -0,0 +1,276 @@
+"""
+This module profiles the pipeline stages (the ``with METRICS.stage(...)`` blocks of
+task_post.py and cli.py) when a run is started with --profile. For each stage it records:
+
+    wall time, CPU time and the rest of the wall time, spent waiting for the network,
+    the disk, locks or sleeps ("wait"),
+    the peak of the memory allocated by Python during the stage (tracemalloc, with
+    --profile-memory only: it slows down the code that allocates a lot several times),
+    the stacks of all the threads, sampled every SAMPLE_INTERVAL seconds, and
+    optionally a deterministic cProfile of the thread that runs the stage.
+
+The profiler writes these files to its directory when it is closed:
+
+    summary.txt             one page with the table of the stages and their hottest functions,
+    stacks.collapsed        the samples in the collapsed-stack format of flamegraph.pl
+                            ("stage;thread;frame;...;frame count"),
+    profile.speedscope.json the samples for https://www.speedscope.app, one profile per
+                            stage and thread,
+    <stage>.prof            the cProfile statistics of each stage, for pstats or snakeviz.
+
+Without --profile, Metrics.profiler is None and a stage only checks that attribute.
+
+Example:
+    profiler = Profiler("profile")
+    METRICS.profiler = profiler
+    try:
+        run_pipeline()
+    finally:
+        profiler.close()
+"""
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the context switches are not reported there
+    resource = None
+
+
+PROFILE_DIR = "profile"
+
+# Seconds between two samples of the stacks of the threads
+SAMPLE_INTERVAL = 0.005
+
+# Frames of a stack that are kept in a sample, the innermost ones
+MAX_STACK_DEPTH = 128
+
+# Functions listed per stage in the summary
+SUMMARY_TOP = 8
+
+# Frame: (file name, function name, first line)
+Frame = Tuple[str, str, int]
+
+
+def _frame_name(frame: Frame) -> str:
+    file_name, function, line = frame
+    return f"{function} ({os.path.basename(file_name)}:{line})"
+
+
+def _switches() -> int:
+    """ Returns the voluntary context switches of the process: each is a wait for I/O, a lock or a sleep. """
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_nvcsw
+
+
+class StageProfile:
+    """ What the profiler measured for all the runs of a stage. """
+
+    __slots__ = ("runs", "wall", "cpu", "switches", "peak_memory", "samples", "cprofile")
+
+    def __init__(self):
+        self.runs = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.switches = 0
+        self.peak_memory = 0
+        # Number of samples of each (thread name, stack)
+        self.samples: Counter = Counter()
+        self.cprofile: Optional[pstats.Stats] = None
+
+    @property
+    def wait(self) -> float:
+        # The CPU time of the threads running at the same time can exceed the wall time
+        return max(self.wall - self.cpu, 0.0)
+
+
+class Profiler:
+    """ Profiles the stages of a run, see the module docstring.
+
+    Args:
+        out_dir (str): Directory of the output files, created if needed.
+        interval (float): Seconds between two samples of the stacks.
+        memory (bool): Whether to trace the allocations for the peak memory of each stage,
+                       which slows down the code that allocates a lot, so the times are
+                       better measured without it.
+        deterministic (bool): Whether to also run cProfile in the thread of each stage.
+    """
+
+    def __init__(self, out_dir: str = PROFILE_DIR, interval: float = SAMPLE_INTERVAL, memory: bool = False,
+                 deterministic: bool = False):
+        self.out_dir = out_dir
+        self.interval = interval
+        self.memory = memory
+        self.deterministic = deterministic
+        self.stages: Dict[str, StageProfile] = dict()
+        self.n_samples = 0
+        self.started = time.time()
+        # Stages in progress, the samples go to the innermost one
+        self._active: List[Tuple[str, float, float, int, Optional[cProfile.Profile]]] = list()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler: Optional[threading.Thread] = None
+        self._cprofile_active = False
+
+    def _stage(self, name: str) -> StageProfile:
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = StageProfile()
+        return stage
+
+    def start_stage(self, name: str) -> None:
+        """ Called by Metrics.stage when a stage starts. """
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        profile = None
+        with self._lock:
+            if self.deterministic and not self._cprofile_active:
+                # cProfile can not profile the nested stages separately
+                profile = cProfile.Profile()
+                self._cprofile_active = True
+            if self.memory and not self._active:
+                tracemalloc.reset_peak()
+            self._active.append((name, time.perf_counter(), time.process_time(), _switches(), profile))
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_loop, name="profiler", daemon=True)
+                self._sampler.start()
+        if profile is not None:
+            profile.enable()
+
+    def stop_stage(self, name: str) -> None:
+        """ Called by Metrics.stage when a stage ends. """
+        wall_end, cpu_end, switches_end = time.perf_counter(), time.process_time(), _switches()
+        with self._lock:
+            i = max(i for i, active in enumerate(self._active) if active[0] == name)
+            _, wall_start, cpu_start, switches_start, profile = self._active.pop(i)
+            if profile is not None:
+                profile.disable()
+                self._cprofile_active = False
+            stage = self._stage(name)
+            stage.runs += 1
+            stage.wall += wall_end - wall_start
+            stage.cpu += cpu_end - cpu_start
+            stage.switches += switches_end - switches_start
+            if self.memory and tracemalloc.is_tracing():
+                # The peak since the outermost stage in progress started
+                stage.peak_memory = max(stage.peak_memory, tracemalloc.get_traced_memory()[1])
+            if profile is not None:
+                if stage.cprofile is None:
+                    stage.cprofile = pstats.Stats(profile)
+                else:
+                    stage.cprofile.add(profile)
+
+    def _sample_loop(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            with self._lock:
+                if not self._active:
+                    continue
+                stage = self._stage(self._active[-1][0])
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = list()
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_name, code.co_firstlineno))
+                    frame = frame.f_back
+                stack.reverse()
+                stage.samples[(names.get(ident, str(ident)), tuple(stack))] += 1
+            self.n_samples += 1
+
+    def close(self) -> str:
+        """ Stops the sampling and writes the output files.
+
+        Returns:
+            str: The file name of the summary.
+        """
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        os.makedirs(self.out_dir, exist_ok=True)
+        self.write_collapsed(os.path.join(self.out_dir, "stacks.collapsed"))
+        self.write_speedscope(os.path.join(self.out_dir, "profile.speedscope.json"))
+        for name, stage in self.stages.items():
+            if stage.cprofile is not None:
+                stage.cprofile.dump_stats(os.path.join(self.out_dir, f"{name}.prof"))
+        summary_file = os.path.join(self.out_dir, "summary.txt")
+        with open(summary_file, 'w', encoding="utf-8") as file:
+            file.write(self.summary())
+        return summary_file
+
+    def write_collapsed(self, file_name: str) -> None:
+        with open(file_name, 'w', encoding="utf-8") as file:
+            for name, stage in self.stages.items():
+                for (thread, stack), count in stage.samples.items():
+                    frames = ";".join(_frame_name(frame).replace(";", ":") for frame in stack)
+                    file.write(f"{name};{thread};{frames} {count}\n")
+
+    def write_speedscope(self, file_name: str) -> None:
+        frames: List[Dict] = list()
+        frame_ids: Dict[Frame, int] = dict()
+        profiles = list()
+        for name, stage in self.stages.items():
+            by_thread: Dict[str, Tuple[List[List[int]], List[float]]] = dict()
+            for (thread, stack), count in stage.samples.items():
+                samples, weights = by_thread.setdefault(thread, ([], []))
+                ids = list()
+                for frame in stack:
+                    i = frame_ids.get(frame)
+                    if i is None:
+                        i = frame_ids[frame] = len(frames)
+                        frames.append(dict(name=frame[1], file=frame[0], line=frame[2]))
+                    ids.append(i)
+                samples.append(ids)
+                weights.append(count * self.interval)
+            for thread, (samples, weights) in by_thread.items():
+                profiles.append(dict(type="sampled", name=f"{name} - {thread}", unit="seconds", startValue=0,
+                                     endValue=sum(weights), samples=samples, weights=weights))
+        document = {"$schema": "https://www.speedscope.app/file-format-schema.json",
+                    "shared": dict(frames=frames), "profiles": profiles, "name": "dataforseo pipeline",
+                    "activeProfileIndex": 0, "exporter": "profiling.py"}
+        with open(file_name, 'w', encoding="utf-8") as file:
+            json.dump(document, file)
+
+    def summary(self) -> str:
+        """ Returns the one-page summary of the run. """
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started))
+        lines = [f"Profile of {' '.join(sys.argv) or 'python'}, started {started}",
+                 f"{self.n_samples} samples every {self.interval * 1000:g} ms", "",
+                 f"{'Stage':<14} {'Runs':>5} {'Wall s':>9} {'CPU s':>9} {'Wait s':>9} {'CPU %':>6} "
+                 f"{'Peak MB':>8} {'Waits':>8}"]
+        for name, stage in self.stages.items():
+            cpu_share = 100 * stage.cpu / stage.wall if stage.wall else 0.0
+            peak = f"{stage.peak_memory / 2 ** 20:8.1f}" if self.memory else f"{'-':>8}"
+            lines.append(f"{name:<14} {stage.runs:>5} {stage.wall:>9.3f} {stage.cpu:>9.3f} {stage.wait:>9.3f} "
+                         f"{cpu_share:>5.0f}% {peak} {stage.switches:>8}")
+        lines.append("")
+        lines.append("Wait is the wall time not spent on a CPU (network, disk, locks, sleeps), Waits counts the")
+        lines.append("voluntary context switches. Peak MB is the peak of the memory allocated by Python.")
+        for name, stage in self.stages.items():
+            # Samples whose innermost frame is the function, over all the threads
+            own: Counter = Counter()
+            for (_, stack), count in stage.samples.items():
+                if stack:
+                    own[stack[-1]] += count
+            total = sum(own.values())
+            if not total:
+                continue
+            lines.append("")
+            lines.append(f"{name}: hottest functions, all threads ({total} samples)")
+            for frame, count in own.most_common(SUMMARY_TOP):
+                lines.append(f"  {100 * count / total:5.1f}%  {_frame_name(frame)}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,232 @@
+"""
+This module renders the price distribution of the competitor offers of every product
+into a static bundle (one PNG per product and an index.html), without a display.
+
+The densities of all the products are computed in one NumPy pass: the prices are
+compared on a common log-price grid with a Gaussian kernel whose bandwidth is chosen
+per product (Silverman's rule on the log prices). The charts are drawn in a process pool
+with matplotlib's Agg backend, and the products whose offers are the same as in the last
+report (see MANIFEST_FILE) are not drawn again.
+
+Example:
+    build_report(analyze_results(iter_results_json()), id_keyword, "report", workers=4)
+"""
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+from typing import Dict, List, Optional, Sequence, Tuple
+import hashlib
+import json
+import os
+
+from models import Offer
+
+
+REPORT_DIR = "report"
+
+# Remembers the offers each chart was drawn from, by product
+MANIFEST_FILE = "manifest.json"
+
+# Number of points of the price grid
+GRID_POINTS = 512
+
+# Smallest bandwidth (in log-price), e.g. for products whose prices are all the same
+MIN_BANDWIDTH = 0.05
+
+# Each chart only shows the part of the grid where the density is above this fraction of its maximum
+CHART_CUTOFF = 1e-3
+
+# Rows of the (offers x grid points) kernel matrix computed at a time
+KERNEL_CHUNK_ROWS = 4096
+
+# Charts drawn per task of the process pool
+RENDER_CHUNK_SIZE = 32
+
+
+def offer_prices(offers: Sequence[Offer]) -> List[float]:
+    return [float(o.price) for o in offers if isinstance(o.price, (int, float)) and o.price > 0]
+
+
+def price_grid(price_lists: Sequence[Sequence[float]], n_points: int = GRID_POINTS):
+    """ Returns the common grid of log prices, from the lowest to the highest price of all the products. """
+    import numpy as np
+    prices = [p for prices in price_lists for p in prices]
+    if not prices:
+        return np.zeros(0)
+    low, high = np.log(min(prices)), np.log(max(prices))
+    # Some room for the tails of the kernels
+    margin = max(0.1, (high - low) * 0.05)
+    return np.linspace(low - margin, high + margin, n_points)
+
+
+def kde_matrix(price_lists: Sequence[Sequence[float]], grid):
+    """ Computes the density of the log prices of every product on grid at once.
+
+    Args:
+        price_lists (Sequence[Sequence[float]]): The prices of each product.
+        grid (numpy.ndarray): The log prices, see price_grid.
+
+    Returns:
+        numpy.ndarray: One row per product with its density at each grid point, rows of
+        products without prices are 0.
+    """
+    import numpy as np
+    n_products = len(price_lists)
+    densities = np.zeros((n_products, len(grid)))
+    counts = np.array([len(prices) for prices in price_lists], dtype=np.int64)
+    if not counts.sum() or not len(grid):
+        return densities
+    values = np.log(np.fromiter((p for prices in price_lists for p in prices), dtype=float, count=counts.sum()))
+    owner = np.repeat(np.arange(n_products), counts)
+    # Silverman's rule of thumb per product
+    sums = np.bincount(owner, weights=values, minlength=n_products)
+    squares = np.bincount(owner, weights=values * values, minlength=n_products)
+    safe_counts = np.maximum(counts, 1)
+    std = np.sqrt(np.maximum(squares / safe_counts - (sums / safe_counts) ** 2, 0))
+    bandwidth = np.maximum(1.06 * std * safe_counts ** -0.2, MIN_BANDWIDTH)
+    row_bandwidth = bandwidth[owner]
+    norm = 1.0 / (safe_counts[owner] * row_bandwidth * np.sqrt(2 * np.pi))
+    for start in range(0, len(values), KERNEL_CHUNK_ROWS):
+        end = min(start + KERNEL_CHUNK_ROWS, len(values))
+        z = (grid[None, :] - values[start:end, None]) / row_bandwidth[start:end, None]
+        kernels = np.exp(-0.5 * z * z) * norm[start:end, None]
+        # The offers are grouped by product, add up the rows of each product in the chunk
+        chunk_owner = owner[start:end]
+        boundaries = np.flatnonzero(np.r_[True, chunk_owner[1:] != chunk_owner[:-1]])
+        densities[chunk_owner[boundaries]] += np.add.reduceat(kernels, boundaries, axis=0)
+    return densities
+
+
+def offers_hash(offers: Sequence[Offer], current_price=None) -> str:
+    """ Returns a hash of what a chart shows, to know if it needs to be drawn again. """
+    digest = hashlib.sha1(repr(current_price).encode("utf-8"))
+    for price, url in sorted((repr(o.price), o.url or "") for o in offers):
+        digest.update(price.encode("utf-8"))
+        digest.update(url.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def chart_name(keyword: str, product_id=None) -> str:
+    if product_id not in (None, ""):
+        return f"{product_id}.png"
+    return hashlib.sha1(keyword.encode("utf-8")).hexdigest()[:16] + ".png"
+
+
+def render_charts(charts: List[Tuple]) -> List[str]:
+    """ Draws the charts of a chunk, runs in the worker processes.
+
+    Args:
+        charts (List[Tuple]): (file name, title, grid prices, density, prices, current price) of each chart.
+
+    Returns:
+        List[str]: The files written.
+    """
+    try:
+        import matplotlib
+    except ImportError:
+        raise ImportError("matplotlib is needed for the report, install it with: pip install matplotlib")
+    # No display is needed
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    written = list()
+    fig, ax = plt.subplots(figsize=(6, 3))
+    for file_name, title, grid_prices, density, prices, current_price in charts:
+        ax.clear()
+        ax.plot(grid_prices, density, color="tab:blue")
+        ax.fill_between(grid_prices, density, alpha=0.2, color="tab:blue")
+        ax.plot(prices, [0] * len(prices), "|", color="black", markersize=10)
+        if current_price is not None:
+            ax.axvline(current_price, color="tab:red", linestyle="--", label="Current price")
+            ax.legend(loc="upper right", fontsize=8)
+        ax.set_xscale("log")
+        ax.set_title(title[:80], fontsize=9)
+        ax.set_xlabel("Price")
+        ax.set_yticks([])
+        fig.tight_layout()
+        fig.savefig(file_name, dpi=80)
+        written.append(file_name)
+    plt.close(fig)
+    return written
+
+
+def _write_index(out_dir: str, rows: List[Tuple[str, str, Dict]]) -> None:
+    with open(os.path.join(out_dir, "index.html"), 'w', encoding="utf-8") as file:
+        file.write("<!DOCTYPE html>\n<html><head><meta charset=\"utf-8\"><title>Competitor prices</title>"
+                   "</head><body>\n<h1>Competitor prices</h1>\n")
+        for keyword, image, stats in rows:
+            file.write(f"<div><h3>{escape(keyword)}</h3>"
+                       f"<p>{stats['offers']} offers, min {stats['min']}, median {stats['median']}, "
+                       f"current {stats['current']}</p>")
+            if image:
+                file.write(f"<img src=\"{escape(image)}\" loading=\"lazy\">")
+            file.write("</div>\n")
+        file.write("</body></html>\n")
+
+
+def build_report(price_dict: Dict[str, List[Offer]], id_keyword: Dict[str, Tuple], out_dir: str = REPORT_DIR,
+                 workers: Optional[int] = None, force: bool = False) -> int:
+    """ Writes the charts of the products and the index.html to out_dir.
+
+    Args:
+        price_dict (Dict[str, List[Offer]]): The offers of each keyword, see task_post.analyze_results.
+        id_keyword (Dict[str, Tuple]): Mapping of keywords to (ID, price, SKU), see task_post.read_xlsx.
+        out_dir (str): The directory of the report.
+        workers (Optional[int]): Number of processes drawing the charts, all the CPUs if it is None.
+        force (bool): Draws all the charts, even the ones that did not change.
+
+    Returns:
+        int: The number of charts drawn.
+    """
+    import numpy as np
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_file = os.path.join(out_dir, MANIFEST_FILE)
+    manifest: Dict[str, str] = dict()
+    if not force and os.path.isfile(manifest_file):
+        with open(manifest_file, 'r', encoding="utf-8") as file:
+            manifest = json.load(file)
+
+    keywords = list(price_dict)
+    price_lists = [offer_prices(price_dict[k]) for k in keywords]
+    rows: List[Tuple[str, str, Dict]] = list()
+    changed: List[int] = list()
+    new_manifest: Dict[str, str] = dict()
+    for i, keyword in enumerate(keywords):
+        product = id_keyword.get(keyword)
+        current_price = float(product[1]) if product is not None else None
+        image = chart_name(keyword, product[0] if product is not None else None) if price_lists[i] else ""
+        prices = price_lists[i]
+        rows.append((keyword, image, dict(
+            offers=len(price_dict[keyword]),
+            min=min(prices) if prices else "-",
+            median=float(np.median(prices)) if prices else "-",
+            current=current_price if current_price is not None else "-")))
+        if image:
+            new_manifest[image] = offers_hash(price_dict[keyword], current_price)
+            if manifest.get(image) != new_manifest[image] or not os.path.isfile(os.path.join(out_dir, image)):
+                changed.append(i)
+
+    if changed:
+        # The densities are only needed for the charts that are drawn
+        changed_prices = [price_lists[i] for i in changed]
+        grid = price_grid(changed_prices)
+        densities = kde_matrix(changed_prices, grid)
+        grid_prices = np.exp(grid)
+        charts = list()
+        for row, i in enumerate(changed):
+            keyword, image, stats = rows[i]
+            current = stats["current"] if stats["current"] != "-" else None
+            visible = np.flatnonzero(densities[row] > densities[row].max() * CHART_CUTOFF)
+            view = slice(visible[0], visible[-1] + 1)
+            charts.append((os.path.join(out_dir, image), keyword, grid_prices[view], densities[row][view],
+                           price_lists[i], current))
+        chunks = [charts[n:n + RENDER_CHUNK_SIZE] for n in range(0, len(charts), RENDER_CHUNK_SIZE)]
+        if workers == 1 or len(chunks) == 1:
+            for chunk in chunks:
+                render_charts(chunk)
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                list(pool.map(render_charts, chunks))
+
+    _write_index(out_dir, rows)
+    with open(manifest_file, 'w', encoding="utf-8") as file:
+        json.dump(new_manifest, file)
+    return len(changed)
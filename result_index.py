@@ -0,0 +1,273 @@
+"""
+This module keeps a sidecar index of a results file (see task_post.write_results_json),
+so that the response of one task is read and decoded on its own instead of decoding the
+whole file, e.g. to debug a product, to analyze a few products again or to check whether
+a task was already fetched.
+
+The index maps the id and the keyword of every task of the file, and the ID of its
+product in the data file if it is known, to the byte offset and length of its response. It is an open-addressing hash table of fixed-size slots in the
+file INDEX_SUFFIX next to the results, which is read through mmap: a lookup hashes the
+key (see snapshot.hash64) and reads a few slots, whatever the size of the results.
+
+The index is written along with the results by write_results_json and tee_results_json,
+and completed by task_ready.py, which appends the results it drains. A results file
+written without it, or only partly indexed (e.g. after a crash), is
+indexed when it is opened, from where the index stops.
+
+Example:
+    with ResultIndex(RESULTS_FILE) as index:
+        response = index.get("09100422-3160-0179-0000-009a2fdef23a")
+        responses = index.by_keyword("Abu Garcia Max X Spinning Reel MAXXSP40-C")
+        responses = index.by_product(6907587002565)
+"""
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import json
+import mmap
+import os
+import re
+import struct
+
+from matching import normalize_keyword
+from snapshot import hash64
+
+
+INDEX_SUFFIX = ".idx"
+
+# magic, version, number of slots, number of entries, bytes of the results file indexed
+HEADER = struct.Struct("<4sIQQQ")
+MAGIC = b"RIDX"
+VERSION = 1
+
+# hash of the key (0 for an empty slot), offset and length of the response
+SLOT = struct.Struct("<QQQ")
+
+# Slots per entry, at most half of the slots are used so the probes stay short
+LOAD_FACTOR = 2
+
+# write_results_json writes the documents with indent=4, see decoding.DOCUMENT_END
+DOCUMENT_END = re.compile(rb"^}", re.MULTILINE)
+
+# (key hash, offset, length)
+Entry = Tuple[int, int, int]
+
+
+def index_name(results_file: str) -> str:
+    return results_file + INDEX_SUFFIX
+
+
+def key_hash(kind: str, key: str) -> int:
+    """ Returns the hash of a task id ("task"), a keyword ("keyword") or a product ID ("product")
+    in the index, never 0.
+    """
+    return hash64(f"{kind}:{key}") or 1
+
+
+def result_entries(result: Dict, offset: int, length: int,
+                   id_keyword: Optional[Dict[str, Tuple]] = None) -> List[Entry]:
+    """ Returns the index entries of a response stored at offset.
+
+    Args:
+        result (Dict): The response.
+        offset (int): Its offset in the results file.
+        length (int): Its size in bytes.
+        id_keyword (Optional[Dict[str, Tuple]]): Mapping of keywords to (ID, price, ...), see
+                                                 task_post.read_xlsx, for the product entries.
+    """
+    entries = list()
+    for task in result.get("tasks") or []:
+        if task.get("id"):
+            entries.append((key_hash("task", task["id"]), offset, length))
+        keyword = (task.get("data") or {}).get("keyword")
+        if keyword:
+            keyword = normalize_keyword(keyword)
+            entries.append((key_hash("keyword", keyword), offset, length))
+            product = id_keyword.get(keyword) if id_keyword else None
+            if product is not None:
+                entries.append((key_hash("product", str(product[0])), offset, length))
+    return entries
+
+
+def write_index(index_file: str, entries: List[Entry], size: int) -> None:
+    """ Writes the hash table of entries, for a results file whose first size bytes are indexed. """
+    capacity = 8
+    while capacity < LOAD_FACTOR * len(entries):
+        capacity *= 2
+    mask = capacity - 1
+    table = bytearray(HEADER.size + capacity * SLOT.size)
+    HEADER.pack_into(table, 0, MAGIC, VERSION, capacity, len(entries), size)
+    used = bytearray(capacity)
+    for h, offset, length in entries:
+        i = h & mask
+        while used[i]:
+            i = (i + 1) & mask
+        used[i] = 1
+        SLOT.pack_into(table, HEADER.size + i * SLOT.size, h, offset, length)
+    tmp_name = index_file + ".tmp"
+    with open(tmp_name, 'wb') as file:
+        file.write(table)
+    os.replace(tmp_name, index_file)
+
+
+class IndexWriter:
+    """ Collects the entries of the responses as they are written to a results file.
+
+    Args:
+        results_file (str): The results file, written from the start.
+        id_keyword (Optional[Dict[str, Tuple]]): See result_entries.
+    """
+
+    def __init__(self, results_file: str, id_keyword: Optional[Dict[str, Tuple]] = None):
+        self.index_file = index_name(results_file)
+        self.id_keyword = id_keyword
+        self.entries: List[Entry] = list()
+        self.size = 0
+        # The index of the previous results would point into the new ones
+        if os.path.exists(self.index_file):
+            os.remove(self.index_file)
+
+    def add(self, result: Dict, length: int) -> None:
+        """ Adds a response written right after the previous one, length is its size in bytes. """
+        self.entries.extend(result_entries(result, self.size, length, self.id_keyword))
+        self.size += length
+
+    def close(self) -> None:
+        write_index(self.index_file, self.entries, self.size)
+
+
+class ResultIndex:
+    """ Random access to the responses of a results file, see the module docstring.
+
+    Args:
+        results_file (str): The results file.
+        index_file (Optional[str]): The index, defaults to index_name(results_file). It is
+                                    created or completed if it does not cover the whole file.
+        id_keyword (Optional[Dict[str, Tuple]]): See result_entries, for the responses that
+                                                 are indexed when the index is completed.
+    """
+
+    def __init__(self, results_file: str, index_file: Optional[str] = None,
+                 id_keyword: Optional[Dict[str, Tuple]] = None):
+        self.results_file = results_file
+        self.index_file = index_file or index_name(results_file)
+        self.id_keyword = id_keyword
+        self.update()
+        self._results = open(results_file, 'rb')
+        self._index = open(self.index_file, 'rb')
+        size = os.fstat(self._results.fileno()).st_size
+        # An empty file can not be mapped
+        self.results = mmap.mmap(self._results.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.index = mmap.mmap(self._index.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, self.capacity, self.count, _ = HEADER.unpack_from(self.index, 0)
+
+    def _header(self) -> Optional[Tuple]:
+        if not os.path.isfile(self.index_file):
+            return None
+        with open(self.index_file, 'rb') as file:
+            header = file.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        values = HEADER.unpack(header)
+        return values if values[:2] == (MAGIC, VERSION) else None
+
+    def update(self) -> int:
+        """ Indexes the responses of the results file that are not indexed yet.
+
+        Returns:
+            int: The number of responses that were indexed.
+        """
+        size = os.path.getsize(self.results_file)
+        header = self._header()
+        if header is not None and header[4] == size:
+            return 0
+        entries: List[Entry] = list()
+        start = 0
+        if header is not None and header[4] < size:
+            # The results were appended to since they were indexed
+            entries = list(self._entries())
+            start = header[4]
+        n_results = 0
+        if size > start:
+            with open(self.results_file, 'rb') as file, \
+                    mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as results:
+                for match in DOCUMENT_END.finditer(results, start):
+                    end = match.end()
+                    entries.extend(result_entries(json.loads(results[start:end]), start, end - start,
+                                                  self.id_keyword))
+                    n_results += 1
+                    start = end
+        # A response that is still being written is indexed by the next update
+        write_index(self.index_file, entries, start)
+        return n_results
+
+    def _entries(self) -> Iterator[Entry]:
+        with open(self.index_file, 'rb') as file:
+            table = file.read()
+        capacity = HEADER.unpack_from(table, 0)[2]
+        for i in range(capacity):
+            entry = SLOT.unpack_from(table, HEADER.size + i * SLOT.size)
+            if entry[0]:
+                yield entry
+
+    def offsets(self, kind: str, key: str) -> List[Tuple[int, int]]:
+        """ Returns the (offset, length) of the responses of a key, see key_hash. """
+        h = key_hash(kind, key)
+        mask = self.capacity - 1
+        i = h & mask
+        found = list()
+        while True:
+            slot_hash, offset, length = SLOT.unpack_from(self.index, HEADER.size + i * SLOT.size)
+            if not slot_hash:
+                return found
+            if slot_hash == h and (offset, length) not in found:
+                found.append((offset, length))
+            i = (i + 1) & mask
+
+    def read(self, offset: int, length: int) -> Dict:
+        return json.loads(self.results[offset:offset + length])
+
+    def contains(self, task_id: str) -> bool:
+        """ Returns whether the response of task_id is in the results file, without reading it. """
+        return bool(self.offsets("task", task_id))
+
+    def get(self, task_id: str) -> Optional[Dict]:
+        """ Returns the response of task_id, None if it is not in the results file. """
+        found = self.offsets("task", task_id)
+        return self.read(*found[-1]) if found else None
+
+    def by_keyword(self, keyword: str) -> List[Dict]:
+        """ Returns the responses of the tasks of keyword, in the order they were written. """
+        return [self.read(*found) for found in sorted(self.offsets("keyword", normalize_keyword(keyword)))]
+
+    def by_product(self, product_id, id_keyword: Optional[Dict[str, Tuple]] = None) -> List[Dict]:
+        """ Returns the responses of a product of the data file, in the order they were written.
+
+        Args:
+            product_id: The ID of the product in the data file.
+            id_keyword (Optional[Dict[str, Tuple]]): Mapping of keywords to (ID, price, ...), see
+                                                     task_post.read_xlsx. Finds the product through
+                                                     its keywords if the responses were indexed
+                                                     without it.
+        """
+        found = self.offsets("product", str(product_id))
+        if found or not id_keyword:
+            return [self.read(*offset) for offset in sorted(found)]
+        keywords = [keyword for keyword, product in id_keyword.items() if str(product[0]) == str(product_id)]
+        return [result for keyword in keywords for result in self.by_keyword(keyword)]
+
+    def responses(self, keywords: Iterable[str]) -> Iterator[Dict]:
+        """ Yields the responses of keywords, e.g. to analyze a few products again with analyze_results. """
+        for keyword in keywords:
+            yield from self.by_keyword(keyword)
+
+    def close(self) -> None:
+        if isinstance(self.results, mmap.mmap):
+            self.results.close()
+        self.index.close()
+        self._results.close()
+        self._index.close()
+
+    def __enter__(self) -> "ResultIndex":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
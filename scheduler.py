@@ -0,0 +1,243 @@
+"""
+This module assigns a priority to each product task instead of the fixed priority in
+PARAMETERS, paces the POST requests so that the tasks finish before a deadline at the
+lowest cost, and compares the projected cost and latency of a run to the actual ones.
+
+Priority 1 (normal) tasks cost half of priority 2 (high) tasks but take longer to finish,
+so the scheduler only uses high priority for products matching one of the rules, or for
+all products if normal priority cannot meet the deadline. The rules and the deadline are
+configured in the "scheduler" table of the config file, see scheduler_from_config.
+"""
+from typing import Callable, Dict, List, Optional, Set
+import csv
+import os
+import time
+
+
+NORMAL_PRIORITY = 1
+HIGH_PRIORITY = 2
+
+# Cost (USD) of a single merchant products task by priority, as reported in the
+# "cost" field of the task_post responses
+TASK_COST = {NORMAL_PRIORITY: 0.001, HIGH_PRIORITY: 0.002}
+
+# Expected time (seconds) between posting a task and it showing up as ready
+TASK_TURNAROUND = {NORMAL_PRIORITY: 1800, HIGH_PRIORITY: 360}
+
+# Minimum time between two POST requests, the API allows 2000 calls per minute
+MIN_POST_DELAY = 0.05
+
+# Fraction of the time left before the deadline used for spreading the POST requests,
+# the rest is kept as a margin for slow tasks
+PACING_MARGIN = 0.8
+
+# A rule takes a product record (as returned by read_xlsx) and returns True if
+# the product should be posted with high priority
+PriorityRule = Callable[[Dict], bool]
+
+
+def ids_rule(ids: Set[int]) -> PriorityRule:
+    """ Matches the products whose ID is in ids, e.g. a list of top sellers. """
+    ids = {int(i) for i in ids}
+    return lambda product: int(product["ID"]) in ids
+
+
+def tag_rule(tag: str) -> PriorityRule:
+    """ Matches the products with the given Shopify tag, e.g. "Best Seller". """
+    tag = tag.strip().lower()
+    return lambda product: tag in [t.strip().lower() for t in str(product.get("Tags", "")).split(",")]
+
+
+def threshold_rule(column: str, minimum: float) -> PriorityRule:
+    """ Matches the products where the numeric column is at least minimum,
+    e.g. threshold_rule("Variant Inventory Qty", 50).
+    """
+    def rule(product: Dict) -> bool:
+        try:
+            return float(product[column]) >= minimum
+        except (KeyError, TypeError, ValueError):
+            return False
+    return rule
+
+
+def price_changed_rule(previous_prices: Dict[int, float], tolerance: float = 0.01) -> PriorityRule:
+    """ Matches the products whose Variant Price changed since the previous run.
+
+    Args:
+        previous_prices (Dict[int, float]): Product IDs mapped to the price of the last run,
+                                            see load_previous_prices.
+        tolerance (float): Changes smaller than this are ignored.
+    """
+    def rule(product: Dict) -> bool:
+        previous = previous_prices.get(int(product["ID"]))
+        return previous is not None and abs(float(product["Variant Price"]) - previous) > tolerance
+    return rule
+
+
+def load_previous_prices(file_name: str) -> Dict[int, float]:
+    """ Reads the ID and Current Price columns of a previous output csv file.
+
+    Args:
+        file_name (str): The output file of a previous run, e.g. results.csv
+
+    Returns:
+        Dict[int, float]: Mapping of product IDs to prices, empty if the file does not exist.
+    """
+    prices: Dict[int, float] = dict()
+    if not os.path.isfile(file_name):
+        return prices
+    with open(file_name, 'r', encoding="utf-8", newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        for row in reader:
+            try:
+                prices[int(row[0])] = float(row[2])
+            except (IndexError, ValueError):
+                continue
+    return prices
+
+
+class Scheduler:
+    """ Assigns priorities to product tasks and paces their submission.
+
+    Args:
+        rules (List[PriorityRule]): Products matching any rule get high priority.
+        deadline (Optional[float]): Unix time by which all tasks should be ready,
+                                    None for no deadline.
+        task_cost (Dict[int, float]): Cost of a task by priority.
+        turnaround (Dict[int, float]): Expected time until a task is ready by priority.
+        priority (Optional[int]): Priority of the products matching no rule, e.g. the priority
+                                  of the config file. None for normal priority unless the
+                                  deadline is too close for it.
+    """
+
+    def __init__(self, rules: Optional[List[PriorityRule]] = None, deadline: Optional[float] = None,
+                 task_cost: Dict[int, float] = TASK_COST, turnaround: Dict[int, float] = TASK_TURNAROUND,
+                 priority: Optional[int] = None):
+        self.rules = list(rules or [])
+        self.deadline = deadline
+        self.priority = priority
+        self.task_cost = task_cost
+        self.turnaround = turnaround
+        self.start = time.time()
+        self.planned: Dict[int, int] = {NORMAL_PRIORITY: 0, HIGH_PRIORITY: 0}
+        self.actual_cost = 0.0
+        self.posted_at: Dict[str, float] = dict()
+        self.latencies: List[float] = list()
+
+    def default_priority(self) -> int:
+        """ Returns the configured priority, otherwise normal priority unless the deadline is
+        too close for normal tasks.
+        """
+        if self.priority is not None:
+            return self.priority
+        if self.deadline is not None and self.deadline - time.time() < self.turnaround[NORMAL_PRIORITY]:
+            return HIGH_PRIORITY
+        return NORMAL_PRIORITY
+
+    def priority_for(self, product: Dict, n_tasks: int = 1) -> int:
+        """ Returns the priority of the tasks of product and counts them for the cost projection.
+
+        Args:
+            product (Dict): The product record.
+            n_tasks (int): The number of tasks of the product, e.g. one per market.
+        """
+        if any(rule(product) for rule in self.rules):
+            priority = HIGH_PRIORITY
+        else:
+            priority = self.default_priority()
+        self.planned[priority] += n_tasks
+        return priority
+
+    def post_delay(self, n_batches: int) -> float:
+        """ Returns the time to wait between POST requests so that n_batches are spread
+        over the time left before the deadline, minus the turnaround of the slowest task.
+        """
+        if self.deadline is None or n_batches <= 1:
+            return MIN_POST_DELAY
+        slowest = max(self.turnaround[p] for p, n in self.planned.items() if n) if any(self.planned.values()) \
+            else self.turnaround[HIGH_PRIORITY]
+        window = (self.deadline - time.time() - slowest) * PACING_MARGIN
+        return max(MIN_POST_DELAY, window / (n_batches - 1))
+
+    def record_post(self, response: Dict) -> None:
+        """ Adds the cost of a task_post response and remembers when each task was created. """
+        self.actual_cost += response.get("cost") or 0
+        now = time.time()
+        for task in response.get("tasks") or []:
+            if task.get("id"):
+                self.posted_at[task["id"]] = now
+
+    def record_ready(self, task_id: str) -> None:
+        """ Records the latency of a task once its results were fetched. """
+        posted = self.posted_at.pop(task_id, None)
+        if posted is not None:
+            self.latencies.append(time.time() - posted)
+
+    def projected_cost(self) -> float:
+        return sum(self.task_cost[p] * n for p, n in self.planned.items())
+
+    def projected_latency(self) -> float:
+        return max((self.turnaround[p] for p, n in self.planned.items() if n), default=0.0)
+
+    def wait_time(self, minimum: float = 0.0) -> float:
+        """ Returns the time to wait after posting for the tasks to be ready: until the
+        deadline if there is one, otherwise the projected latency, at least minimum.
+        """
+        if self.deadline is not None:
+            return max(0.0, self.deadline - time.time())
+        return max(minimum, self.projected_latency())
+
+    def report(self) -> Dict[str, float]:
+        """ Returns the projected and the actual cost and latency of the run. """
+        latencies = sorted(self.latencies)
+        return dict(
+            normal_tasks=self.planned[NORMAL_PRIORITY],
+            high_tasks=self.planned[HIGH_PRIORITY],
+            projected_cost=self.projected_cost(),
+            actual_cost=self.actual_cost,
+            projected_latency=self.projected_latency(),
+            actual_latency_median=latencies[len(latencies) // 2] if latencies else 0.0,
+            actual_latency_max=latencies[-1] if latencies else 0.0,
+        )
+
+    def print_report(self) -> None:
+        r = self.report()
+        print(f"Tasks: {r['high_tasks']} high priority, {r['normal_tasks']} normal priority")
+        print(f"Cost: projected {r['projected_cost']:.4f} actual {r['actual_cost']:.4f}")
+        print(f"Latency: projected {r['projected_latency']:.0f}s "
+              f"actual median {r['actual_latency_median']:.0f}s max {r['actual_latency_max']:.0f}s")
+
+
+def scheduler_from_config(config: Dict, output_file: str, priority: Optional[int] = None) -> Scheduler:
+    """ Returns the scheduler of the "scheduler" table of the config file, e.g.
+
+        [scheduler]
+        deadline = 3600                                # seconds, no deadline by default
+        ids = [1234, 5678]                             # ids_rule
+        tags = ["Best Seller"]                         # tag_rule, for each tag
+        thresholds = {"Variant Inventory Qty" = 50}    # threshold_rule, for each column
+        price_changed = true                           # price_changed_rule, on by default
+        price_tolerance = 0.01
+
+    Args:
+        config (Dict): The "scheduler" table.
+        output_file (str): The output of the previous run, for price_changed_rule.
+        priority (Optional[int]): The priority configured in the "parameters" table, if any,
+                                  see Scheduler.
+
+    Returns:
+        Scheduler: The scheduler, whose deadline counts from now.
+    """
+    rules: List[PriorityRule] = list()
+    if config.get("ids"):
+        rules.append(ids_rule(set(config["ids"])))
+    for tag in config.get("tags", []):
+        rules.append(tag_rule(tag))
+    for column, minimum in config.get("thresholds", {}).items():
+        rules.append(threshold_rule(column, float(minimum)))
+    if config.get("price_changed", True):
+        rules.append(price_changed_rule(load_previous_prices(output_file), config.get("price_tolerance", 0.01)))
+    deadline = config.get("deadline")
+    return Scheduler(rules=rules, deadline=time.time() + deadline if deadline is not None else None,
+                     priority=priority)
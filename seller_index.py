@@ -0,0 +1,265 @@
+"""
+This module indexes the competitor offers by seller and by domain, so the questions
+across the whole catalog ("which sellers undercut us most", "how far above or below our
+price is each seller") are answered with array operations instead of reading the
+results again.
+
+The index is filled while the results are parsed (see index_products). The names of the
+sellers and the domains are interned to integer ids, each offer becomes one row of
+parallel arrays (product, seller, domain, price, our price), and the offers of each
+seller and of each domain are kept as inverted lists: the rows sorted by seller (and by
+the ratio of the price to ours) with the start of each seller in an offsets array, like
+a CSR matrix. The index is saved to an
+.npz file so that the queries can run later without the results.
+
+Example:
+    index = SellerIndex()
+    write_outputs(index_products(iter_products(results, matcher), index), id_keyword)
+    index.save(SELLER_INDEX_FILE)
+    for row in SellerIndex.load(SELLER_INDEX_FILE).undercutters(top=10):
+        print(row)
+"""
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import urlsplit
+import math
+
+from models import Offer
+from urls import StringTable
+
+
+SELLER_INDEX_FILE = "seller_index.npz"
+
+# Name of the offers without a seller or a domain
+UNKNOWN = "(unknown)"
+
+# Sellers listed by the queries by default
+TOP_SELLERS = 20
+
+# Sellers with fewer priced offers than this are left out of the queries by default
+MIN_OFFERS = 3
+
+
+def normalize_domain(domain: Optional[str], url: Optional[str] = None) -> str:
+    """ Returns the host of domain, or of url if there is no domain, lowercased and without www. """
+    host = (domain or "").strip()
+    if not host and url:
+        host = urlsplit(url).hostname or ""
+    host = host.lower().split("/")[0].split(":")[0].rstrip(".")
+    if host.startswith("www."):
+        host = host[4:]
+    return host or UNKNOWN
+
+
+def normalize_seller(seller: Optional[str]) -> str:
+    """ Returns the key of a seller name: the same seller is spelled with different cases and spaces. """
+    return " ".join((seller or "").split()).casefold()
+
+
+def _price(value) -> float:
+    """ Returns value as a float, NaN if it is not a price (e.g. an empty cell of the data file). """
+    try:
+        price = float(value)
+    except (TypeError, ValueError):
+        return math.nan
+    return price if price > 0 else math.nan
+
+
+class SellerIndex:
+    """ Offers of all the products, indexed by seller and by domain.
+
+    The index is filled with add, then frozen into NumPy arrays by the first query (or
+    by freeze), after which it can not be added to.
+
+    Args:
+        id_keyword (Optional[Dict[str, Tuple]]): Mapping of keywords to (ID, price, ...), see
+                                                 task_post.read_xlsx, for our price of each product.
+    """
+
+    def __init__(self, id_keyword: Optional[Dict[str, Tuple]] = None):
+        self.id_keyword = id_keyword or dict()
+        self.products = StringTable()
+        self.sellers = StringTable()
+        self.domains = StringTable()
+        # The first spelling of each seller, the table holds the keys of normalize_seller
+        self.seller_names: List[str] = list()
+        self.our_prices = array("d")
+        self._columns = dict(product=array("i"), seller=array("i"), domain=array("i"), price=array("d"))
+        self.arrays = None
+
+    def add(self, keyword: str, offers: Sequence[Offer]) -> None:
+        """ Adds the offers of the product of keyword. """
+        if self.arrays is not None:
+            raise RuntimeError("The seller index is frozen")
+        product = self.products.intern(keyword)
+        if product == len(self.our_prices):
+            known = self.id_keyword.get(keyword)
+            self.our_prices.append(_price(known[1]) if known is not None else math.nan)
+        columns = self._columns
+        for offer in offers:
+            key = normalize_seller(offer.seller)
+            seller = self.sellers.intern(key or UNKNOWN)
+            if seller == len(self.seller_names):
+                self.seller_names.append(" ".join(offer.seller.split()) if key else UNKNOWN)
+            columns["product"].append(product)
+            columns["seller"].append(seller)
+            columns["domain"].append(self.domains.intern(normalize_domain(offer.domain, offer.url)))
+            columns["price"].append(_price(offer.price))
+
+    def freeze(self) -> None:
+        """ Builds the arrays and the inverted lists of the offers added so far. """
+        if self.arrays is not None:
+            return
+        import numpy as np
+        arrays = {name: np.frombuffer(column, dtype=np.int32 if column.typecode == "i" else np.float64).copy()
+                  for name, column in self._columns.items()}
+        arrays["our_price"] = np.frombuffer(self.our_prices, dtype=np.float64).copy()
+        # Offers without a price or whose product has no price of ours sort last within their seller
+        ratio = arrays["price"] / arrays["our_price"][arrays["product"]]
+        by_ratio = np.argsort(ratio, kind="stable")
+        by_product = np.argsort(arrays["product"], kind="stable")
+        for name, table in (("seller", self.sellers), ("domain", self.domains)):
+            group = arrays[name]
+            # The rows of each seller (domain) are order[offsets[id]:offsets[id + 1]], by ratio to our price
+            arrays[f"{name}_order"] = by_ratio[np.argsort(group[by_ratio], kind="stable")].astype(np.int32)
+            arrays[f"{name}_offsets"] = np.concatenate(
+                ([0], np.cumsum(np.bincount(group, minlength=len(table))))).astype(np.int64)
+            # Distinct products of each seller: the rows sorted by (seller, product) that start a new pair
+            rows = by_product[np.argsort(group[by_product], kind="stable")]
+            group_rows, product_rows = group[rows], arrays["product"][rows]
+            first = np.ones(len(rows), dtype=bool)
+            first[1:] = (group_rows[1:] != group_rows[:-1]) | (product_rows[1:] != product_rows[:-1])
+            arrays[f"{name}_products"] = np.bincount(group_rows[first], minlength=len(table))
+        self.arrays = arrays
+        self._columns = None
+
+    def __len__(self) -> int:
+        return len(self.arrays["price"]) if self.arrays is not None else len(self._columns["price"])
+
+    def save(self, file_name: str = SELLER_INDEX_FILE) -> None:
+        import numpy as np
+        self.freeze()
+        np.savez(file_name, products=np.array(self.products.names, dtype=str),
+                 sellers=np.array(self.seller_names, dtype=str),
+                 domains=np.array(self.domains.names, dtype=str), **self.arrays)
+
+    @classmethod
+    def load(cls, file_name: str = SELLER_INDEX_FILE) -> "SellerIndex":
+        import numpy as np
+        index = cls()
+        with np.load(file_name) as data:
+            index.products = StringTable(data["products"].tolist())
+            index.seller_names = data["sellers"].tolist()
+            index.sellers = StringTable([normalize_seller(name) or UNKNOWN for name in index.seller_names])
+            index.domains = StringTable(data["domains"].tolist())
+            index.arrays = {name: data[name] for name in data.files
+                            if name not in ("products", "sellers", "domains")}
+        index._columns = None
+        return index
+
+    def _table(self, by: str) -> Tuple[str, List[str]]:
+        if by == "seller":
+            return "seller", self.seller_names
+        if by == "domain":
+            return "domain", self.domains.names
+        raise ValueError(f"Unknown grouping {by!r}, expected seller or domain")
+
+    def offers_of(self, name: str, by: str = "seller"):
+        """ Returns the rows of the offers of a seller (or a domain), empty if it is unknown.
+
+        Args:
+            name (str): The seller name or the domain, normalized like the index.
+            by (str): "seller" or "domain".
+
+        Returns:
+            numpy.ndarray: Indexes of the rows of the arrays.
+        """
+        import numpy as np
+        self.freeze()
+        column, _ = self._table(by)
+        table = self.sellers if column == "seller" else self.domains
+        key = normalize_seller(name) if column == "seller" else normalize_domain(name)
+        i = table.ids.get(key)
+        if i is None:
+            return np.empty(0, dtype=np.int32)
+        offsets = self.arrays[f"{column}_offsets"]
+        return self.arrays[f"{column}_order"][offsets[i]:offsets[i + 1]]
+
+    def seller_stats(self, by: str = "seller", min_offers: int = MIN_OFFERS) -> List[Dict]:
+        """ Compares the prices of each seller (or domain) with ours, over the products we have a price of.
+
+        Args:
+            by (str): "seller" or "domain".
+            min_offers (int): Leaves out the sellers with fewer comparable offers.
+
+        Returns:
+            List[Dict]: For each seller: its name, the number of offers and of products, how
+            many of the offers are below our price ("undercuts") and by how much in total
+            ("undercut_amount"), and the mean and median ratio of its prices to ours.
+        """
+        import numpy as np
+        self.freeze()
+        column, names = self._table(by)
+        a = self.arrays
+        group = a[column]
+        our_price = a["our_price"][a["product"]]
+        ratio = a["price"] / our_price
+        comparable = np.isfinite(ratio)
+        n_groups = len(names)
+
+        n_offers = np.bincount(group[comparable], minlength=n_groups)
+        undercut = comparable & (ratio < 1)
+        undercuts = np.bincount(group[undercut], minlength=n_groups)
+        undercut_amount = np.bincount(group[undercut], weights=(our_price - a["price"])[undercut], minlength=n_groups)
+        ratio_sum = np.bincount(group[comparable], weights=ratio[comparable], minlength=n_groups)
+        n_products = a[f"{column}_products"]
+
+        # The inverted lists are sorted by ratio and start with the comparable offers
+        starts = a[f"{column}_offsets"][:-1]
+        order = a[f"{column}_order"]
+        has_offers = n_offers > 0
+        median = np.full(n_groups, np.nan)
+        lower = order[(starts + (n_offers - 1) // 2)[has_offers]]
+        upper = order[(starts + n_offers // 2)[has_offers]]
+        median[has_offers] = (ratio[lower] + ratio[upper]) / 2
+
+        stats = list()
+        for i in np.flatnonzero(n_offers >= max(min_offers, 1)):
+            stats.append(dict(name=names[i], offers=int(n_offers[i]), products=int(n_products[i]),
+                              undercuts=int(undercuts[i]), undercut_amount=round(float(undercut_amount[i]), 2),
+                              mean_ratio=round(float(ratio_sum[i] / n_offers[i]), 4),
+                              median_ratio=round(float(median[i]), 4)))
+        return stats
+
+    def undercutters(self, by: str = "seller", top: int = TOP_SELLERS, min_offers: int = MIN_OFFERS) -> List[Dict]:
+        """ Returns the top sellers (or domains) with the most offers below our price, see seller_stats. """
+        stats = self.seller_stats(by, min_offers)
+        stats.sort(key=lambda s: (-s["undercuts"], -s["undercut_amount"], s["name"]))
+        return stats[:top]
+
+
+def index_products(products: Iterable[Tuple[str, Sequence[Offer]]],
+                   index: SellerIndex) -> Iterator[Tuple[str, Sequence[Offer]]]:
+    """ Adds the offers of each product to index as they go by, e.g. to the writers.
+
+    Args:
+        products (Iterable[Tuple[str, Sequence[Offer]]]): The keyword and offers of each
+                                                           product, e.g. iter_products(results).
+        index (SellerIndex): The index to fill.
+
+    Yields:
+        Tuple[str, Sequence[Offer]]: The products, unchanged.
+    """
+    for keyword, offers in products:
+        index.add(keyword, offers)
+        yield keyword, offers
+
+
+def print_sellers(stats: Sequence[Dict], by: str = "seller") -> None:
+    """ Prints the rows of seller_stats or undercutters as a table. """
+    width = max([len(by)] + [len(s["name"]) for s in stats])
+    print(f"{by.capitalize():<{width}}  {'Offers':>6}  {'Products':>8}  {'Undercuts':>9}  "
+          f"{'Amount':>10}  {'Mean ratio':>10}  {'Median ratio':>12}")
+    for s in stats:
+        print(f"{s['name']:<{width}}  {s['offers']:>6}  {s['products']:>8}  {s['undercuts']:>9}  "
+              f"{s['undercut_amount']:>10.2f}  {s['mean_ratio']:>10.3f}  {s['median_ratio']:>12.3f}")
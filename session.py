@@ -0,0 +1,131 @@
+"""
+This module provides the Session that is created once per run and passed to all the
+pipeline functions in task_post.py. It owns the credentials, the client with its
+connections, the rate and concurrency limiters, the metrics, the budget, the deadline
+and the caches (ad URLs, locations and languages), and flushes the caches and closes the
+connections when it is closed.
+
+Example:
+    with Session(login, password) as session:
+        send_post(data_list, session=session)
+"""
+from typing import Dict, List, Optional
+from client import Deadline, RestClient, RateLimiter
+from concurrency import AdaptiveLimiter
+from metrics import Metrics
+from ad_url import AdUrlResolver, AD_URL_CACHE_FILE
+import json
+import os
+import time
+
+
+SUCCESS_STATUS_CODE = 20000
+
+REFERENCE_CACHE_FILE = "reference_cache.json"
+
+# Locations and languages rarely change, cached entries are used for a week
+REFERENCE_TTL = 7 * 24 * 3600
+
+
+class Session:
+    """ Shared state of a run.
+
+    Args:
+        login (str): The email id used when logging into the API.
+        password (str): The password/API token used when logging into the API.
+        metrics (Optional[Metrics]): The metrics registry, a new one if it is None.
+        rate_limiter (Optional[RateLimiter]): The rate limiter, a new one if it is None.
+        concurrency (Optional[AdaptiveLimiter]): The limit of the calls in flight per
+                                                 endpoint, a new one if it is None.
+        ad_url_cache_file (Optional[str]): Persistent cache of the ad URL resolver.
+        reference_cache_file (Optional[str]): Persistent cache of the locations and languages.
+        budget (Optional[Budget]): Tracks the spend of the calls and caps it, see budget.py.
+        deadline (Optional[Deadline]): The deadline of the run, every call and stage stops by then.
+        hedge (bool): Send a second copy of the slow idempotent GET calls, see RestClient.
+    """
+
+    def __init__(self, login: str, password: str, metrics: Optional[Metrics] = None,
+                 rate_limiter: Optional[RateLimiter] = None, concurrency: Optional[AdaptiveLimiter] = None,
+                 ad_url_cache_file: Optional[str] = AD_URL_CACHE_FILE,
+                 reference_cache_file: Optional[str] = REFERENCE_CACHE_FILE, budget=None,
+                 deadline: Optional[Deadline] = None, hedge: bool = False):
+        self.login = login
+        self.password = password
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.concurrency = concurrency if concurrency is not None else AdaptiveLimiter(metrics=self.metrics)
+        self.budget = budget
+        self.deadline = deadline
+        if budget is not None:
+            # The budget sees the cost of every call through the metrics
+            self.metrics.add_hook(budget)
+        self.client = RestClient(login, password, metrics=self.metrics, rate_limiter=self.rate_limiter,
+                                 keep_alive=True, deadline=deadline, hedge=hedge, concurrency=self.concurrency)
+        self.ad_urls = AdUrlResolver(self.client, cache_file=ad_url_cache_file, metrics=self.metrics)
+        self.reference_cache_file = reference_cache_file
+        self._reference: Dict[str, Dict] = dict()
+        self._reference_dirty = False
+        self.closed = False
+        if reference_cache_file and os.path.isfile(reference_cache_file):
+            with open(reference_cache_file, 'r', encoding="utf-8") as file:
+                self._reference = json.load(file)
+
+    def get(self, path: str) -> Dict:
+        return self.client.get(path)
+
+    def post(self, path: str, data) -> Dict:
+        return self.client.post(path, data)
+
+    def reference(self, name: str, path: str) -> Optional[List[Dict]]:
+        """ Returns the result of a reference data call such as the locations, from the
+        cache if it is younger than REFERENCE_TTL.
+
+        Args:
+            name (str): The cache key, e.g. "locations".
+            path (str): The path of the call, e.g. "/v3/merchant/google/locations".
+
+        Returns:
+            Optional[List[Dict]]: The result list or None if there was an error.
+        """
+        entry = self._reference.get(name)
+        if entry is not None and time.time() - entry["time"] < REFERENCE_TTL:
+            return entry["result"]
+        response = self.client.get(path)
+        if response["status_code"] != SUCCESS_STATUS_CODE:
+            print(f"error. Code: {response['status_code']} Message: {response['status_message']}")
+            return None
+        result = response["tasks"][0]["result"]
+        self._reference[name] = dict(time=time.time(), result=result)
+        self._reference_dirty = True
+        return result
+
+    def flush(self) -> None:
+        """ Persists the caches and the spend and exports the metrics. """
+        self.ad_urls.save()
+        if self.budget is not None:
+            self.budget.flush()
+        if self.reference_cache_file and self._reference_dirty:
+            tmp_name = self.reference_cache_file + ".tmp"
+            with open(tmp_name, 'w', encoding="utf-8") as file:
+                json.dump(self._reference, file)
+            os.replace(tmp_name, self.reference_cache_file)
+            self._reference_dirty = False
+        self.metrics.flush()
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+        finally:
+            self.ad_urls.close()
+            self.client.close()
+            if self.budget is not None:
+                self.metrics.hooks.remove(self.budget)
+
+    def __enter__(self) -> "Session":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
@@ -0,0 +1,231 @@
+"""
+This module keeps a snapshot of the product catalog between runs, so that a run only
+posts the products that are new, that changed, or whose last post is older than a
+maximum age, instead of a paid task for every row of the daily export.
+
+Each product of the data file is reduced to two 64-bit hashes: one of its keyword (the
+normalized title, which identifies its task) and one of its normalized row (the
+SNAPSHOT_COLUMNS). The snapshot keeps the sorted keyword hashes with the row hash and the
+time of the last post of each product, and the catalog is compared with it in a
+vectorized hash join (numpy.searchsorted) rather than row by row.
+
+The snapshot is only updated for the products whose tasks were created, so the products
+that were deferred by the budget or failed to post are still changed in the next run.
+
+Since a run only fetches the results of the products it posted, the outputs carry the
+last offers of the other products forward from OFFERS_FILE (see task_post.write_outputs).
+
+The parsed rows of the workbook are also cached (see load_parsed), so an unchanged data
+file is read without pandas.
+
+Example:
+    store = SnapshotStore()
+    batches, id_keyword = set_task(DATA_FILE, snapshot=store)
+    store.commit(send_post(batches))
+"""
+from hashlib import blake2b, sha1
+from typing import Any, Dict, Iterable, List, Optional, Set
+import json
+import math
+import os
+import time
+
+from matching import normalize_keyword
+
+
+SNAPSHOT_FILE = "catalog_snapshot.npz"
+
+# The last offers of every product, in the format of writers.CsvWriter, see task_post.write_outputs
+OFFERS_FILE = "catalog_offers.csv"
+
+# The parsed rows of the last data file that was read, see load_parsed
+PARSE_CACHE_FILE = "catalog_cache.json"
+
+# Columns of a product whose change makes it post again
+SNAPSHOT_COLUMNS = ("Title", "Variant Price", "Variant Barcode")
+
+# Seconds after which a product is posted again even if it did not change (a week)
+MAX_AGE = 7 * 24 * 3600
+
+# Bytes read at a time to hash the data file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def hash64(text: str) -> int:
+    """ Returns a 64-bit hash of text that is the same in every process, unlike hash(). """
+    return int.from_bytes(blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def _cell(value: Any) -> str:
+    """ Returns the text of a cell, the same for the values that pandas reads in different types. """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ""
+    if isinstance(value, float):
+        return str(int(value)) if value.is_integer() else f"{value:.2f}"
+    return " ".join(str(value).split())
+
+
+def row_hash(product: Dict, columns: Iterable[str] = SNAPSHOT_COLUMNS) -> int:
+    return hash64("\x1f".join(_cell(product.get(column)) for column in columns))
+
+
+class CatalogDiff:
+    """ The products of the data file compared with the snapshot.
+
+    Args:
+        keywords (List[str]): The keyword of each distinct product of the data file.
+        key_hashes (numpy.ndarray): The hash64 of each keyword.
+        row_hashes (numpy.ndarray): The row_hash of each product.
+        added, changed, stale (numpy.ndarray): Whether each product is new, changed or too old.
+        removed (List[str]): The keywords of the snapshot that are no longer in the data file.
+    """
+
+    def __init__(self, keywords: List[str], key_hashes, row_hashes, added, changed, stale, removed: List[str]):
+        self.keywords = keywords
+        self.key_hashes = key_hashes
+        self.row_hashes = row_hashes
+        self.added = added
+        self.changed = changed
+        self.stale = stale
+        self.removed = removed
+
+    @property
+    def to_post(self) -> Set[str]:
+        """ The keywords of the products to post: the new, changed and stale ones. """
+        post = self.added | self.changed | self.stale
+        return {keyword for keyword, p in zip(self.keywords, post.tolist()) if p}
+
+    def __str__(self) -> str:
+        n_added, n_changed, n_stale = int(self.added.sum()), int(self.changed.sum()), int(self.stale.sum())
+        unchanged = len(self.keywords) - n_added - n_changed - n_stale
+        return (f"Catalog: {n_added} new, {n_changed} changed, {n_stale} stale, {unchanged} unchanged, "
+                f"{len(self.removed)} removed products")
+
+
+class SnapshotStore:
+    """ The snapshot of the catalog of the last runs, in an .npz file.
+
+    Args:
+        file_name (str): The snapshot file.
+        max_age (float): See MAX_AGE.
+    """
+
+    def __init__(self, file_name: str = SNAPSHOT_FILE, max_age: float = MAX_AGE):
+        self.file_name = file_name
+        self.max_age = max_age
+        # The diff that commit saves
+        self.pending: Optional[CatalogDiff] = None
+
+    def load(self) -> Dict:
+        """ Returns the arrays of the snapshot, sorted by key hash, empty if there is none yet. """
+        import numpy as np
+        if not os.path.isfile(self.file_name):
+            return dict(keywords=np.array([], dtype=str), key_hashes=np.array([], dtype=np.uint64),
+                        row_hashes=np.array([], dtype=np.uint64), posted_at=np.array([], dtype=np.float64))
+        with np.load(self.file_name) as data:
+            return {name: data[name] for name in data.files}
+
+    def diff(self, product_data: List[Dict], now: Optional[float] = None) -> CatalogDiff:
+        """ Compares the products of read_xlsx with the snapshot, see CatalogDiff.
+
+        Products with the same keyword are one task, the last of them is compared like
+        in the id_keyword of read_xlsx.
+        """
+        import numpy as np
+        now = time.time() if now is None else now
+        rows: Dict[str, int] = dict()
+        for product in product_data:
+            rows[normalize_keyword(str(product["Title"]))] = row_hash(product)
+        keywords = list(rows)
+        key_hashes = np.fromiter((hash64(keyword) for keyword in keywords), dtype=np.uint64, count=len(keywords))
+        row_hashes = np.fromiter(rows.values(), dtype=np.uint64, count=len(rows))
+
+        old = self.load()
+        n_old = len(old["key_hashes"])
+        pos = np.minimum(np.searchsorted(old["key_hashes"], key_hashes), max(n_old - 1, 0))
+        if n_old:
+            found = old["key_hashes"][pos] == key_hashes
+            changed = found & (old["row_hashes"][pos] != row_hashes)
+            stale = found & ~changed & (now - old["posted_at"][pos] > self.max_age)
+        else:
+            found = changed = stale = np.zeros(len(keywords), dtype=bool)
+        # The keywords of the snapshot without a product, with the same join the other way
+        new_sorted = np.sort(key_hashes)
+        back = np.minimum(np.searchsorted(new_sorted, old["key_hashes"]), max(len(new_sorted) - 1, 0))
+        kept = new_sorted[back] == old["key_hashes"] if len(new_sorted) else np.zeros(n_old, dtype=bool)
+        removed = old["keywords"][~kept].tolist()
+        self.pending = CatalogDiff(keywords, key_hashes, row_hashes, ~found, changed, stale, removed)
+        return self.pending
+
+    def commit(self, posted: Iterable[str], now: Optional[float] = None) -> None:
+        """ Saves the snapshot of the last diff, with the products of posted as posted now.
+
+        Args:
+            posted (Iterable[str]): The keywords of the tasks that were created, see send_post.
+            now (Optional[float]): The time of the post, defaults to now.
+        """
+        import numpy as np
+        diff = self.pending
+        if diff is None:
+            raise RuntimeError("commit needs a diff of the catalog first")
+        now = time.time() if now is None else now
+        posted_hashes = np.fromiter({hash64(keyword) for keyword in posted}, dtype=np.uint64)
+        is_posted = np.isin(diff.key_hashes, posted_hashes)
+
+        old = self.load()
+        n_old = len(old["key_hashes"])
+        found = ~diff.added
+        pos = np.minimum(np.searchsorted(old["key_hashes"], diff.key_hashes), max(n_old - 1, 0))
+        # The products that were not posted keep what the snapshot had, the new ones are left out
+        keep = is_posted | found
+        row_hashes = np.where(is_posted, diff.row_hashes, old["row_hashes"][pos] if n_old else diff.row_hashes)
+        posted_at = np.where(is_posted, now, old["posted_at"][pos] if n_old else now)
+        key_hashes = diff.key_hashes[keep]
+        order = np.argsort(key_hashes)
+        keywords = np.array(diff.keywords, dtype=str)[keep] if diff.keywords else np.array([], dtype=str)
+        tmp_name = self.file_name + ".tmp"
+        with open(tmp_name, 'wb') as file:
+            np.savez(file, keywords=keywords[order], key_hashes=key_hashes[order],
+                     row_hashes=row_hashes[keep][order], posted_at=posted_at[keep][order])
+        os.replace(tmp_name, self.file_name)
+        self.pending = None
+
+
+def file_hash(file_name: str) -> str:
+    digest = sha1()
+    with open(file_name, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _json_value(value: Any) -> Any:
+    """ Converts the NumPy and pandas values of the records, e.g. numpy.int64 or Timestamp. """
+    if hasattr(value, "item"):
+        return value.item()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def load_parsed(file_name: str, cache_file: str = PARSE_CACHE_FILE) -> Optional[List[Dict]]:
+    """ Returns the records saved by save_parsed if file_name did not change since, otherwise None. """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'r', encoding="utf-8") as file:
+            cache = json.load(file)
+    except ValueError:
+        return None
+    if cache.get("file") != os.path.abspath(file_name) or cache.get("sha1") != file_hash(file_name):
+        return None
+    return cache["records"]
+
+
+def save_parsed(file_name: str, product_data: List[Dict], cache_file: str = PARSE_CACHE_FILE) -> None:
+    """ Caches the records read from file_name, see load_parsed. """
+    tmp_name = cache_file + ".tmp"
+    with open(tmp_name, 'w', encoding="utf-8") as file:
+        json.dump(dict(file=os.path.abspath(file_name), sha1=file_hash(file_name), records=product_data), file,
+                  default=_json_value)
+    os.replace(tmp_name, cache_file)
@@ -0,0 +1,128 @@
+"""
+Local stand-in for the DataForSEO API, used by the benchmarks. Every GET is answered
+with the same task_get response after a random delay: most calls take about
+FAST_LATENCY, a SLOW_FRACTION of them take SLOW_LATENCY, like the slow tail of the real
+API. POSTs get an empty task_post response. With a capacity, the calls beyond capacity
+in flight are throttled: they get the 40202 status code instead, like the rate limit of
+the API. The next failures calls fail: the connection is closed without an answer.
+
+Example:
+    with StubServer() as server:
+        client = RestClient("login", "password", domain=server.address, secure=False)
+        client.get("/v3/merchant/google/products/task_get/advanced/<id>")
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Optional
+import json
+import random
+import time
+
+
+# Typical latency of a call, in seconds
+FAST_LATENCY = 0.01
+
+# Fraction of the calls that are slow, and their latency
+SLOW_FRACTION = 0.03
+SLOW_LATENCY = 0.5
+
+THROTTLED_RESPONSE = dict(status_code=40202, status_message="Rate limit exceeded.", cost=0, tasks_count=0,
+                          tasks_error=0, tasks=[])
+
+STUB_RESPONSE = dict(status_code=20000, status_message="Ok.", cost=0, tasks_count=1, tasks_error=0,
+                     tasks=[dict(status_code=20000, status_message="Ok.", cost=0, result=[])])
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keeps the connections open between calls, like the API
+    protocol_version = "HTTP/1.1"
+    # The headers and the body are written separately, without this the body waits for the delayed ACK
+    disable_nagle_algorithm = True
+
+    def _answer(self) -> None:
+        server: StubServer = self.server.stub
+        with server.lock:
+            failed = server.failures > 0
+            server.failures -= failed
+        if failed:
+            time.sleep(server.slow_latency)
+            self.close_connection = True
+            return
+        with server.lock:
+            server.in_flight += 1
+            throttled = server.capacity is not None and server.in_flight > server.capacity
+        try:
+            time.sleep(server.fast_latency if throttled else server.latency())
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+                server.calls += 1
+                server.throttled += throttled
+        body = server.throttled_body if throttled else server.body
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        try:
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up on the call, e.g. after its read timeout
+            self.close_connection = True
+
+    def do_GET(self) -> None:
+        self._answer()
+
+    def do_POST(self) -> None:
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self._answer()
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class StubServer:
+    """ Runs the stub in a background thread on a free local port.
+
+    Args:
+        response (Optional[dict]): The body of every answer, defaults to STUB_RESPONSE.
+        fast_latency (float): Mean latency of the normal calls, exponentially distributed.
+        slow_fraction (float): Fraction of the calls that take slow_latency.
+        slow_latency (float): Latency of the slow calls.
+        seed (Optional[int]): Seed of the latencies, for repeatable benchmarks.
+        capacity (Optional[int]): Calls in flight above which the calls are throttled, no limit if it is None.
+    """
+
+    def __init__(self, response: Optional[dict] = None, fast_latency: float = FAST_LATENCY,
+                 slow_fraction: float = SLOW_FRACTION, slow_latency: float = SLOW_LATENCY,
+                 seed: Optional[int] = None, capacity: Optional[int] = None):
+        self.body = json.dumps(response or STUB_RESPONSE).encode("utf-8")
+        self.throttled_body = json.dumps(THROTTLED_RESPONSE).encode("utf-8")
+        self.capacity = capacity
+        # Calls that are answered by closing the connection after slow_latency, e.g. to test the retries
+        self.failures = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.throttled = 0
+        self.lock = Lock()
+        self.fast_latency = fast_latency
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.random = random.Random(seed)
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.address = f"127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def latency(self) -> float:
+        if self.random.random() < self.slow_fraction:
+            return self.slow_latency
+        return self.random.expovariate(1 / self.fast_latency)
+
+    def __enter__(self) -> "StubServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -3,13 +3,33 @@ This module facilitates the connection to the DataForSEO API, reading and parsin
 and sending REST API requests for use with the Merchant API provided by DataForSEO.
 """
 from pathlib import Path
-from typing import Dict, List, Union, Tuple, Any
-import pandas as pd
-from client import RestClient
-from time import sleep
+from typing import Dict, List, Set, Union, Tuple, Any, Optional, Iterable, Iterator, TextIO
+from client import Deadline, DeadlineExceeded, RestClient, RateLimiter
+from concurrency import AdaptiveLimiter, is_throttled, retry_delay, sleep_then, FETCH_ATTEMPTS
+from metrics import Metrics
+from scheduler import Scheduler, scheduler_from_config
+from session import Session
+from batching import Batch, pack_batches
+import batching
+from matching import TitleMatcher, normalize_keyword, sku
+from models import Offer, Task, parse_response
+from markets import (Market, compare_markets, expand_markets, iter_market_offers, market_file_name,
+                     markets_from_config, split_markets, validate_markets, write_market_csv, MARKETS_OUTPUT_FILE)
+from writers import ArchiveWriter, CompetitorCsvWriter, open_writer, read_offers, write_products
+from budget import Budget, estimate_cost, save_deferred, DEFERRED_FILE
+from ledger import Ledger
+from snapshot import SnapshotStore, load_parsed, save_parsed, MAX_AGE, OFFERS_FILE, SNAPSHOT_FILE
+from result_index import IndexWriter, index_name
+from urls import share_url
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from time import sleep, time
 import json
+import heapq
 import os
-import csv
+import re
+import sys
+import atexit
 
 
 DEFAULT_EMAIL = ""
@@ -31,55 +51,193 @@ TASK_IDS_FILE = "task_ids.dat"
 RESULTS_FILE = "task_results.json"
 OUTPUT_FILE = "results.csv"
 
-# Waiting time for tasks to finish since they will be in the queue
+# Additional outputs with one row per offer, the format is given by the extension
+# (.csv, .parquet or .xlsx), see writers.py
+EXPORT_FILES: List[str] = list()
+
+# Minimum waiting time for tasks to finish since they will be in the queue, the run waits
+# for the deadline of the scheduler or the turnaround of the priorities of its tasks
 TASK_WAIT = 360
 
-def connect(e_id: str = DEFAULT_EMAIL, token: str = DEFAULT_PWD) -> RestClient:
+# Size of the blocks read by iter_results_json, the reader holds at most one block
+# plus the document being decoded
+READ_BLOCK_SIZE = 1024 * 1024
+
+# Number of offers analyze_results buffers before matching and aggregating them
+ANALYZE_CHUNK_SIZE = 10000
+
+NON_WHITESPACE = re.compile(r"\S")
+
+# Metrics shared by every client created with connect() and by the pipeline stages,
+# add hooks from the metrics module to export them (see Metrics.add_hook)
+METRICS = Metrics()
+
+# All the clients created with connect() share the API limit of 2000 calls per minute
+RATE_LIMITER = RateLimiter()
+
+# They also share the limit of the calls in flight per endpoint, which grows while the API
+# answers quickly and is cut when it throttles, see concurrency.py
+CONCURRENCY = AdaptiveLimiter(metrics=METRICS)
+
+# Session used by the pipeline functions when none is passed, see get_session()
+_SESSION: Optional[Session] = None
+
+# Spend caps of the "budget" table of the config file, see budget.py
+BUDGET: Dict[str, float] = dict()
+
+# The "queue" table of the config file, for the worker and coordinate commands, see jobqueue.py
+QUEUE: Dict[str, Any] = dict()
+
+# The "daemon" table of the config file, for the daemon command, see daemon.py
+DAEMON: Dict[str, float] = dict()
+
+# The "snapshot" table of the config file, for the runs that only post the changed products, see snapshot.py
+SNAPSHOT: Dict[str, Any] = dict()
+
+# The "scheduler" table of the config file, the priority rules and deadline of the tasks, see scheduler.py
+SCHEDULER: Dict[str, Any] = dict()
+
+# The priority of the "parameters" table if it is configured, the scheduler then uses it
+# instead of choosing one for the products matching no rule
+CONFIGURED_PRIORITY: Optional[int] = None
+
+# Seconds the whole run may take (posting, waiting and fetching), no limit if it is None.
+# The tasks that are not posted by then are saved to DEFERRED_FILE and the ones that are
+# not fetched stay in TASK_IDS_FILE for a resumed run.
+RUN_DEADLINE: Optional[float] = None
+
+# Send a second copy of the task_get, tasks_ready, locations and languages calls that are
+# slower than 95% of the recent ones, see client.RestClient
+HEDGE_REQUESTS = False
+
+# Markets of a multi-market run (see markets.py), the run only uses the location and
+# language of PARAMETERS if it is empty
+MARKETS: List[Market] = list()
+
+def configure(config: Dict[str, Dict]) -> None:
+    """ Applies a configuration loaded with config.load_config to the module defaults.
+
+    Args:
+        config (Dict[str, Dict]): The "credentials", "parameters", "files", "run" and "markets" tables.
     """
-    Connects to DataForSEO and returns the RestClient object that is then
-    used to send requests.
+    global DEFAULT_EMAIL, DEFAULT_PWD, DATA_FILE, TASK_IDS_FILE, RESULTS_FILE, OUTPUT_FILE, TASK_WAIT, MARKETS
+    global EXPORT_FILES, BUDGET, RUN_DEADLINE, HEDGE_REQUESTS, QUEUE, DAEMON, SNAPSHOT, SCHEDULER, CONFIGURED_PRIORITY
+    credentials = config.get("credentials", {})
+    DEFAULT_EMAIL = credentials.get("login", DEFAULT_EMAIL)
+    DEFAULT_PWD = credentials.get("password", DEFAULT_PWD)
+    PARAMETERS.update(config.get("parameters", {}))
+    CONFIGURED_PRIORITY = config.get("parameters", {}).get("priority", CONFIGURED_PRIORITY)
+    files = config.get("files", {})
+    DATA_FILE = files.get("data_file", DATA_FILE)
+    TASK_IDS_FILE = files.get("task_ids_file", TASK_IDS_FILE)
+    RESULTS_FILE = files.get("results_file", RESULTS_FILE)
+    OUTPUT_FILE = files.get("output_file", OUTPUT_FILE)
+    EXPORT_FILES = list(files.get("exports", EXPORT_FILES))
+    run = config.get("run", {})
+    TASK_WAIT = run.get("task_wait", TASK_WAIT)
+    RUN_DEADLINE = run.get("deadline", RUN_DEADLINE)
+    HEDGE_REQUESTS = run.get("hedge", HEDGE_REQUESTS)
+    CONCURRENCY.max_limit = run.get("max_concurrency", CONCURRENCY.max_limit)
+    batching.MAX_TASKS_PER_POST = run.get("max_tasks_per_post", batching.MAX_TASKS_PER_POST)
+    batching.MAX_BODY_BYTES = run.get("max_body_bytes", batching.MAX_BODY_BYTES)
+    MARKETS = markets_from_config(config) or MARKETS
+    BUDGET = dict(config.get("budget", BUDGET))
+    QUEUE = dict(config.get("queue", QUEUE))
+    DAEMON = dict(config.get("daemon", DAEMON))
+    SNAPSHOT = dict(config.get("snapshot", SNAPSHOT))
+    SCHEDULER = dict(config.get("scheduler", SCHEDULER))
+
+
+def credentials(e_id: str = "", token: str = "") -> Tuple[str, str]:
+    """ Returns the login email and password, asking for them (once per run) if they
+    were neither passed nor configured.
     Args:
         e_id (str, optional): The email id used when logging into the API.
                                 Defaults to DEFAULT_EMAIL.
         token (str, optional): The password/API token used when logging into the API.
                                 Defaults to DEFAULT_PWD.
-    Returns:
-        RestClient: The object used to send requests to DataForSEO.
     """
-    if DEFAULT_EMAIL == '' or DEFAULT_PWD == '':
+    global DEFAULT_EMAIL, DEFAULT_PWD
+    e_id = e_id or DEFAULT_EMAIL
+    token = token or DEFAULT_PWD
+    if e_id == '' or token == '':
+        if not sys.stdin.isatty():
+            raise RuntimeError("No DataForSEO credentials, set DATAFORSEO_LOGIN and DATAFORSEO_PASSWORD "
+                               "or add them to the config file")
         print("Enter the login email:")
         e_id = input()
         print("Enter the login password:")
         token = input()
-    client = RestClient(e_id, token)
+        # Only ask once per run
+        DEFAULT_EMAIL, DEFAULT_PWD = e_id, token
+    return e_id, token
+
+
+def connect(e_id: str = "", token: str = "") -> RestClient:
+    """
+    Connects to DataForSEO and returns the RestClient object that is then
+    used to send requests.
+    Args:
+        e_id (str, optional): The email id used when logging into the API.
+                                Defaults to DEFAULT_EMAIL.
+        token (str, optional): The password/API token used when logging into the API.
+                                Defaults to DEFAULT_PWD.
+    Returns:
+        RestClient: The object used to send requests to DataForSEO.
+    """
+    e_id, token = credentials(e_id, token)
+    client = RestClient(e_id, token, metrics=METRICS, rate_limiter=RATE_LIMITER, concurrency=CONCURRENCY)
     return client
 
 
+def open_session(e_id: str = "", token: str = "") -> Session:
+    """ Creates the session of a run with the module's metrics and rate limiter, the
+    budget if BUDGET has a cap and the deadline if RUN_DEADLINE is set. Use it as a
+    context manager so that the caches are flushed and the connections closed.
+    Args:
+        e_id (str, optional): The email id used when logging into the API.
+        token (str, optional): The password/API token used when logging into the API.
+    """
+    e_id, token = credentials(e_id, token)
+    budget = Budget.from_config(BUDGET, Ledger()) if BUDGET else None
+    deadline = Deadline(RUN_DEADLINE) if RUN_DEADLINE else None
+    return Session(e_id, token, metrics=METRICS, rate_limiter=RATE_LIMITER, concurrency=CONCURRENCY,
+                   budget=budget, deadline=deadline, hedge=HEDGE_REQUESTS)
+
+
+def get_session() -> Session:
+    """ Returns the default session used by the pipeline functions when they are not
+    given one, it is created on first use and closed when the program exits.
+    """
+    global _SESSION
+    if _SESSION is None or _SESSION.closed:
+        _SESSION = open_session()
+        atexit.register(_SESSION.close)
+    return _SESSION
+
+
 
-def get_languages() -> List[Dict]:
+def get_languages(session: Optional[Session] = None) -> List[Dict]:
     """Returns the list of languages supported by the google merchant API
-    or an empty list if there is an error
+    or an empty list if there is an error, cached by the session
+    Args:
+        session (Optional[Session]): The session of the run, defaults to get_session()
 
     Returns:
         List[Dict]: A list of dictionaries containing
         "language_name": The name of the language
         "language_code": The corresponding ISO code of the language
     """
-    client = connect()
-    response = client.get("/v3/merchant/google/languages")
-    if response["status_code"] == SUCCESS_STATUS_CODE:
-        # print(response)
-        return response["tasks"][0]["result"]
-    status_code = response["status_code"]
-    status_message = response["status_message"]
-    print(f"error. Code: {status_code} Message: {status_message}")
-    return [Dict()]
+    session = session or get_session()
+    return session.reference("languages", "/v3/merchant/google/languages") or []
 
 
 
-def get_locations() -> List[Dict]:
-    """ Returns the list of languages supported by google merchant API
-    or an empty list if there is an error
+def get_locations(session: Optional[Session] = None) -> List[Dict]:
+    """ Returns the list of locations supported by google merchant API
+    or an empty list if there is an error, cached by the session
+    Args:
+        session (Optional[Session]): The session of the run, defaults to get_session()
     Returns:
         List[Dict]: A list of dictionaries, each containing
           "location_code",
@@ -88,15 +246,8 @@ def get_locations() -> List[Dict]:
           "country_iso_code",
           "location_type"
     """
-    client = connect()
-    response = client.get("/v3/merchant/google/locations")
-    if response["status_code"] == SUCCESS_STATUS_CODE:
-        # print(response)
-        return response["tasks"][0]["result"]
-    status_code = response["status_code"]
-    status_message = response["status_message"]
-    print(f"error. Code: {status_code} Message: {status_message}")
-    return [Dict()]
+    session = session or get_session()
+    return session.reference("locations", "/v3/merchant/google/locations") or []
 
 
 
@@ -132,6 +283,23 @@ def read_xlsx(file_name: str) -> Tuple[List[Dict], Dict[str, int]]:
     if not os.path.isfile(file_name):
         print("Invalid file")
         return product_data
+    # A workbook that did not change since it was last read is not parsed again
+    product_data = load_parsed(file_name)
+    if product_data is None:
+        product_data = parse_xlsx(file_name)
+        save_parsed(file_name, product_data)
+    # The keywords sent to the API are the normalized titles, see matching.normalize_keyword
+    id_keyword = dict()
+    for p in product_data:
+        id_keyword[normalize_keyword(str(p["Title"]))] = p["ID"], p["Variant Price"], sku(str(p["Title"]))
+    return product_data, id_keyword
+
+
+def parse_xlsx(file_name: str) -> List[Dict]:
+    """ Returns the rows of the spreadsheet with a numeric barcode, as records, see read_xlsx. """
+    # pandas is only needed for reading the spreadsheet, importing it here keeps the
+    # startup of fetch-only runs fast
+    import pandas as pd
     file = pd.read_excel(file_name)
 
     # Drop float NaN values
@@ -147,65 +315,86 @@ def read_xlsx(file_name: str) -> Tuple[List[Dict], Dict[str, int]]:
     # Each element in this product_data list corresponds to a dictionary with each column names
     # as keys, i.e. product_data[i].keys() will return the list of column names in
     # the excel spreadsheet
-    product_data = file.to_dict('records')
-    id_keyword = dict()
-    for p in product_data:
-        id_keyword[str(p["Title"])] = p["ID"], p["Variant Price"]
-    return product_data, id_keyword
+    return file.to_dict('records')
 
 
 
-def set_task(file_name: str = DATA_FILE) -> Tuple[List[Dict[int, Dict]], Dict[str, int]]:
+def product_task(product: Dict, priority: Optional[int] = None) -> Dict:
+    """ Returns the task of a product record of read_xlsx.
+    Args:
+        product (Dict): The product record.
+        priority (Optional[int]): The priority of the task, the priority in PARAMETERS if it is None.
+    """
+    if priority is None:
+        priority = PARAMETERS["priority"]
+    return Task(
+        location_name=PARAMETERS["location_name"],
+        language_name=PARAMETERS["language_name"],
+        priority=priority,
+        sort_by=PARAMETERS["sort_by"],
+        # UPC isn't a good keyword
+        # keyword=str(product["Variant Barcode"]),
+        keyword=normalize_keyword(str(product["Title"])),
+        # price_min=PARAMETERS["price_min"]
+        # Minimum price to filter out bad results
+        price_min=PARAMETERS["price_min"]*product["Variant Price"]
+        # Add tag to identify task??
+        # tag=product["Variant Barcode"]
+    ).as_dict()
+
+
+def set_task(file_name: str = DATA_FILE, scheduler: Optional[Scheduler] = None,
+             markets: Optional[List[Market]] = None,
+             snapshot: Optional[SnapshotStore] = None) -> Tuple[List[Batch], Dict[str, int]]:
     """Sets the appropriate task information that will be sent
     Args:
         file_name (str): The name of the file containing the data
+        scheduler (Optional[Scheduler]): Assigns the priority of each task, the priority
+                                         in PARAMETERS is used if it is None
+        markets (Optional[List[Market]]): Posts each product in each of these markets
+                                          instead of the location and language of PARAMETERS
+        snapshot (Optional[SnapshotStore]): Only creates the tasks of the products that are new,
+                                            changed or stale since the snapshot, call its
+                                            commit with the result of send_post after posting
     Returns:
-        The first return value is the data for the request and the second item is 
-        the mapping of keywords to IDs
+        The first return value is the data for the request (batches of tasks, see
+        batching.pack_batches) and the second item is the mapping of keywords to IDs
     """
     
     # We The maximum number of API calls per minute is 2000 and each API call
-    # cannot exceed 100 tasks, hence why we need a list of dictionaries
-    post_data = dict()
+    # cannot exceed 100 tasks, hence why we need a list of batches
+    tasks = list()
     # The product data from the excel file, converted into pandas records format
     product_data, id_keyword = read_xlsx(file_name)
-    data_list = list()
+    only = None
+    if snapshot is not None:
+        diff = snapshot.diff(product_data)
+        print(diff)
+        only = diff.to_post
     for product in product_data:
-        if len(post_data) >= 100:
-            data_list.append(post_data.copy())
-            post_data = {}
+        if only is not None and normalize_keyword(str(product["Title"])) not in only:
+            continue
         if not product["Variant Barcode"] == '' and product["Variant Barcode"]:
-            post_data[len(post_data)] = dict(
-                location_name=PARAMETERS["location_name"],
-                language_name=PARAMETERS["language_name"],
-                priority=PARAMETERS["priority"],
-                sort_by=PARAMETERS["sort_by"],
-                # UPC isn't a good keyword
-                # keyword=str(product["Variant Barcode"]),
-                keyword=str(product["Title"]),
-                # price_min=PARAMETERS["price_min"]
-                # Minimum price to filter out bad results
-                price_min=PARAMETERS["price_min"]*product["Variant Price"]
-                # Add tag to identify task??
-                # tag=product["Variant Barcode"]
-            )
-    if len(post_data) > 0:
-        data_list.append(post_data)
-    return data_list, id_keyword
-
-
-def write_json_file(data_list: List[Dict[int, Dict]], file_name: str) -> None:
+            # Each product is posted once per market, the priority is the same in every market
+            priority = scheduler.priority_for(product, len(markets) if markets else 1) if scheduler else None
+            tasks.append(product_task(product, priority))
+    if markets:
+        tasks = expand_markets(tasks, markets)
+    return pack_batches(tasks), id_keyword
+
+
+def write_json_file(data_list: List[Batch], file_name: str) -> None:
     """ Write the data that is meant to be send via the POST request to the file
 
     Args:
-        data_list (List[Dict[int, Dict]]): The data to be sent with the call
+        data_list (List[Batch]): The data to be sent with the call
         file_name (str): Name of the file
     """
     new_data = dict()
     n_items = 0
-    for i in data_list:
-        for j in i:
-            new_data[n_items] = i[j]
+    for batch in data_list:
+        for task in batch.tasks:
+            new_data[n_items] = task
             n_items += 1
     with open(file_name, 'w+', encoding='utf-8') as file:
         json.dump(new_data, file, sort_keys=True, indent=4)
@@ -238,19 +427,55 @@ def write_json_file(data_list: List[Dict[int, Dict]], file_name: str) -> None:
 #         plt.show()
 
 
-def send_post(data_list: List[Dict[int, Dict]]) -> None:
+def send_post(data_list: List[Batch], scheduler: Optional[Scheduler] = None,
+              session: Optional[Session] = None) -> Set[str]:
     """ Sends the POST request to the DataForSEO server with the
     appropriate data and checks if the tasks were created properly.
     Args:
-        data_list (List[Dict[int, Dict]]): The data for the request.
+        data_list (List[Batch]): The batches of tasks, posted with their pre-serialized body.
+        scheduler (Optional[Scheduler]): Paces the requests and tracks their cost.
+        session (Optional[Session]): The session of the run, defaults to get_session(). If it
+                                     has a budget, the batches above its soft cap are posted
+                                     with normal priority and those above its hard cap are
+                                     saved to DEFERRED_FILE, as are the batches that
+                                     are left when its deadline passes.
+
+    Returns:
+        Set[str]: The keywords of the tasks that were created.
     """
-    client = connect()
+    session = session or get_session()
+    client = session.client
+    budget = session.budget
+    deadline = session.deadline
     response_list = list()
-    for dat in data_list:
-        res = client.post("/v3/merchant/google/products/task_post", dat)
+    created: Set[str] = set()
+    print(f"Estimated cost: {estimate_cost(data_list):.4f}")
+    deferred: List[Batch] = list()
+    if budget is not None:
+        data_list, deferred = budget.plan(data_list)
+    # Sleep for 50 milliseconds, or spread the requests up to the deadline of the scheduler
+    delay = scheduler.post_delay(len(data_list)) if scheduler else 0.05
+    for n, batch in enumerate(data_list):
+        if n > 0:
+            sleep(delay if deadline is None else deadline.timeout(delay))
+        if deadline is not None and deadline.expired():
+            print(f"Deadline of the run reached after {n} of {len(data_list)} batches")
+            deferred = data_list[n:] + deferred
+            break
+        if budget is not None:
+            # The actual costs of the previous posts may differ from the estimates
+            admitted = budget.admit(batch)
+            if admitted is None:
+                deferred = data_list[n:] + deferred
+                break
+            batch = admitted
+        res = client.post("/v3/merchant/google/" + batch.endpoint + "/task_post", batch.body)
         response_list.append(res)
-        # Sleep for 50 milliseconds
-        sleep(0.05)
+        if scheduler:
+            scheduler.record_post(res)
+    if deferred:
+        save_deferred(deferred)
+        print(f"{sum(len(b) for b in deferred)} tasks were saved to {DEFERRED_FILE} instead of being posted")
     with open("post_responses.json", 'a+', encoding="utf-8") as file:
         for i in range(len(response_list)):
             json.dump(response_list[i], file, indent=4)
@@ -262,110 +487,457 @@ def send_post(data_list: List[Dict[int, Dict]]) -> None:
             for task in response["tasks"]:
                 if task["status_code"] == TASK_CREATED_CODE:
                     write_id_to_file(task["id"])
+                    METRICS.inc("tasks_posted_total", endpoint="products")
+                    created.add((task.get("data") or {}).get("keyword"))
         else:
             print(f"Error. Code: {response['status_code']} Message: {response['status_message']}")
+    created.discard(None)
+    return created
 
 
-def get_task_by_ids(file_name: str = TASK_IDS_FILE) -> List[Dict[str, Union[str, int, List]]]:
+def get_task_by_ids(file_name: str = TASK_IDS_FILE, scheduler: Optional[Scheduler] = None,
+                    session: Optional[Session] = None) -> List[Dict[str, Union[str, int, List]]]:
     """ Reads the task ids from a file and sends a GET request to the DataForSEO
     API to get the results. The results are returned as a list of dictionaries,
     each dicionary with the same format.
     Args:
         file_name (str): The name of the file to read task ids from.
+        scheduler (Optional[Scheduler]): Records the latency of the finished tasks.
+        session (Optional[Session]): The session of the run, defaults to get_session()
 
     Returns:
         List[Dict[str, Union[str, int, List]]]: The list of result dictionaries
     """
-    client = connect()
-    results: List[Dict[str, Union[str, int, List]]] = list()
+    return list(iter_task_results(file_name, scheduler, session))
+
+
+def iter_task_results(file_name: str = TASK_IDS_FILE, scheduler: Optional[Scheduler] = None,
+                      session: Optional[Session] = None) -> Iterator[Dict[str, Union[str, int, List]]]:
+    """ Same as get_task_by_ids, but yields each response as soon as it is fetched so
+    that the caller does not need to hold all of them. The calls run on up to the
+    maximum concurrency of the session (see concurrency.py) and the responses are yielded
+    in the order of the ids. A call that fails with a connection error or a timeout, or
+    that is throttled, is retried after backing off, up to FETCH_ATTEMPTS times. Stops when the deadline of the
+    session passes, the ids that were not fetched can be fetched with a resumed run.
+    """
+    session = session or get_session()
+    client = session.client
+    if not os.path.isfile(file_name):
+        # No task was created, e.g. no product changed since the last run
+        print(f"No task ids in {file_name}")
+        return
     with open(file_name, 'r', encoding="utf-8") as file:
-        for line in file.readlines():
-            _id = line.strip()
+        ids = [line.strip() for line in file.readlines()]
+    # Failed calls of each id, the retried ids are appended to ids
+    attempts: Dict[str, int] = dict()
+    workers = session.concurrency.max_limit
+    with ThreadPoolExecutor(workers, thread_name_prefix="fetch") as pool:
+        # Bounds the responses held while an earlier one is still being fetched
+        pending: "deque[Tuple[str, Future]]" = deque()
+        submitted = 0
+        n = 0
+        while n < len(ids):
+            while submitted < len(ids) and len(pending) < 2 * workers:
+                _id = ids[submitted]
+                path = "/v3/merchant/google/products/task_get/advanced/" + _id
+                delay = retry_delay(attempts[_id]) if _id in attempts else 0
+                pending.append((_id, pool.submit(sleep_then, delay, client.get, path, deadline=session.deadline)))
+                submitted += 1
+            METRICS.set_gauge("queue_depth", len(ids) - n, stage="fetch")
+            _id, future = pending.popleft()
+            n += 1
             print(f"Reading and processing ID {_id}")
-            res = client.get("/v3/merchant/google/products/task_get/advanced/" + _id)
-            results.append(res)
-    return results
+            try:
+                res = future.result()
+            except DeadlineExceeded:
+                print(f"Deadline of the run reached, {len(ids) - n + 1} tasks were not fetched")
+                for _, other in pending:
+                    other.cancel()
+                break
+            except OSError as e:
+                METRICS.inc("fetch_errors_total", endpoint="products")
+                error = repr(e)
+            else:
+                if not is_throttled(0, res):
+                    error = None
+                else:
+                    # Not a result, it is neither written nor analyzed
+                    METRICS.inc("fetch_throttled_total", endpoint="products")
+                    error = f"Status code {res['status_code']}"
+            if error is not None:
+                attempts[_id] = attempts.get(_id, 0) + 1
+                if attempts[_id] < FETCH_ATTEMPTS:
+                    print(f"ERROR: {error} when fetching {_id}, retrying")
+                    ids.append(_id)
+                else:
+                    print(f"ERROR: {error} when fetching {_id}, left for a resumed run")
+                continue
+            METRICS.inc("tasks_fetched_total", endpoint="products")
+            if res.get("status_code") == SUCCESS_STATUS_CODE:
+                for task in res["tasks"]:
+                    if task["status_code"] == SUCCESS_STATUS_CODE:
+                        METRICS.inc("tasks_ready_total", endpoint="products")
+                        if scheduler:
+                            scheduler.record_ready(task["id"])
+            yield res
+    METRICS.set_gauge("queue_depth", 0, stage="fetch")
 
 
-def write_results_json(results: List[Dict[str, Union[str, int, List]]], file_name: str = RESULTS_FILE) -> None:
-    """ Writes the results json to a json file.
+def write_results_json(results: Iterable[Dict[str, Union[str, int, List]]], file_name: str = RESULTS_FILE,
+                       id_keyword: Optional[Dict[str, Tuple]] = None) -> None:
+    """ Writes the results json to a json file, and its index (see result_index.py).
 
     Args:
         file_name (str): The name of the json file.
-        results(List[Dict[str, Union[str, int, List]]]): The results obtained from the call
+        results(Iterable[Dict[str, Union[str, int, List]]]): The results obtained from the call,
+                                                              written as they are produced
+        id_keyword (Optional[Dict[str, Tuple]]): Mapping of keywords to (ID, price, SKU), see
+                                                 read_xlsx, to index the results by product ID.
+    """
+    with open(file_name, 'w+', encoding="utf-8", newline='') as file:
+        for _ in tee_results_json(results, file, id_keyword=id_keyword):
+            pass
+
+
+def tee_results_json(results: Iterable[Dict[str, Union[str, int, List]]], file: TextIO,
+                     index: bool = True, id_keyword: Optional[Dict[str, Tuple]] = None
+                     ) -> Iterator[Dict[str, Union[str, int, List]]]:
+    """ Writes each result to an open results file in the format of write_results_json
+    and yields it, so that the results can be saved and analyzed in a single pass.
+
+    Args:
+        results (Iterable[Dict[str, Union[str, int, List]]]): The results.
+        file (TextIO): The results file, opened empty and with newline='' so that the index
+                       has the offsets of the bytes that are written.
+        index (bool): Whether to write the index of the file once the results are written.
+        id_keyword (Optional[Dict[str, Tuple]]): See write_results_json.
     """
-    with open(file_name, 'w+', encoding="utf-8") as file:
+    writer = IndexWriter(file.name, id_keyword) if index else None
+    try:
         for result in results:
-            json.dump(result, file, indent=4)
+            # The text is ASCII (ensure_ascii) and its newlines are not translated (newline=''),
+            # so its length is its size in bytes
+            text = json.dumps(result, indent=4)
+            file.write(text)
+            if writer is not None:
+                writer.add(result, len(text))
+            yield result
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def read_results_json(file_name: str = RESULTS_FILE) -> List[Dict[str, Union[str, int, List]]]:
+    """ Reads the results written by write_results_json, which are JSON documents
+    written one after the other rather than a single JSON list.
+
+    Args:
+        file_name (str): The name of the json file.
+
+    Returns:
+        List[Dict[str, Union[str, int, List]]]: The results in the order they were written
+    """
+    return list(iter_results_json(file_name))
 
 
-def analyze_results(results: List[Dict[str, Union[str, int, List]]]) -> Dict[str, List[int]]:
+def iter_results_json(file_name: str = RESULTS_FILE,
+                      block_size: int = READ_BLOCK_SIZE) -> Iterator[Dict[str, Union[str, int, List]]]:
+    """ Yields the results of a file written by write_results_json one at a time,
+    reading the file in blocks instead of all at once.
+
+    Args:
+        file_name (str): The name of the json file.
+        block_size (int): Number of characters read at a time.
+    """
+    decoder = json.JSONDecoder()
+    with open(file_name, 'r', encoding="utf-8") as file:
+        text = ""
+        pos = 0
+        eof = False
+        while True:
+            match = NON_WHITESPACE.search(text, pos)
+            if match is None:
+                if eof:
+                    return
+                text, pos = file.read(block_size), 0
+                eof = not text
+                continue
+            try:
+                result, end = decoder.raw_decode(text, match.start())
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # The document continues in the next block
+                block = file.read(block_size)
+                eof = not block
+                text, pos = text[match.start():] + block, 0
+                continue
+            pos = end
+            yield result
+
+
+def build_matcher(id_keyword: Dict[str, Tuple]) -> TitleMatcher:
+    """ Returns the matcher that filters the offers of the keywords of read_xlsx.
+
+    Args:
+        id_keyword (Dict[str, Tuple]): Mapping of keywords to (ID, price, SKU), see read_xlsx.
+    """
+    return TitleMatcher(list(id_keyword), skus={k: v[2] for k, v in id_keyword.items() if len(v) > 2})
+
+
+def analyze_results(results: Iterable[Dict[str, Union[str, int, List]]],
+                    matcher: Optional[TitleMatcher] = None, chunk_size: int = ANALYZE_CHUNK_SIZE,
+                    max_offers: Optional[int] = None) -> Dict[str, List[Offer]]:
     """ Given the resultss, collect all the prices of all the products and group it together
 
+    The results are consumed one at a time (e.g. from iter_results_json or
+    iter_task_results) and each one is parsed into models.TaskResult, which only keeps
+    the fields of the items that are used, so the memory used depends on the number of
+    offers rather than on the size of the responses.
+
     Args:
-        results (List[Dict[str, Union[str, int, List]]]): The results obtained from the call
+        results (Iterable[Dict[str, Union[str, int, List]]]): The results obtained from the call
+        matcher (Optional[TitleMatcher]): Drops the offers whose title is not the product
+                                          of the keyword, all offers are kept if it is None
+        chunk_size (int): Number of offers matched at a time.
+        max_offers (Optional[int]): Keeps only the max_offers lowest prices of each product,
+                                    sorted by price, which bounds the memory used by the
+                                    aggregation to max_offers offers per product (and a
+                                    chunk of offers). The copies of a listing take one place.
 
     Returns:
-        Dict[str, List[int]]: The prices of the products, where the keys are the product names
-        and the value is the list of all the prices.
+        Dict[str, List[Offer]]: The prices of the products, where the keys are the product names
+        and the value is the list of all the offers.
     """
-    price_dict: Dict[str, List[Any]] = dict()
+    return aggregate_offers(iter_offers(results), matcher, chunk_size, max_offers)
+
+
+def iter_offers(results: Iterable[Dict[str, Union[str, int, List]]]) -> Iterator[Tuple[str, str, Offer]]:
+    """ Yields the (keyword, title, offer) of each item of the successful tasks of the results. """
     for r in results:
         if r["status_code"] != SUCCESS_STATUS_CODE:
             print(f"ERROR: Status code {r['status_code']} when trying to fetch results")
         else:
-           for t in r["tasks"]:
-               if t["status_code"] == SUCCESS_STATUS_CODE:
-                   keyword = t["data"]["keyword"]
-                   for data in t["result"]:
-                       for item in data["items"]:
-                            price = item["price"]
-                            url = item["url"]
-                            t = (price, url)
-                            if keyword not in price_dict:
-                                    price_dict[keyword] = [t]
-                            else:
-                                    price_dict[keyword].append(t)
+           for t in parse_response(r):
+               if t.ok:
+                   # Results posted before the keywords were normalized use the raw title
+                   keyword = normalize_keyword(t.task.keyword)
+                   for item in t.items:
+                        yield keyword, item.title or "", Offer.from_item(item)
+
+
+def aggregate_offers(offers: Iterable[Tuple[str, str, Offer]], matcher: Optional[TitleMatcher] = None,
+                     chunk_size: int = ANALYZE_CHUNK_SIZE, max_offers: Optional[int] = None) -> Dict[str, List[Offer]]:
+    """ Groups (keyword, title, offer) tuples by keyword, see analyze_results for the arguments. """
+    price_dict: Dict[str, List[Offer]] = dict()
+    # Per product with max_offers: a heap of (-price, sequence number, offer)
+    lowest: Dict[str, List[Tuple]] = dict()
+    # Per product with max_offers: the heap entry of each URL, a listing takes one place only
+    listings: Dict[str, Dict[str, Tuple]] = dict()
+    # (keyword, title, offer) of the current chunk
+    chunk: List[Tuple[str, str, Offer]] = list()
+    n_offers = 0
+    n_duplicates = 0
+
+    def add_chunk() -> None:
+        nonlocal chunk, n_offers, n_duplicates
+        if matcher is not None and chunk:
+            # The key is the keyword, or a tuple starting with it (see markets.iter_market_offers)
+            keywords = [o[0] if isinstance(o[0], str) else o[0][0] for o in chunk]
+            keep = matcher.matches(keywords, [o[1] for o in chunk])
+            METRICS.inc("offers_dropped_total", value=int(len(chunk) - keep.sum()))
+            chunk = [o for o, k in zip(chunk, keep) if k]
+        for keyword, _, offer in chunk:
+            if max_offers is not None:
+                heap = lowest.setdefault(keyword, [])
+                by_url = listings.setdefault(keyword, {})
+                # Offers without a price sort last
+                key = -offer.price if offer.price is not None else float("-inf")
+                n_offers += 1
+                entry = (key, n_offers, offer)
+                if offer.url is not None and offer.url in by_url:
+                    # Keeps the cheapest copy of the listing, like unique_offers
+                    n_duplicates += 1
+                    kept = by_url[offer.url]
+                    if key > kept[0]:
+                        heap[heap.index(kept)] = by_url[offer.url] = entry
+                        heapq.heapify(heap)
+                    continue
+                if len(heap) < max_offers:
+                    heapq.heappush(heap, entry)
+                elif key > heap[0][0]:
+                    dropped = heapq.heapreplace(heap, entry)
+                    by_url.pop(dropped[2].url, None)
+                else:
+                    continue
+                if offer.url is not None:
+                    by_url[offer.url] = entry
+                continue
+            _share_url(offer)
+            if keyword not in price_dict:
+                    price_dict[keyword] = [offer]
+            else:
+                    price_dict[keyword].append(offer)
+        chunk = list()
+
+    for offer in offers:
+        chunk.append(offer)
+        if len(chunk) >= chunk_size:
+            add_chunk()
+    add_chunk()
+    if n_duplicates:
+        METRICS.inc("offers_duplicate_total", value=n_duplicates)
+    for keyword, heap in lowest.items():
+        price_dict[keyword] = [_share_url(offer) for _, _, offer in sorted(heap, key=lambda e: (-e[0], e[1]))]
+    for keyword, keyword_offers in price_dict.items():
+        price_dict[keyword] = unique_offers(keyword_offers)
     return price_dict
 
 
-def write_output_csv(price_dict: Dict[str, List[int]], id_keyword: Dict[str, int]) -> None:
+def _share_url(offer: Offer) -> Offer:
+    """ Interns the URL of an offer that is kept, see urls.share_url. """
+    offer.url = share_url(offer.url)
+    return offer
+
+
+def unique_offers(offers: List[Offer]) -> List[Offer]:
+    """ Keeps the cheapest offer of each listing: the results repeat a listing with other
+    tracking parameters, which are the same URL once canonicalized (see urls.py).
+
+    Args:
+        offers (List[Offer]): The offers of a product.
+
+    Returns:
+        List[Offer]: The offers in the same order, without the more expensive copies of a URL.
+    """
+    first: Dict[str, int] = dict()
+    unique: List[Offer] = list()
+    for offer in offers:
+        i = first.get(offer.url) if offer.url is not None else None
+        if i is None:
+            if offer.url is not None:
+                first[offer.url] = len(unique)
+            unique.append(offer)
+        elif offer.price is not None and (unique[i].price is None or offer.price < unique[i].price):
+            unique[i] = offer
+    if len(unique) < len(offers):
+        METRICS.inc("offers_duplicate_total", value=len(offers) - len(unique))
+    return unique
+
+
+def iter_products(results: Iterable[Dict[str, Union[str, int, List]]],
+                  matcher: Optional[TitleMatcher] = None) -> Iterator[Tuple[str, List[Offer]]]:
+    """ Yields the keyword and offers of each successful task as soon as its response is
+    read, for writing the output while the results are fetched (see writers.write_products).
+    Unlike analyze_results, a keyword that was posted twice is yielded twice.
+
+    Args:
+        results (Iterable[Dict[str, Union[str, int, List]]]): The results obtained from the call
+        matcher (Optional[TitleMatcher]): Drops the offers whose title is not the product
+                                          of the keyword, all offers are kept if it is None
+    """
+    for r in results:
+        if r["status_code"] != SUCCESS_STATUS_CODE:
+            print(f"ERROR: Status code {r['status_code']} when trying to fetch results")
+            continue
+        for t in parse_response(r):
+            if t.ok:
+                keyword = normalize_keyword(t.task.keyword)
+                items = t.items
+                if matcher is not None and items:
+                    keep = matcher.matches([keyword] * len(items), [item.title or "" for item in items])
+                    METRICS.inc("offers_dropped_total", value=int(len(items) - keep.sum()))
+                    items = [item for item, k in zip(items, keep) if k]
+                yield keyword, unique_offers([Offer.from_item(item) for item in items])
+
+
+def analyze_markets(results: Iterable[Dict[str, Union[str, int, List]]],
+                    matcher: Optional[TitleMatcher] = None, chunk_size: int = ANALYZE_CHUNK_SIZE,
+                    max_offers: Optional[int] = None) -> Tuple[Dict[Market, Dict[str, List[Offer]]], Dict[str, List[Dict]]]:
+    """ Same as analyze_results for the results of a multi-market run.
+
+    Returns:
+        Tuple[Dict[Market, Dict[str, List[Offer]]], Dict[str, List[Dict]]]: The offers of
+        each keyword in each market, written per market by write_market_outputs, and the
+        comparison of the markets of each keyword (see markets.compare_markets).
+    """
+    market_prices = aggregate_offers(iter_market_offers(results), matcher, chunk_size, max_offers)
+    return split_markets(market_prices), compare_markets(market_prices)
+
+
+def write_output_csv(price_dict: Dict[str, List[Offer]], id_keyword: Dict[str, int]) -> None:
     """ This function writes the names, ids and the price listings to a csv file defined in the header
     under OUTPUT_FILE
 
     Args:
-        price_dict (Dict[str, List[int]]): The dictionary containing the keywords, i.e. names of products and lists of prices.
+        price_dict (Dict[str, List[Offer]]): The dictionary containing the keywords, i.e. names of products and lists of offers.
         id_keyword (Dict[str, int]): Mapping of keywords to ID numbers.
     """
-    
-    header = ['ID', 'Product Name', 'Current Price', 'Competitor Prices, URLs']
-    with open(OUTPUT_FILE, 'w+', encoding='utf-8') as f:
-        writer = csv.writer(f)
-        # write the header
-        writer.writerow(header)
-        
-        for p in price_dict:
-            row_data = []
-            p_id = id_keyword[p][0]
-            curr_price = -1
-            if p in id_keyword:
-                curr_price = id_keyword[p][1]
-            price_urls = []
-            
-            for i in price_dict[p]:
-                price = i[0]
-                url = i[1]
-                price_urls.append(price)
-                price_urls.append(url)
-            # prices = price_dict[p][0]
-            # urls = price_dict[p][1]
-            
-            row_data.append(p_id)
-            row_data.append(p)
-            row_data.append(curr_price)
-            row_data.extend(price_urls)
-            # write the data
-            writer.writerow(row_data)
+    write_outputs(price_dict.items(), id_keyword, export_files=[])
+
+
+def write_outputs(products: Iterable[Tuple[str, List[Offer]]], id_keyword: Dict[str, Tuple],
+                  export_files: Optional[List[str]] = None, market: Optional[Market] = None) -> None:
+    """ Writes OUTPUT_FILE and the exports while the products come, e.g. from iter_products.
+    Products whose keyword is not in id_keyword are written without ID and price.
+
+    Once the runs only post the changed products (there is a snapshot, see snapshot.py),
+    the products of id_keyword without new offers are written with their last offers,
+    kept in the offers file of the snapshot, so that the outputs still have every product.
+
+    Args:
+        products (Iterable[Tuple[str, List[Offer]]]): The keyword and offers of each product.
+        id_keyword (Dict[str, Tuple]): Mapping of keywords to (ID, price, SKU), see read_xlsx.
+        export_files (Optional[List[str]]): The exports, defaults to EXPORT_FILES.
+        market (Optional[Market]): The market of the offers of a multi-market run, the
+                                   output, exports and archive are then the files of the
+                                   market (see markets.market_file_name).
+    """
+    archive = offers_archive()
+    export_files = EXPORT_FILES if export_files is None else export_files
+    output_file = OUTPUT_FILE
+    if market is not None:
+        output_file = market_file_name(output_file, market)
+        export_files = [market_file_name(file_name, market) for file_name in export_files]
+        archive = market_file_name(archive, market) if archive is not None else None
+    writers = [CompetitorCsvWriter(output_file)]
+    written: Set[str] = set()
+    n_carried = 0
+    try:
+        for file_name in export_files:
+            writers.append(open_writer(file_name))
+        if archive is not None:
+            # Replaces the archive once the products are written, they are carried forward from it
+            writers.append(ArchiveWriter(archive + ".tmp"))
+            products = _remember(products, written)
+        n_products, n_unmatched = write_products(products, id_keyword, writers)
+        if archive is not None and os.path.isfile(archive):
+            carried = ((keyword, offers) for keyword, offers in read_offers(archive)
+                       if keyword in id_keyword and keyword not in written)
+            n_carried, _ = write_products(carried, id_keyword, writers)
+    finally:
+        for writer in writers:
+            writer.close()
+    if archive is not None:
+        os.replace(archive + ".tmp", archive)
+    if n_unmatched:
+        print(f"{n_unmatched} of {n_products} products are not in the product data")
+    if n_carried:
+        print(f"{n_carried} products without new results were written with their last offers")
+
+
+def write_market_outputs(market_offers: Dict[Market, Dict[str, List[Offer]]], id_keyword: Dict[str, Tuple],
+                         export_files: Optional[List[str]] = None) -> None:
+    """ Writes the outputs of each market of the result of analyze_markets, see write_outputs. """
+    for market, price_dict in market_offers.items():
+        write_outputs(price_dict.items(), id_keyword, export_files, market)
+        print(f"Wrote the output of {market} to {market_file_name(OUTPUT_FILE, market)}")
+
+
+def _remember(products: Iterable[Tuple[str, List[Offer]]], keywords: Set[str]) -> Iterator[Tuple[str, List[Offer]]]:
+    for keyword, offers in products:
+        keywords.add(keyword)
+        yield keyword, offers
 
 
 def cleanup() -> None:
@@ -389,6 +961,13 @@ def cleanup() -> None:
         except OSError as file_e:
             print(f"Error: {file_e.filename} - {file_e.strerror}.")
     
+    # Remove the index of the results, see result_index.py
+    if os.path.isfile(index_name(RESULTS_FILE)):
+        try:
+            os.remove(index_name(RESULTS_FILE))
+        except OSError as file_e:
+            print(f"Error: {file_e.filename} - {file_e.strerror}.")
+
     # Remove the output file with all the prices
     # if os.path.isfile(OUTPUT_FILE):
     #     print(f"Removing file {OUTPUT_FILE}")
@@ -398,6 +977,90 @@ def cleanup() -> None:
     #         print(f"Error: {file_e.filename} - {file_e.strerror}.")
 
 
+def default_scheduler() -> Scheduler:
+    """ Returns the scheduler used for posting tasks, see scheduler_from_config: by default
+    products whose price changed since the last run get high priority and the others the
+    configured priority, or normal priority.
+    """
+    return scheduler_from_config(SCHEDULER, OUTPUT_FILE, CONFIGURED_PRIORITY)
+
+
+def offers_archive() -> Optional[str]:
+    """ Returns the offers file of the snapshot, None if the runs do not use a snapshot. """
+    if not os.path.isfile(SNAPSHOT.get("file", SNAPSHOT_FILE)):
+        return None
+    return SNAPSHOT.get("offers", OFFERS_FILE)
+
+
+def snapshot_store() -> SnapshotStore:
+    """ Returns the snapshot of the catalog of the "snapshot" table of the config file. """
+    return SnapshotStore(SNAPSHOT.get("file", SNAPSHOT_FILE), SNAPSHOT.get("max_age", MAX_AGE))
+
+
+def run_pipeline(data_file: Optional[str] = None, resume: bool = False,
+                 session: Optional[Session] = None, markets: Optional[List[Market]] = None,
+                 changed: bool = False) -> None:
+    """ Runs the whole pipeline: creates and posts the tasks, waits for them, fetches the
+    results and writes the output file.
+
+    Args:
+        data_file (Optional[str]): The xlsx data file, defaults to DATA_FILE.
+        resume (bool): Only fetch the results of the task ids of a previous call.
+        session (Optional[Session]): The session of the run, a new one is opened and
+                                     closed at the end if it is None.
+        markets (Optional[List[Market]]): The markets of the run, defaults to MARKETS.
+                                          The offers of each market are written to its
+                                          own output files and the comparison of the
+                                          markets to MARKETS_OUTPUT_FILE.
+        changed (bool): Only post the products that changed since the last run, see snapshot.py.
+    """
+    if session is None:
+        with open_session() as session:
+            run_pipeline(data_file, resume, session, markets, changed)
+        return
+    data_file = data_file or DATA_FILE
+    markets = markets or MARKETS
+    if markets:
+        markets = validate_markets(markets, get_locations(session), get_languages(session))
+    sched = None if resume else default_scheduler()
+    store = snapshot_store() if changed and not resume else None
+    with METRICS.stage("read"):
+        d, id_kw = set_task(data_file, sched, markets, store)
+    if not resume:
+        # print(len(d))
+        # write_json_file(d, 'task_data.txt')
+        with METRICS.stage("post"):
+            created = send_post(d, sched, session)
+        if store is not None:
+            store.commit(created)
+        print(f"Task IDs written to file {TASK_IDS_FILE}")
+        print("Sent the data to DataForSEO")
+        print("Waiting for tasks to finish")
+        wait_time = sched.wait_time(TASK_WAIT)
+        if session.deadline is not None:
+            wait_time = session.deadline.timeout(wait_time)
+        sleep(wait_time)
+    # The responses are written and analyzed as they are fetched instead of being kept
+    with METRICS.stage("fetch"), open(RESULTS_FILE, 'w+', encoding="utf-8", newline='') as results_file:
+        res = tee_results_json(iter_task_results(TASK_IDS_FILE, sched, session), results_file, id_keyword=id_kw)
+        if markets:
+            market_offers, comparison = analyze_markets(res, build_matcher(id_kw))
+        else:
+            # Each product is written as soon as its results are fetched
+            write_outputs(iter_products(res, build_matcher(id_kw)), id_kw)
+    if markets:
+        with METRICS.stage("write_output"):
+            write_market_outputs(market_offers, id_kw)
+            write_market_csv(comparison, id_kw)
+        print(f"Wrote the market comparison to {MARKETS_OUTPUT_FILE}")
+    else:
+        print(f"Wrote the output to {OUTPUT_FILE}")
+    if sched:
+        sched.print_report()
+    if session.budget is not None:
+        session.budget.print_report()
+
+
 if __name__ == '__main__':
     
     print("------------------------------------------------------")
@@ -421,26 +1084,9 @@ if __name__ == '__main__':
         else:
             DATA_FILE = f_name
 
-        d, id_kw = set_task(DATA_FILE)
-        # print(len(d))
-        # write_json_file(d, 'task_data.txt')
-        send_post(d)
-        print(f"Task IDs written to file {TASK_IDS_FILE}")
-        print("Sent the data to DataForSEO")
-        print("Waiting for tasks to finish")
-        sleep(TASK_WAIT)
-        res = get_task_by_ids()
-        write_results_json(res, RESULTS_FILE)
-        p_dict = analyze_results(res)
-        write_output_csv(p_dict, id_kw)
-        print(f"Wrote the output to {OUTPUT_FILE}")
+        run_pipeline(DATA_FILE)
         
     elif read_from_id == "Y":
         
         print(f"Reading IDs from {TASK_IDS_FILE}")
-        d, id_kw = set_task(DATA_FILE)
-        res = get_task_by_ids()
-        write_results_json(res, RESULTS_FILE)
-        p_dict = analyze_results(res)
-        write_output_csv(p_dict, id_kw)
-        print(f"Wrote the output to {OUTPUT_FILE}")
\ No newline at end of file
+        run_pipeline(DATA_FILE, resume=True)
\ No newline at end of file
@@ -1,13 +1,27 @@
-from client import RestClient
+from concurrent.futures import ThreadPoolExecutor
+import json
+from drain import Drainer
+from ledger import Ledger
+from result_index import ResultIndex
+from task_post import open_session, RESULTS_FILE
 
-client = RestClient("login", "password")
-
-# using this method you can get a list of completed tasks
-# GET /v3/merchant/google/products/tasks_ready
-response = client.get("/v3/merchant/google/products/tasks_ready")
-# you can find the full list of the response codes here https://docs.dataforseo.com/v3/appendix/errors
-if response["status_code"] == 20000:
-    print(response)
-    # do something with result
-else:
-    print("error. Code: %d Message: %s" % (response["status_code"], response["status_message"]))
\ No newline at end of file
+if __name__ == '__main__':
+    # using this method you can get a list of completed tasks
+    # GET /v3/merchant/google/$endpoint/tasks_ready
+    # every ready task of the merchant endpoints is fetched with
+    # GET /v3/merchant/google/$endpoint/task_get/advanced/$id
+    # until the ready lists are empty, the ledger and the index of RESULTS_FILE skip tasks
+    # that were already fetched, each response is appended to RESULTS_FILE as soon as it is
+    # fetched (newline='' keeps the offsets of the index in bytes) and indexed at the end
+    ledger = Ledger()
+    try:
+        with open(RESULTS_FILE, 'a', encoding="utf-8", newline='') as results_file, \
+                ResultIndex(RESULTS_FILE) as index, open_session() as session, ThreadPoolExecutor(8) as pool:
+            drainer = Drainer(session.client, ledger, pool,
+                              lambda endpoint, _id, res: results_file.write(json.dumps(res, indent=4)),
+                              metrics=session.metrics, fetched=index.contains)
+            print(f"Fetched {drainer.drain()} tasks")
+    finally:
+        ledger.close()
+    with ResultIndex(RESULTS_FILE) as index:
+        print(f"Indexed the results in {index.index_file}")
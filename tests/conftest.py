@@ -0,0 +1,24 @@
+"""
+Shared helpers of the tests. The modules of the pipeline are at the root of the
+repository, which is put first on the path so that they import as in the scripts.
+"""
+from typing import Dict, List, Optional, Sequence, Tuple
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def make_response(tasks: Sequence[Tuple[str, str, List[Dict]]]) -> Dict:
+    """ Returns a task_get response with a products task for each (id, keyword, items). """
+    return dict(status_code=20000, status_message="Ok.", tasks=[
+        dict(id=task_id, status_code=20000, status_message="Ok.", cost=0.001,
+             data=dict(keyword=keyword, location_name="United States", language_name="English"),
+             result=[dict(items=items)])
+        for task_id, keyword, items in tasks])
+
+
+def make_item(title: str, price: Optional[float], url: Optional[str] = None, seller: str = "Shop",
+              domain: Optional[str] = None) -> Dict:
+    return dict(type="google_shopping_serp", title=title, price=price, currency="USD", url=url,
+                domain=domain, seller=seller, rank_group=1)
@@ -0,0 +1,167 @@
+"""
+In-memory stand-in for a Redis server, speaking enough of its protocol (RESP2) for
+jobqueue.RedisQueue: hashes, sets, sorted sets, SET with NX/PX and MULTI/EXEC.
+
+Example:
+    with RespServer() as server:
+        queue = RedisQueue(RespConnection("127.0.0.1", server.port))
+"""
+from socketserver import StreamRequestHandler, ThreadingTCPServer
+from threading import Lock, Thread
+import time
+
+
+class RespHandler(StreamRequestHandler):
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = list()
+        for _ in range(int(line[1:-2])):
+            size = int(self.rfile.readline()[1:-2])
+            args.append(self.rfile.read(size + 2)[:-2].decode("utf-8"))
+        return args
+
+    def handle(self) -> None:
+        store: RespServer = self.server.store
+        queued = None
+        while True:
+            args = self._read_command()
+            if args is None:
+                return
+            name = args[0].upper()
+            if name == "MULTI":
+                queued = list()
+                self.wfile.write(b"+OK\r\n")
+            elif name == "EXEC":
+                with store.lock:
+                    replies = [store.execute(command) for command in queued]
+                queued = None
+                self.wfile.write(b"*%d\r\n" % len(replies) + b"".join(encode(reply) for reply in replies))
+            elif queued is not None:
+                queued.append(args)
+                self.wfile.write(b"+QUEUED\r\n")
+            else:
+                with store.lock:
+                    reply = store.execute(args)
+                self.wfile.write(encode(reply))
+
+
+def encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, bool):
+        reply = int(reply)
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, Exception):
+        return b"-ERR %s\r\n" % str(reply).encode("utf-8")
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(encode(item) for item in reply)
+    if reply == "OK":
+        return b"+OK\r\n"
+    data = str(reply).encode("utf-8")
+    return b"$%d\r\n%s\r\n" % (len(data), data)
+
+
+class RespServer:
+    """ Runs the server in a background thread on a free local port. """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.data = dict()
+        # Expiry times of the keys set with PX
+        self.expires = dict()
+        self.server = ThreadingTCPServer(("127.0.0.1", 0), RespHandler)
+        self.server.daemon_threads = True
+        self.server.store = self
+        self.port = self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+
+    def _get(self, key, default=None):
+        if key in self.expires and self.expires[key] <= time.time():
+            del self.expires[key]
+            self.data.pop(key, None)
+        if key not in self.data and default is not None:
+            self.data[key] = default
+        return self.data.get(key)
+
+    def execute(self, args):
+        name, key, rest = args[0].upper(), args[1] if len(args) > 1 else None, args[2:]
+        if name in ("AUTH", "SELECT"):
+            return "OK"
+        if name == "SET":
+            options = [option.upper() for option in rest[1:]]
+            if "NX" in options and self._get(key) is not None:
+                return None
+            self.data[key] = rest[0]
+            if "PX" in options:
+                self.expires[key] = time.time() + int(rest[1:][options.index("PX") + 1]) / 1000
+            return "OK"
+        if name == "HSETNX":
+            hash_ = self._get(key, dict())
+            if rest[0] in hash_:
+                return 0
+            hash_[rest[0]] = rest[1]
+            return 1
+        if name == "HSET":
+            hash_ = self._get(key, dict())
+            new = sum(field not in hash_ for field in rest[::2])
+            hash_.update(zip(rest[::2], rest[1::2]))
+            return new
+        if name == "HMGET":
+            hash_ = self._get(key) or dict()
+            return [hash_.get(field) for field in rest]
+        if name == "HINCRBY":
+            hash_ = self._get(key, dict())
+            hash_[rest[0]] = str(int(hash_.get(rest[0], 0)) + int(rest[1]))
+            return int(hash_[rest[0]])
+        if name == "SADD":
+            members = self._get(key, set())
+            new = len(set(rest) - members)
+            members.update(rest)
+            return new
+        if name == "SCARD":
+            return len(self._get(key) or ())
+        if name == "SMEMBERS":
+            return sorted(self._get(key) or ())
+        if name == "ZADD":
+            scores = self._get(key, dict())
+            options = list()
+            while rest[0].upper() in ("XX", "NX", "CH"):
+                options.append(rest[0].upper())
+                rest = rest[1:]
+            changed = 0
+            for score, member in zip(rest[::2], rest[1::2]):
+                if "XX" in options and member not in scores:
+                    continue
+                if "NX" in options and member in scores:
+                    continue
+                changed += member not in scores or ("CH" in options and scores[member] != float(score))
+                scores[member] = float(score)
+            return changed
+        if name == "ZREM":
+            scores = self._get(key) or dict()
+            return sum(scores.pop(member, None) is not None for member in rest)
+        if name == "ZRANGEBYSCORE":
+            scores = self._get(key) or dict()
+            low, high = (float(bound) for bound in rest[:2])
+            members = sorted((score, member) for member, score in scores.items() if low <= score <= high)
+            options = [option.upper() for option in rest[2:]]
+            if "LIMIT" in options:
+                i = options.index("LIMIT")
+                offset, count = int(rest[2 + i + 1]), int(rest[2 + i + 2])
+                members = members[offset:offset + count]
+            if "WITHSCORES" in options:
+                return [item for score, member in members for item in (member, repr(score))]
+            return [member for _, member in members]
+        return RuntimeError(f"unknown command '{name}'")
+
+    def __enter__(self) -> "RespServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor
+import threading
+
+from ad_url import AD_URL_PATH, AdUrlResolver, ad_tokens, resolve_ad_urls
+from conftest import make_item, make_response
+from metrics import Metrics
+
+
+class FakeClient:
+    """ Answers the ad_url calls with the URL of the token, after release is set. """
+
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        token = path[len(AD_URL_PATH):]
+        with self._lock:
+            self.calls.append(token)
+        self.release.wait(5)
+        if self.fail:
+            return dict(status_code=40000, status_message="Error.", tasks=[])
+        return dict(status_code=20000, status_message="Ok.", tasks=[
+            dict(status_code=20000, status_message="Ok.", result=[dict(ad_url=f"https://ads.com/{token}")])])
+
+
+def ad_item(token, url=None):
+    return dict(make_item("Reel", 10.0, url=url), shop_ad_aclk=token)
+
+
+def test_ad_tokens():
+    task = make_response([("1", "Reel", [ad_item("a"), ad_item("b", "https://b.com"), ad_item("a"),
+                                         make_item("Reel", 10.0)])])["tasks"][0]
+    assert ad_tokens(task) == ["a", "b"]
+    assert ad_tokens(task, without_url=True) == ["a"]
+
+
+def test_concurrent_lookups_share_a_call():
+    client = FakeClient()
+    client.release.clear()
+    resolver = AdUrlResolver(client, cache_file=None)
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(resolver.resolve, "a") for _ in range(4)]
+        while resolver.coalesced < 3:
+            threading.Event().wait(0.01)
+        client.release.set()
+        urls = [f.result() for f in futures]
+    assert urls == ["https://ads.com/a"] * 4
+    assert client.calls == ["a"]
+    assert (resolver.misses, resolver.coalesced) == (1, 3)
+
+
+def test_hit_rate():
+    client = FakeClient()
+    metrics = Metrics()
+    resolver = AdUrlResolver(client, cache_file=None, metrics=metrics)
+    assert resolver.resolve_many(["a", "b", "a"]) == {"a": "https://ads.com/a", "b": "https://ads.com/b"}
+    resolver.resolve_many(["a", "b", "c", "d"])
+    assert sorted(client.calls) == ["a", "b", "c", "d"]
+    assert resolver.hit_rate() == 2 / 6
+    assert metrics.total("ad_url_lookups_total", result="hit") == 2
+    assert metrics.total("ad_url_lookups_total", result="miss") == 4
+
+
+def test_failed_lookups_are_not_cached():
+    client = FakeClient(fail=True)
+    resolver = AdUrlResolver(client, cache_file=None)
+    assert resolver.resolve("a") is None
+    assert resolver.resolve("a") is None
+    assert client.calls == ["a", "a"]
+
+
+def test_lru_reads_through_to_the_file(tmp_path):
+    client = FakeClient()
+    resolver = AdUrlResolver(client, cache_file=str(tmp_path / "ad_urls.db"), lru_size=2)
+    resolver.resolve_many(["a", "b", "c"])
+    assert len(resolver._lru) == 2
+    assert resolver.resolve("a") == "https://ads.com/a"
+    assert len(client.calls) == 3
+    assert resolver.hits == 1
+    resolver.close()
+
+
+def test_save_and_load(tmp_path):
+    cache_file = str(tmp_path / "ad_urls.db")
+    resolver = AdUrlResolver(FakeClient(), cache_file=cache_file)
+    resolver.resolve_many(["a", "b"])
+    resolver.close()
+
+    client = FakeClient(fail=True)
+    resolver = AdUrlResolver(client, cache_file=cache_file)
+    assert resolver.resolve_many(["a", "b", "c"]) == {"a": "https://ads.com/a", "b": "https://ads.com/b",
+                                                      "c": None}
+    assert client.calls == ["c"]
+    resolver.close()
+
+
+def test_resolve_ad_urls():
+    response = make_response([("1", "Reel", [ad_item("a"), ad_item("b", "https://b.com"),
+                                             make_item("Reel", 10.0)])])
+    resolver = AdUrlResolver(FakeClient(), cache_file=None)
+    items = next(resolve_ad_urls([response], resolver))["tasks"][0]["result"][0]["items"]
+    assert [item["url"] for item in items] == ["https://ads.com/a", "https://b.com", None]
@@ -0,0 +1,76 @@
+import tracemalloc
+
+import urls
+from conftest import make_item, make_response
+from models import Offer
+from task_post import aggregate_offers, analyze_results
+
+
+KEYWORDS = ["Reel A", "Reel B", "Reel C"]
+
+# Items of each response
+ITEMS = 100
+
+
+def responses(n):
+    """ Yields n responses of ITEMS offers for each keyword, with distinct URLs and prices. """
+    for i in range(n):
+        yield make_response([
+            (f"task-{i}-{keyword}", keyword,
+             [make_item(keyword, float((i * ITEMS + j) * 7919 % 100003), f"https://shop{j}.com/{keyword}/{i}")
+              for j in range(ITEMS)])
+            for keyword in KEYWORDS])
+
+
+def offers(prices, keyword="Reel A"):
+    return [(keyword, keyword, Offer(price, url)) for price, url in prices]
+
+
+def test_max_offers_keeps_the_lowest_prices():
+    price_dict = aggregate_offers(offers([(5.0, "a"), (None, "b"), (3.0, "c"), (4.0, "d"), (1.0, "e")]),
+                                  max_offers=3)
+    assert [o.price for o in price_dict["Reel A"]] == [1.0, 3.0, 4.0]
+
+
+def test_offers_without_a_price_sort_last():
+    price_dict = aggregate_offers(offers([(None, "a"), (2.0, "b")]), max_offers=3)
+    assert [o.price for o in price_dict["Reel A"]] == [2.0, None]
+
+
+def test_copies_of_a_listing_take_one_place():
+    price_dict = aggregate_offers(offers([(1.0, "a"), (0.5, "a"), (2.0, "b"), (3.0, "c"), (0.7, "a")]),
+                                  max_offers=3)
+    assert [(o.price, o.url) for o in price_dict["Reel A"]] == [(0.5, "a"), (2.0, "b"), (3.0, "c")]
+
+
+def test_without_max_offers_every_listing_is_kept():
+    price_dict = aggregate_offers(offers([(1.0, "a"), (0.5, "a"), (2.0, "b")]))
+    assert [(o.price, o.url) for o in price_dict["Reel A"]] == [(0.5, "a"), (2.0, "b")]
+
+
+def test_analyze_results_groups_by_keyword():
+    price_dict = analyze_results(responses(2), max_offers=10)
+    assert sorted(price_dict) == KEYWORDS
+    for keyword_offers in price_dict.values():
+        prices = [o.price for o in keyword_offers]
+        assert len(prices) == 10 and prices == sorted(prices)
+
+
+def peak_memory(n_responses, max_offers):
+    urls.reset_urls()
+    tracemalloc.start()
+    try:
+        price_dict = analyze_results(responses(n_responses), chunk_size=1000, max_offers=max_offers)
+        return tracemalloc.get_traced_memory()[1], price_dict
+    finally:
+        tracemalloc.stop()
+
+
+def test_max_offers_bounds_the_memory_of_the_aggregation():
+    small, _ = peak_memory(10, max_offers=5)
+    large, price_dict = peak_memory(100, max_offers=5)
+    # Ten times the offers, the peak is a response and a chunk of offers either way
+    assert large < 1.5 * small
+    assert all(len(keyword_offers) == 5 for keyword_offers in price_dict.values())
+    # Only the URLs of the offers that are kept are interned
+    assert len(urls.URLS) == 5 * len(KEYWORDS)
@@ -0,0 +1,52 @@
+import json
+
+from batching import pack_batches
+
+
+def tasks(n, priority=None, size=10):
+    return [dict(keyword="k" * size + str(i), priority=priority) for i in range(n)]
+
+
+def test_batches_hold_at_most_max_tasks():
+    batches = pack_batches(tasks(250), max_tasks=100)
+    assert [len(b) for b in batches] == [100, 100, 50]
+    assert [t["keyword"] for b in batches for t in b.tasks] == [t["keyword"] for t in tasks(250)]
+
+
+def test_body_is_the_json_of_the_tasks():
+    batch, = pack_batches(tasks(3), endpoint="sellers")
+    assert batch.endpoint == "sellers"
+    assert json.loads(batch.body) == batch.tasks
+
+
+def test_batches_stay_under_max_bytes():
+    all_tasks = tasks(20, size=100)
+    max_bytes = 600
+    batches = pack_batches(all_tasks, max_bytes=max_bytes)
+    assert len(batches) > 1
+    assert all(len(b.body) <= max_bytes for b in batches)
+    assert sum(len(b) for b in batches) == len(all_tasks)
+
+
+def test_task_larger_than_max_bytes_gets_its_own_batch():
+    batches = pack_batches(tasks(1, size=1000) + tasks(2), max_bytes=200)
+    assert [len(b) for b in batches] == [1, 2]
+
+
+def test_batches_are_grouped_by_priority():
+    batches = pack_batches(tasks(3, priority=1) + tasks(2, priority=2) + tasks(1, priority=1))
+    assert {b.priority: len(b) for b in batches} == {1: 4, 2: 2}
+    assert batches[0].priority == 2
+
+
+def test_configured_limits(monkeypatch):
+    import batching
+    import task_post
+    monkeypatch.setattr(batching, "MAX_TASKS_PER_POST", batching.MAX_TASKS_PER_POST)
+    monkeypatch.setattr(batching, "MAX_BODY_BYTES", batching.MAX_BODY_BYTES)
+    monkeypatch.setattr(task_post, "PARAMETERS", dict(task_post.PARAMETERS))
+    task_post.configure({"run": {"max_tasks_per_post": 10, "max_body_bytes": 600}})
+    assert [len(b) for b in pack_batches(tasks(25))] == [10, 10, 5]
+    batches = pack_batches(tasks(20, size=100))
+    assert len(batches) > 2
+    assert all(len(b.body) <= 600 for b in batches)
@@ -0,0 +1,103 @@
+import pytest
+
+import budget as budget_module
+from batching import pack_batches
+from budget import HARD, OK, SOFT, Budget, load_deferred, save_deferred
+from ledger import Ledger
+from metrics import Metrics
+from scheduler import HIGH_PRIORITY, NORMAL_PRIORITY, TASK_COST
+
+
+def batches(n_tasks, priority=NORMAL_PRIORITY, max_tasks=10):
+    tasks = [dict(keyword=f"reel {i}", priority=priority) for i in range(n_tasks)]
+    return pack_batches(tasks, max_tasks=max_tasks)
+
+
+@pytest.fixture
+def ledger():
+    ledger = Ledger(":memory:", run_id="run")
+    yield ledger
+    ledger.close()
+
+
+def test_state_of_the_caps():
+    budget = Budget(run_cap=1.0, soft_fraction=0.8)
+    assert budget.state() == OK
+    budget.add("products/task_post", 0.85)
+    assert budget.state() == SOFT
+    assert budget.state(extra=0.2) == HARD
+    assert budget.remaining() == pytest.approx(0.15)
+
+
+def test_admit_degrades_above_the_soft_cap():
+    budget = Budget(run_cap=1.0, soft_fraction=0.5)
+    batch, = batches(10, HIGH_PRIORITY)
+    assert budget.admit(batch) is batch
+    budget.add("products/task_post", 0.49)
+    admitted = budget.admit(batch)
+    assert admitted.priority == NORMAL_PRIORITY
+    assert [t["keyword"] for t in admitted.tasks] == [t["keyword"] for t in batch.tasks]
+    budget.add("products/task_post", 0.6)
+    assert budget.admit(batch) is None
+
+
+def test_plan_defers_the_batches_over_the_hard_cap():
+    budget = Budget(run_cap=TASK_COST[NORMAL_PRIORITY] * 25)
+    admitted, deferred = budget.plan(batches(40))
+    assert [len(b) for b in admitted] == [10, 10]
+    assert [len(b) for b in deferred] == [10, 10]
+
+
+def test_plan_degrades_above_the_soft_cap():
+    budget = Budget(run_cap=TASK_COST[HIGH_PRIORITY] * 20, soft_fraction=0.5)
+    admitted, deferred = budget.plan(batches(20, HIGH_PRIORITY))
+    assert [b.priority for b in admitted] == [NORMAL_PRIORITY, NORMAL_PRIORITY]
+    assert not deferred
+
+
+def test_spend_is_seen_through_the_metrics():
+    budget = Budget(run_cap=1.0)
+    metrics = Metrics()
+    metrics.add_hook(budget)
+    metrics.inc("api_status_total", endpoint="products/task_post", status=20000)
+    metrics.inc("api_cost_total", 0.25, endpoint="products/task_post")
+    assert budget.run_spent == pytest.approx(0.25)
+    assert budget.report()["by_endpoint"] == {"products/task_post": dict(cost=0.25, calls=1)}
+
+
+def test_daily_spend_includes_the_other_runs(ledger):
+    ledger.add_spend(budget_module.today(), {"products/task_post": (0.5, 3)})
+    budget = Budget(Ledger(":memory:"), daily_cap=1.0)
+    assert budget.spent_today() == 0.0
+    budget = Budget(ledger, daily_cap=1.0)
+    budget.add("products/task_post", 0.25)
+    assert budget.spent_today() == pytest.approx(0.75)
+    budget.flush()
+    assert ledger.spent(budget_module.today())["products/task_post"] == pytest.approx((0.75, 4))
+
+
+def test_day_rollover(ledger, monkeypatch):
+    monkeypatch.setattr(budget_module, "today", lambda: "2026-01-01")
+    ledger.add_spend("2026-01-01", {"products/task_post": (0.5, 1)})
+    budget = Budget(ledger, daily_cap=1.0, run_cap=10.0)
+    budget.add("products/task_post", 0.25)
+    assert budget.spent_today() == pytest.approx(0.75)
+
+    ledger.add_spend("2026-01-02", {"products/task_get": (0.125, 1)})
+    monkeypatch.setattr(budget_module, "today", lambda: "2026-01-02")
+    budget.add("products/task_post", 0.0625)
+    # Yesterday's spend of this run and of the other runs no longer counts
+    assert budget.day == "2026-01-02"
+    assert budget.spent_today() == pytest.approx(0.125 + 0.0625)
+    assert budget.run_spent == pytest.approx(0.3125)
+    budget.flush()
+    assert ledger.spent("2026-01-01")["products/task_post"][0] == pytest.approx(0.75)
+    assert ledger.spent("2026-01-02", run_only=True)["products/task_post"][0] == pytest.approx(0.0625)
+
+
+def test_deferred_round_trip(tmp_path):
+    file_name = str(tmp_path / "deferred.json")
+    save_deferred(batches(15), file_name)
+    loaded = load_deferred(file_name)
+    assert sum(len(b) for b in loaded) == 15
+    assert loaded[0].tasks[0] == dict(keyword="reel 0", priority=NORMAL_PRIORITY)
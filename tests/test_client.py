@@ -0,0 +1,90 @@
+from concurrent.futures import ALL_COMPLETED, FIRST_COMPLETED, wait
+
+import pytest
+
+import client
+from client import Deadline, DeadlineExceeded, LatencyWindow, RestClient
+from metrics import Metrics
+from stub_server import StubServer, STUB_RESPONSE
+
+
+PATH = "/v3/merchant/google/products/task_get/advanced/1"
+
+
+def stub(**kwargs):
+    kwargs.setdefault("slow_fraction", 0)
+    kwargs.setdefault("fast_latency", 0.002)
+    return StubServer(seed=1, **kwargs)
+
+
+def test_get_through_a_kept_alive_connection():
+    with stub() as server:
+        rest = RestClient("login", "password", domain=server.address, secure=False, keep_alive=True)
+        assert rest.get(PATH) == STUB_RESPONSE
+        assert rest.get(PATH) == STUB_RESPONSE
+        assert len(rest._connections) == 1
+        rest.close()
+    assert server.calls == 2
+
+
+def test_read_timeout():
+    with stub(slow_fraction=1, slow_latency=0.5) as server:
+        rest = RestClient("login", "password", domain=server.address, secure=False, read_timeout=0.05)
+        with pytest.raises(TimeoutError):
+            rest.get(PATH)
+
+
+def test_no_call_starts_after_the_deadline():
+    with stub() as server:
+        rest = RestClient("login", "password", domain=server.address, secure=False, deadline=Deadline(0))
+        with pytest.raises(DeadlineExceeded):
+            rest.get(PATH)
+    assert server.calls == 0
+
+
+def test_latency_quantile_needs_samples():
+    window = LatencyWindow()
+    assert window.quantile("e", 0.5, min_samples=3) is None
+    for latency in (0.3, 0.1, 0.2):
+        window.add("e", latency)
+    assert window.quantile("e", 0.5, min_samples=3) == 0.2
+
+
+def primed_client(server, metrics):
+    rest = RestClient("login", "password", domain=server.address, secure=False, hedge=True, metrics=metrics)
+    for _ in range(client.MIN_LATENCY_SAMPLES):
+        rest.get(PATH)
+    return rest
+
+
+def test_slow_call_is_hedged():
+    metrics = Metrics()
+    with stub(slow_latency=0.5) as server:
+        rest = primed_client(server, metrics)
+        server.slow_fraction = 1
+        # The first copy is slow, the second one is sent after the usual latency and answers first
+        server.latency = iter([0.5, 0.002]).__next__
+        assert rest.get(PATH) == STUB_RESPONSE
+        rest.close()
+    assert metrics.total("request_hedges_total", endpoint=client.endpoint_name(PATH)) == 1
+    assert metrics.total("request_hedge_wins_total", endpoint=client.endpoint_name(PATH)) == 1
+
+
+def test_failed_copy_does_not_hide_the_answer_of_the_other(monkeypatch):
+    # Both copies are done when the client looks at them, the first one failed
+    monkeypatch.setattr(client, "wait", lambda futures, timeout=None, return_when=ALL_COMPLETED: wait(
+        futures, timeout, ALL_COMPLETED if return_when == FIRST_COMPLETED else return_when))
+    with stub(slow_latency=0.2) as server:
+        rest = primed_client(server, Metrics())
+        server.failures = 1
+        assert rest.get(PATH) == STUB_RESPONSE
+        rest.close()
+
+
+def test_error_when_every_copy_failed():
+    with stub(slow_latency=0.2) as server:
+        rest = primed_client(server, Metrics())
+        server.failures = 2
+        with pytest.raises(ConnectionError):
+            rest.get(PATH)
+        rest.close()
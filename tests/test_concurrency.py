@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from client import RestClient
+from concurrency import AdaptiveLimiter, is_throttled, raw_status_code, retry_delay
+from stub_server import StubServer, THROTTLED_RESPONSE
+
+
+def test_is_throttled():
+    assert is_throttled(200, dict(status_code=40202))
+    assert is_throttled(429) and is_throttled(503) and is_throttled(0, timed_out=True)
+    assert not is_throttled(200, dict(status_code=20000))
+    assert not is_throttled(200)
+
+
+def test_raw_status_code():
+    assert raw_status_code(json.dumps(THROTTLED_RESPONSE).encode()) == 40202
+    assert raw_status_code(b'{"version": "0.1", "status_code" : 20000, "tasks": []}') == 20000
+    assert raw_status_code(b"<html>Bad gateway</html>") is None
+
+
+def test_retry_delay_doubles():
+    assert [retry_delay(attempt, 1.0) for attempt in (1, 2, 3)] == [1.0, 2.0, 4.0]
+
+
+def call(limiter, endpoint="task_get", latency=0.01, throttled=False):
+    started = limiter.acquire(endpoint)
+    limiter.release(endpoint, started, latency, throttled)
+
+
+def round_of_calls(limiter, endpoint="task_get", latency=0.01):
+    """ Runs as many calls at once as the limit allows. """
+    started = [limiter.acquire(endpoint) for _ in range(int(limiter.limit(endpoint)))]
+    for s in started:
+        limiter.release(endpoint, s, latency, False)
+
+
+def test_limit_increases_while_the_calls_are_healthy():
+    limiter = AdaptiveLimiter(initial=1, max_limit=4)
+    round_of_calls(limiter)
+    assert limiter.limit("task_get") == 2
+    round_of_calls(limiter)
+    assert 2 < limiter.limit("task_get") < 4
+    for _ in range(20):
+        round_of_calls(limiter)
+    assert limiter.limit("task_get") == 4
+
+
+def test_calls_below_the_limit_do_not_raise_it():
+    limiter = AdaptiveLimiter(initial=4)
+    for _ in range(10):
+        call(limiter)
+    assert limiter.limit("task_get") == 4
+
+
+def test_slow_calls_do_not_raise_the_limit():
+    limiter = AdaptiveLimiter(initial=1, latency_tolerance=2.0)
+    call(limiter, latency=0.01)
+    limit = limiter.limit("task_get")
+    call(limiter, latency=0.05)
+    assert limiter.limit("task_get") == limit
+
+
+def test_throttled_call_cuts_the_limit_once_per_round():
+    limiter = AdaptiveLimiter(initial=8, backoff=0.5)
+    started = [limiter.acquire("task_get") for _ in range(3)]
+    for s in started:
+        limiter.release("task_get", s, 0.01, True)
+    # The calls started before the first cut do not cut it again
+    assert limiter.limit("task_get") == 4
+    call(limiter, throttled=True)
+    assert limiter.limit("task_get") == 2
+    assert limiter.limit("sellers") == 8
+
+
+def test_acquire_times_out_at_the_limit():
+    limiter = AdaptiveLimiter(initial=1)
+    assert limiter.acquire("task_get") is not None
+    assert limiter.acquire("task_get", timeout=0.01) is None
+
+
+@pytest.mark.parametrize("decode", [True, False])
+def test_throttled_responses_cut_the_limit_of_the_client(decode):
+    limiter = AdaptiveLimiter(initial=8)
+    with StubServer(response=THROTTLED_RESPONSE) as server:
+        client = RestClient("login", "password", domain=server.address, secure=False, concurrency=limiter)
+        path = "/v3/merchant/google/products/task_get/advanced/1"
+        client.get(path) if decode else client.get_raw(path)
+        client.close()
+    assert list(limiter.report().values()) == [4]
@@ -0,0 +1,87 @@
+import json
+import time
+
+import pytest
+
+from daemon import FreshnessPolicy, ProductState, RepricingDaemon
+from ledger import Ledger
+from scheduler import HIGH_PRIORITY, NORMAL_PRIORITY, Scheduler, ids_rule
+import task_post
+
+
+@pytest.fixture
+def policy():
+    return FreshnessPolicy(min_ttl=3600, max_ttl=7 * 24 * 3600, base_ttl=24 * 3600, target_change=0.05, alpha=0.5)
+
+
+def test_ttl_of_the_target_change_is_base_ttl(policy):
+    assert policy.ttl(0.05) == pytest.approx(24 * 3600)
+
+
+def test_ttl_is_clamped(policy):
+    assert policy.ttl(10.0) == 3600
+    assert policy.ttl(0.0001) == 7 * 24 * 3600
+    assert policy.ttl(0) == 7 * 24 * 3600
+
+
+def test_volatile_products_are_refreshed_more_often(policy):
+    assert policy.ttl(0.2) < policy.ttl(0.05) < policy.ttl(0.01)
+
+
+def test_first_volatility_is_the_change(policy):
+    assert policy.volatility(None, 100.0, 110.0) == pytest.approx(0.1)
+
+
+def test_volatility_is_a_moving_average(policy):
+    assert policy.volatility(0.1, 100.0, 100.0) == pytest.approx(0.05)
+    assert policy.volatility(0.1, 100.0, 120.0) == pytest.approx(0.15)
+
+
+def test_volatility_without_prices(policy):
+    assert policy.volatility(None, None, 10.0) == 0.05
+    assert policy.volatility(0.2, 10.0, None) == 0.2
+    assert policy.volatility(0.2, 0.0, 10.0) == 0.2
+
+
+class FakeClient:
+    def __init__(self):
+        self.tasks = []
+
+    def post(self, path, body):
+        tasks = json.loads(body)
+        self.tasks.extend(tasks)
+        return dict(status_code=20000, status_message="Ok.", tasks=[
+            dict(id=str(i), status_code=20100, status_message="Task Created.", cost=0.001)
+            for i, _ in enumerate(tasks)])
+
+
+class FakeSession:
+    def __init__(self):
+        self.client = FakeClient()
+        self.budget = None
+
+
+def stale_daemon(scheduler=None):
+    daemon = RepricingDaemon(FakeSession(), Ledger(":memory:"), "data.xlsx", health_file=None, scheduler=scheduler)
+    for product_id, title in ((1, "reel a"), (2, "reel b")):
+        state = ProductState(title, {"ID": product_id, "Title": title, "Variant Price": 10.0})
+        daemon.products[title] = state
+        daemon._push(state)
+    daemon._tokens = 2
+    return daemon
+
+
+def test_stale_products_get_the_priority_of_the_scheduler():
+    daemon = stale_daemon(Scheduler(rules=[ids_rule({2})], priority=NORMAL_PRIORITY))
+    assert daemon.post_due(time.time()) == 2
+    assert {t["keyword"]: t["priority"] for t in daemon.session.client.tasks} == \
+        {"reel a": NORMAL_PRIORITY, "reel b": HIGH_PRIORITY}
+    # The high priority product is expected back sooner
+    assert daemon.products["reel b"].due_at < daemon.products["reel a"].due_at
+
+
+def test_stale_products_get_the_configured_priority(monkeypatch):
+    monkeypatch.setattr(task_post, "CONFIGURED_PRIORITY", HIGH_PRIORITY)
+    daemon = stale_daemon()
+    daemon.post_due(time.time())
+    assert [t["priority"] for t in daemon.session.client.tasks] == [HIGH_PRIORITY, HIGH_PRIORITY]
@@ -0,0 +1,177 @@
+import json
+import time
+
+import pytest
+
+from batching import pack_batches
+from conftest import make_item, make_response
+from jobqueue import (ANALYZE, DEAD, DONE, FETCH, PENDING, POST, Coordinator, Job, RedisQueue, RespConnection,
+                      SqliteQueue, Worker, open_queue)
+from resp_server import RespServer
+
+
+@pytest.fixture(params=["sqlite", "redis"])
+def queue(request, tmp_path):
+    if request.param == "sqlite":
+        queue = SqliteQueue(str(tmp_path / "jobs.db"))
+        yield queue
+        queue.close()
+    else:
+        with RespServer() as server:
+            queue = RedisQueue(RespConnection("127.0.0.1", server.port))
+            yield queue
+            queue.close()
+
+
+def test_round_trip(queue):
+    assert queue.put(Job("post:1", POST, dict(body="[]"), "run"))
+    # The same id is not added twice
+    assert not queue.put(Job("post:1", POST, dict(body="other"), "run"))
+    job = queue.get([POST], "worker")
+    assert (job.id, job.kind, job.payload, job.run_id, job.attempts) == ("post:1", POST, dict(body="[]"), "run", 1)
+    assert queue.get([POST], "worker") is None
+    queue.ack(job, dict(task_ids=["a"]))
+    queue.ack(job, dict(task_ids=["b"]))
+    assert queue.result("post:1") == dict(task_ids=["a"])
+    assert list(queue.results(POST, "run")) == [("post:1", dict(task_ids=["a"]))]
+    assert queue.counts("run") == {PENDING: 0, DONE: 1, DEAD: 0}
+
+
+def test_jobs_are_handed_out_by_kind_and_visibility(queue):
+    queue.put(Job("fetch:1", FETCH, dict(), "run"), delay=60)
+    queue.put(Job("post:1", POST, dict(), "run"))
+    assert queue.get([FETCH], "worker") is None
+    assert queue.get([FETCH, POST], "worker").id == "post:1"
+
+
+def test_job_is_handed_out_again_after_the_visibility_timeout(queue):
+    queue.put(Job("post:1", POST, dict(), "run"))
+    first = queue.get([POST], "worker-1", visibility_timeout=0.05)
+    assert queue.get([POST], "worker-2", visibility_timeout=0.05) is None
+    time.sleep(0.1)
+    second = queue.get([POST], "worker-2")
+    assert second.id == first.id and second.attempts == 2
+    # The first worker was too late, its retry does nothing
+    queue.retry(first, 0, "late")
+    assert queue.get([POST], "worker-3") is None
+    queue.ack(second, "done")
+    assert queue.counts("run")[DONE] == 1
+
+
+def test_retry_and_dead_letter(queue):
+    queue.put(Job("post:1", POST, dict(), "run"))
+    job = queue.get([POST], "worker")
+    queue.retry(job, 0, "error")
+    job = queue.get([POST], "worker")
+    assert job.attempts == 2
+    queue.retry(job, 0, "error", dead=True)
+    assert queue.get([POST], "worker") is None
+    assert queue.counts("run") == {PENDING: 0, DONE: 0, DEAD: 1}
+    assert queue.result("post:1") is None
+
+
+def test_open_queue(tmp_path):
+    queue = open_queue(f"sqlite:///{tmp_path / 'jobs.db'}")
+    assert isinstance(queue, SqliteQueue)
+    queue.close()
+    with pytest.raises(ValueError):
+        open_queue("amqp://localhost")
+
+
+class FakeClient:
+    """ Creates a task per posted task, ready after ready_after task_get calls. """
+
+    def __init__(self, ready_after=0, throttled=0):
+        self.posted = list()
+        self.gets = dict()
+        self.ready_after = ready_after
+        self.throttled = throttled
+
+    def post(self, path, body):
+        tasks = list()
+        for task in json.loads(body):
+            self.posted.append(task)
+            tasks.append(dict(id=f"task-{len(self.posted)}", status_code=20100, status_message="Task Created.",
+                              data=task))
+        return dict(status_code=20000, status_message="Ok.", tasks=tasks)
+
+    def get(self, path):
+        assert path.endswith("/tasks_ready")
+        return dict(status_code=20000, status_message="Ok.", tasks=[dict(result=[
+            dict(id=f"task-{i + 1}", tag=task.get("tag")) for i, task in enumerate(self.posted)])])
+
+    def get_raw(self, path):
+        task_id = path.rsplit("/", 1)[1]
+        if self.throttled:
+            self.throttled -= 1
+            return json.dumps(dict(status_code=40202, status_message="Rate limit exceeded.", tasks=[])).encode()
+        self.gets[task_id] = self.gets.get(task_id, 0) + 1
+        if self.gets[task_id] <= self.ready_after:
+            return json.dumps(dict(status_code=20000, tasks=[dict(id=task_id, status_code=40602)])).encode()
+        task = self.posted[int(task_id.split("-")[1]) - 1]
+        return json.dumps(make_response([(task_id, task["keyword"], [make_item(task["keyword"], 9.5, "https://a.com/1")])]))
+
+
+class FakeSession:
+    def __init__(self, client):
+        self.client = client
+        self.budget = None
+        self.deadline = None
+
+
+def run_all(worker, rounds=10):
+    for _ in range(rounds):
+        if not worker.run(once=True):
+            break
+
+
+def coordinated_run(queue, client, tasks):
+    coordinator = Coordinator(queue, "run")
+    assert coordinator.submit(pack_batches(tasks)) == 1
+    worker = Worker(queue, FakeSession(client), retry_delay=0)
+    return coordinator, worker
+
+
+def test_worker_runs_the_jobs_of_a_run(queue):
+    client = FakeClient(ready_after=1)
+    coordinator, worker = coordinated_run(queue, client, [dict(keyword="Reel A"), dict(keyword="Reel B")])
+    run_all(worker)
+    assert queue.counts("run") == {PENDING: 0, DONE: 5, DEAD: 0}
+    price_dict = coordinator.merge()
+    assert {keyword: [o.price for o in offers] for keyword, offers in price_dict.items()} == \
+        {"Reel A": [9.5], "Reel B": [9.5]}
+
+
+def test_throttled_fetch_is_retried(queue):
+    client = FakeClient(throttled=2)
+    coordinator, worker = coordinated_run(queue, client, [dict(keyword="Reel A")])
+    run_all(worker)
+    assert queue.counts("run") == {PENDING: 0, DONE: 3, DEAD: 0}
+    assert queue.result("fetch:task-1")["status_code"] == 20000
+    assert list(coordinator.merge()) == ["Reel A"]
+
+
+def test_caller_tags_are_kept(queue):
+    client = FakeClient()
+    coordinator, worker = coordinated_run(queue, client, [dict(keyword="Reel A", tag="101"), dict(keyword="Reel B")])
+    run_all(worker)
+    assert [task["tag"] for task in client.posted] == ["101", client.posted[1]["tag"]]
+    assert client.posted[1]["tag"].startswith("post:")
+
+
+def test_failing_job_is_given_up(queue):
+    queue.put(Job("analyze:1", ANALYZE, dict(fetch_job="fetch:missing"), "run"))
+    worker = Worker(queue, FakeSession(FakeClient()), max_attempts=2, retry_delay=0)
+    run_all(worker)
+    assert queue.counts("run") == {PENDING: 0, DONE: 0, DEAD: 1}
+
+
+def test_post_job_handed_out_again_does_not_post_twice(queue):
+    client = FakeClient()
+    coordinator, worker = coordinated_run(queue, client, [dict(keyword="Reel A")])
+    job = queue.get([POST], "worker", visibility_timeout=0)
+    worker.post(job)
+    # The worker crashed before acknowledging the job, another one runs it again
+    run_all(worker)
+    assert len(client.posted) == 1
+    assert queue.counts("run") == {PENDING: 0, DONE: 3, DEAD: 0}
@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import drain
+from drain import MERCHANT_API, Drainer
+from ledger import FAILED, FETCHED, POSTED, Ledger
+
+
+@pytest.fixture
+def ledger():
+    ledger = Ledger(":memory:", run_id="run")
+    yield ledger
+    ledger.close()
+
+
+def test_pending_tasks(ledger):
+    ledger.record_posted("1", "products", cost=0.001)
+    ledger.record_posted("2", "products")
+    ledger.record_posted("3", "sellers")
+    ledger.mark("1", FETCHED, 0.001)
+    assert ledger.pending() == ["2", "3"]
+    assert ledger.pending("sellers") == ["3"]
+    assert ledger.is_pending("2") and not ledger.is_pending("1")
+    assert ledger.status("4") is None
+    assert ledger.counts() == {"products": {FETCHED: 1, POSTED: 1}, "sellers": {POSTED: 1}}
+
+
+def test_later_runs_see_the_pending_tasks(tmp_path):
+    file_name = str(tmp_path / "ledger.db")
+    first = Ledger(file_name, run_id="first")
+    first.record_posted("1", "products")
+    first.close()
+    second = Ledger(file_name, run_id="second")
+    assert second.pending() == []
+    assert second.pending(run_only=False) == ["1"]
+    second.close()
+
+
+class FakeClient:
+    """ Serves the ready lists of the endpoints and the task_get responses. """
+
+    def __init__(self, ready, throttled=0):
+        self.ready = ready
+        self.throttled = throttled
+        self.deadline = None
+        self.fetched = []
+
+    def get(self, path):
+        endpoint, _, rest = path[len(MERCHANT_API):].partition("/")
+        if rest == "tasks_ready":
+            ids, self.ready[endpoint] = self.ready.get(endpoint, []), []
+            return dict(status_code=20000, status_message="Ok.", tasks=[
+                dict(status_code=20000, result=[dict(id=task_id) for task_id in ids])])
+        task_id = rest.rpartition("/")[2]
+        if self.throttled:
+            self.throttled -= 1
+            return dict(status_code=40202, status_message="Rate limit.", tasks=[])
+        self.fetched.append(task_id)
+        return dict(status_code=20000, status_message="Ok.", tasks=[
+            dict(id=task_id, status_code=20000 if task_id != "bad" else 40400, cost=0.001)])
+
+
+def drain_all(client, ledger, **kwargs):
+    handled = []
+    with ThreadPoolExecutor(4) as pool:
+        drainer = Drainer(client, ledger, pool, lambda endpoint, task_id, res: handled.append(task_id), **kwargs)
+        return drainer.drain(), handled
+
+
+def test_drain_fetches_the_ready_tasks(ledger):
+    ledger.record_posted("1", "products")
+    ledger.record_posted("2", "products")
+    ledger.record_posted("done", "products")
+    ledger.mark("done", FETCHED)
+    client = FakeClient({"products": ["1", "2", "done", "bad"], "sellers": ["3"]})
+    n, handled = drain_all(client, ledger)
+    assert n == 4
+    assert sorted(handled) == ["1", "2", "3", "bad"]
+    assert ledger.status("1") == FETCHED
+    assert ledger.status("bad") == FAILED
+    # Tasks posted by other tools are added to the ledger
+    assert ledger.counts()["sellers"] == {FETCHED: 1}
+
+
+def test_drain_only_known_and_fetched(ledger):
+    ledger.record_posted("1", "products")
+    ledger.record_posted("2", "products")
+    client = FakeClient({"products": ["1", "2", "other"]})
+    n, handled = drain_all(client, ledger, only_known=True, fetched=lambda task_id: task_id == "2")
+    assert handled == ["1"]
+    assert ledger.status("other") is None
+    assert ledger.is_pending("2")
+
+
+def test_drain_retries_throttled_fetches(ledger, monkeypatch):
+    monkeypatch.setattr(drain, "retry_delay", lambda attempt: 0)
+    ledger.record_posted("1", "products")
+    client = FakeClient({"products": ["1"]}, throttled=2)
+    n, handled = drain_all(client, ledger)
+    assert handled == ["1"]
+    assert ledger.status("1") == FETCHED
+
+
+def test_drain_leaves_tasks_pending_after_the_last_attempt(ledger, monkeypatch):
+    monkeypatch.setattr(drain, "retry_delay", lambda attempt: 0)
+    ledger.record_posted("1", "products")
+    client = FakeClient({"products": ["1"]}, throttled=drain.FETCH_ATTEMPTS)
+    n, handled = drain_all(client, ledger)
+    assert (n, handled) == (0, [])
+    assert ledger.is_pending("1")
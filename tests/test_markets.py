@@ -0,0 +1,58 @@
+import csv
+
+import pytest
+
+from conftest import make_item, make_response
+from markets import Market, market_file_name, parse_market
+import task_post
+
+
+US = Market("United States", "English")
+CA = Market("Canada", "French")
+
+
+def market_response(task_id, keyword, market, items):
+    response = make_response([(task_id, keyword, items)])
+    response["tasks"][0]["data"].update(location_name=market.location_name, language_name=market.language_name)
+    return response
+
+
+@pytest.fixture
+def results():
+    return [
+        market_response("1", "Reel", US, [make_item("Reel", 10.0, "https://us.com/reel"),
+                                          make_item("Reel", 12.0, "https://us2.com/reel")]),
+        market_response("2", "Reel", CA, [dict(make_item("Reel", 14.0, "https://ca.com/reel"), currency="CAD")]),
+    ]
+
+
+def test_parse_market():
+    assert parse_market("Canada : French") == CA
+    with pytest.raises(ValueError):
+        parse_market("Canada")
+
+
+def test_market_file_name():
+    assert market_file_name("results.csv", US) == "results.United_States.English.csv"
+    assert market_file_name("out/results.csv", Market("Paris,Ile-de-France,France", "French")) == \
+        "out/results.Paris_Ile_de_France_France.French.csv"
+
+
+def test_offers_are_kept_per_market(results):
+    market_offers, comparison = task_post.analyze_markets(results)
+    assert {m: {k: sorted(o.price for o in offers) for k, offers in by_keyword.items()}
+            for m, by_keyword in market_offers.items()} == {US: {"Reel": [10.0, 12.0]}, CA: {"Reel": [14.0]}}
+    assert {row["market"]: row["currency"] for row in comparison["Reel"]} == {US: "USD", CA: "CAD"}
+
+
+def test_each_market_has_its_own_output(results, tmp_path, monkeypatch):
+    monkeypatch.setattr(task_post, "OUTPUT_FILE", str(tmp_path / "results.csv"))
+    monkeypatch.setattr(task_post, "SNAPSHOT", dict(file=str(tmp_path / "snapshot.npz")))
+    market_offers, _ = task_post.analyze_markets(results)
+    task_post.write_market_outputs(market_offers, {"Reel": (1, 11.0, "SKU")}, export_files=[])
+    assert not (tmp_path / "results.csv").exists()
+    for market, prices in ((US, {"10.0", "12.0"}), (CA, {"14.0"})):
+        with open(market_file_name(str(tmp_path / "results.csv"), market), encoding="utf-8") as file:
+            header, row = list(csv.reader(file))
+        assert row[:3] == ["1", "Reel", "11.0"]
+        assert set(row[3::2]) == prices
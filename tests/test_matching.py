@@ -0,0 +1,60 @@
+import pytest
+
+from matching import TitleMatcher, is_model_code, normalize_keyword, sku, tokens
+
+
+KEYWORDS = ["Abu Garcia Max X Spinning Reel MAXXSP40-C", "Garmin Striker 4 Fishfinder 010-01550-00",
+            "Penn Battle III Spinning Reel", "Minn Kota Endura C2 30 Trolling Motor 12V"]
+
+
+def test_normalize_keyword():
+    assert normalize_keyword("Abu Garcia Max X Spinning Reel - Clam Shell - MAXXSP40-C [1523255]") == \
+        "Abu Garcia Max X Spinning Reel MAXXSP40-C"
+    assert normalize_keyword("*Case of 12* Hooks - Blister Pack") == "Case of 12 Hooks"
+    assert normalize_keyword("  [1523255]") == "[1523255]"
+
+
+def test_sku():
+    assert sku("Reel [ 1523255 ]") == "1523255"
+    assert sku("Reel") is None
+
+
+def test_tokens():
+    assert tokens("The Reel for the 2.5 reel, w/ line") == ["reel", "2.5", "line"]
+
+
+@pytest.mark.parametrize("token, code", [("maxxsp40", True), ("dst810", True), ("12v", False), ("16oz", False),
+                                         ("2024", False), ("reel", False), ("c2", False)])
+def test_is_model_code(token, code):
+    assert is_model_code(token) == code
+
+
+@pytest.fixture
+def matcher():
+    return TitleMatcher(KEYWORDS, skus={KEYWORDS[2]: "PENN-BTLIII4000"})
+
+
+def test_same_products_match(matcher):
+    keywords = [KEYWORDS[0], KEYWORDS[1], KEYWORDS[3]]
+    titles = ["Abu Garcia Max X Spinning Reel, MAXXSP40", "Garmin STRIKER 4 fish finder 010-01550-00",
+              "Minn Kota Endura C2 30lb Transom Trolling Motor, 12V"]
+    assert matcher.matches(keywords, titles).tolist() == [True, True, True]
+
+
+def test_other_products_do_not_match(matcher):
+    keywords = [KEYWORDS[0], KEYWORDS[2], KEYWORDS[3]]
+    titles = ["Spinning Reel Handle Knob", "Shimano Sedona Spinning Reel", "12V Deep Cycle Battery"]
+    assert matcher.matches(keywords, titles).tolist() == [False, False, False]
+
+
+def test_model_code_and_sku_scores(matcher):
+    scores = matcher.score_many([KEYWORDS[0], KEYWORDS[2], KEYWORDS[2]],
+                                ["MAXXSP40-C", "penn btliii4000 bundle", ""])
+    assert scores[0] == pytest.approx(0.9)
+    assert scores[1] == 1.0
+    assert scores[2] == 0.0
+
+
+def test_unknown_keywords_and_empty_titles(matcher):
+    scores = matcher.score_many(["Brand New Thing", KEYWORDS[1]], ["Brand New Thing", None])
+    assert scores.tolist() == [1.0, 0.0]
@@ -0,0 +1,79 @@
+import io
+import json
+
+import pytest
+
+from metrics import CallbackHook, Histogram, JsonLogHook, Metrics, PrometheusTextHook, endpoint_name
+
+
+TASK_ID = "09100422-3160-0179-0000-009a2fdef23a"
+
+
+@pytest.mark.parametrize("path, endpoint", [
+    ("/v3/merchant/google/products/task_get/advanced/" + TASK_ID, "/v3/merchant/google/products/task_get/advanced"),
+    ("/v3/merchant/google/products/tasks_ready?x=1", "/v3/merchant/google/products/tasks_ready"),
+    ("/v3/merchant/google/sellers/ad_url/some-token", "/v3/merchant/google/sellers/ad_url"),
+])
+def test_endpoint_name(path, endpoint):
+    assert endpoint_name(path) == endpoint
+
+
+def test_histogram_quantile():
+    histogram = Histogram((0.1, 1.0))
+    assert histogram.quantile(0.5) == 0.0
+    for value in (0.05, 0.05, 0.5, 5.0):
+        histogram.observe(value)
+    assert histogram.counts == [2, 1, 1]
+    assert histogram.quantile(0.5) == 0.1
+    assert histogram.quantile(0.75) == 1.0
+    assert histogram.quantile(1.0) == float("inf")
+
+
+def test_record_request():
+    metrics = Metrics()
+    response = dict(status_code=20000, cost=0.002)
+    metrics.record_request("/v3/merchant/google/products/task_post", "POST", 200, 0.3, 100, 400, response)
+    metrics.record_request("/v3/merchant/google/products/task_post", "POST", 200, 0.1, 50, 40, dict(status_code=40202))
+    endpoint = "/v3/merchant/google/products/task_post"
+    assert metrics.total("request_bytes_out_total", endpoint=endpoint) == 150
+    assert metrics.total("api_status_total", code=20000) == 1
+    assert metrics.total("api_cost_total") == pytest.approx(0.002)
+    histogram = metrics.histograms[("request_latency_seconds", (("endpoint", endpoint), ("method", "POST")))]
+    assert histogram.count == 2
+
+
+def test_hooks_see_every_measurement():
+    seen = []
+    metrics = Metrics([CallbackHook(lambda *args: seen.append(args))])
+    metrics.inc("tasks_posted_total", 3, stage="products")
+    metrics.set_gauge("queue_depth", 7)
+    with metrics.stage("read"):
+        pass
+    assert seen[:2] == [("counter", "tasks_posted_total", 3, {"stage": "products"}),
+                        ("gauge", "queue_depth", 7, {})]
+    assert seen[2][:2] == ("histogram", "stage_seconds")
+
+
+def test_prometheus_text(tmp_path):
+    metrics = Metrics()
+    metrics.inc("tasks_posted_total", 2, stage="products")
+    metrics.observe("stage_seconds", 0.2, stage="post")
+    hook = PrometheusTextHook(str(tmp_path / "metrics.prom"))
+    metrics.add_hook(hook)
+    metrics.flush()
+    text = (tmp_path / "metrics.prom").read_text(encoding="utf-8")
+    assert "# TYPE dataforseo_tasks_posted_total counter" in text
+    assert 'dataforseo_tasks_posted_total{stage="products"} 2' in text
+    assert 'dataforseo_stage_seconds_bucket{stage="post",le="0.25"} 1' in text
+    assert 'dataforseo_stage_seconds_bucket{stage="post",le="+Inf"} 1' in text
+    assert 'dataforseo_stage_seconds_count{stage="post"} 1' in text
+
+
+def test_json_log():
+    stream = io.StringIO()
+    metrics = Metrics([JsonLogHook(stream=stream, events=True)])
+    metrics.inc("tasks_posted_total", stage="products")
+    metrics.flush()
+    event, snapshot = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert (event["kind"], event["name"], event["labels"]) == ("counter", "tasks_posted_total", {"stage": "products"})
+    assert snapshot["metrics"]["counters"] == [dict(name="tasks_posted_total", labels={"stage": "products"}, value=1)]
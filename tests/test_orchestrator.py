@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+
+import pytest
+
+from batching import pack_batches
+from budget import Budget
+from ledger import FAILED, FETCHED, Ledger
+from orchestrator import Orchestrator, product_ids, tag_tasks
+
+
+class FakeMerchantApi:
+    """ Creates the posted tasks of every endpoint, ready at once unless ready is False.
+    The products tasks find two products, the cost of each task goes to the budget.
+    """
+
+    def __init__(self, ready=True, budget=None, cost=0.001):
+        self.deadline = None
+        self.ready = ready
+        self.budget = budget
+        self.cost = cost
+        self.tasks = dict()
+        self.lock = threading.Lock()
+
+    def post(self, path, body):
+        endpoint = path.split("/")[-2]
+        created = list()
+        with self.lock:
+            for task in json.loads(body):
+                task_id = f"{endpoint}-{len(self.tasks) + 1}"
+                self.tasks[task_id] = (endpoint, task)
+                created.append(dict(id=task_id, status_code=20100, status_message="Task Created.", data=task,
+                                    cost=self.cost))
+        if self.budget is not None:
+            self.budget.add(endpoint + "/task_post", self.cost * len(created))
+        return dict(status_code=20000, status_message="Ok.", tasks=created)
+
+    def get(self, path):
+        endpoint = path.split("/")[4]
+        if path.endswith("/tasks_ready"):
+            with self.lock:
+                ready = [dict(id=task_id) for task_id, (e, _) in self.tasks.items() if e == endpoint and self.ready]
+            return dict(status_code=20000, status_message="Ok.", tasks=[dict(result=ready)])
+        task_id = path.rsplit("/", 1)[1]
+        _, task = self.tasks[task_id]
+        items = [dict(product_id=f"{task.get('tag')}-{i}") for i in range(2)] if endpoint == "products" else []
+        return dict(status_code=20000, status_message="Ok.", tasks=[
+            dict(id=task_id, status_code=20000, data=task, result=[dict(items=items)])])
+
+
+@pytest.fixture
+def ledger(tmp_path):
+    ledger = Ledger(str(tmp_path / "ledger.db"))
+    yield ledger
+    ledger.close()
+
+
+def run(api, ledger, tasks, **kwargs):
+    with ThreadPoolExecutor(4) as pool:
+        orchestrator = Orchestrator(api, ledger, pool, poll_interval=0.01, **kwargs)
+        return orchestrator, orchestrator.run(tasks)
+
+
+def products(n):
+    return [dict(keyword=f"Reel {i}", location_name="United States", language_name="English", tag=str(i))
+            for i in range(n)]
+
+
+def test_children_are_posted_for_the_products_found(ledger):
+    _, results = run(FakeMerchantApi(), ledger, products(2))
+    assert len(results["products"]) == 2
+    assert len(results["sellers"]) == len(results["product_info"]) == 4
+    assert {task["data"]["product_id"] for task in results["sellers"]} == {"0-0", "0-1", "1-0", "1-1"}
+    # The market and tag of the parent are kept
+    assert all(task["data"]["tag"] == task["data"]["product_id"][0] for task in results["sellers"])
+    assert ledger.counts() == {stage: {FETCHED: n} for stage, n in
+                               (("products", 2), ("sellers", 4), ("product_info", 4))}
+
+
+def test_tasks_still_pending_after_max_wait_fail(ledger):
+    orchestrator, results = run(FakeMerchantApi(ready=False), ledger, products(2), max_wait=0.1)
+    assert results["products"] == []
+    assert ledger.pending() == []
+    assert ledger.counts() == {"products": {FAILED: 2}}
+
+
+def test_batches_above_the_hard_cap_are_deferred(ledger):
+    # The two products tasks fit, their children would not
+    budget = Budget(run_cap=0.004)
+    orchestrator, results = run(FakeMerchantApi(budget=budget), ledger, products(2), budget=budget)
+    assert len(results["products"]) == 2
+    assert results["sellers"] == [] and results["product_info"] == []
+    assert sum(len(batch) for batch in orchestrator.deferred) == 8
+    assert {batch.endpoint for batch in orchestrator.deferred} == {"sellers", "product_info"}
+    assert budget.run_spent == pytest.approx(0.002)
+
+
+def test_product_ids():
+    task = dict(result=[dict(items=[dict(product_id="a"), dict(product_id="b"), dict(product_id="a"),
+                                    dict(), dict(product_id="c")])])
+    assert product_ids(task) == ["a", "b", "c"]
+    assert product_ids(task, limit=2) == ["a", "b"]
+
+
+def test_tag_tasks():
+    batches = pack_batches([dict(keyword="Reel A"), dict(keyword="Reel B")])
+    tasks = tag_tasks(batches, {"Reel A": (101, 9.5, "A")})
+    assert tasks == [dict(keyword="Reel A", tag="101"), dict(keyword="Reel B")]
@@ -0,0 +1,63 @@
+import json
+import os
+import pstats
+import time
+
+from metrics import Metrics
+from profiling import Profiler
+
+
+def busy(seconds):
+    end = time.process_time() + seconds
+    total = 0
+    while time.process_time() < end:
+        total += 1
+    return total
+
+
+def profiled_run(out_dir, **kwargs):
+    metrics = Metrics()
+    metrics.profiler = profiler = Profiler(str(out_dir), interval=0.001, **kwargs)
+    with metrics.stage("fetch"):
+        time.sleep(0.1)
+    with metrics.stage("analyze"):
+        busy(0.1)
+        with metrics.stage("write_output"):
+            [bytearray(2 ** 20) for _ in range(4)]
+    return profiler, profiler.close()
+
+
+def test_stages_are_measured(tmp_path):
+    profiler, summary_file = profiled_run(tmp_path, memory=True)
+    fetch, analyze, write = (profiler.stages[name] for name in ("fetch", "analyze", "write_output"))
+    assert fetch.runs == analyze.runs == write.runs == 1
+    assert fetch.wall >= 0.1 and fetch.wait > 0.05
+    assert analyze.cpu >= 0.05 and analyze.wall >= write.wall
+    assert write.peak_memory >= 2 ** 20
+    summary = open(summary_file, encoding="utf-8").read()
+    assert "analyze" in summary and "hottest functions" in summary
+
+
+def test_output_files(tmp_path):
+    profiler, _ = profiled_run(tmp_path, deterministic=True)
+    assert profiler.n_samples > 0
+    with open(os.path.join(tmp_path, "stacks.collapsed"), encoding="utf-8") as file:
+        lines = file.read().splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert any(line.startswith("analyze;MainThread;") and "busy (test_profiling.py" in line for line in lines)
+    with open(os.path.join(tmp_path, "profile.speedscope.json"), encoding="utf-8") as file:
+        document = json.load(file)
+    assert {p["name"] for p in document["profiles"]} >= {"analyze - MainThread"}
+    n_frames = len(document["shared"]["frames"])
+    assert all(0 <= i < n_frames for p in document["profiles"] for sample in p["samples"] for i in sample)
+    # The nested stage is in the cProfile of the outer one
+    stats = pstats.Stats(os.path.join(tmp_path, "analyze.prof"))
+    assert any(function == "busy" for _, _, function in stats.stats)
+    assert not os.path.exists(os.path.join(tmp_path, "write_output.prof"))
+
+
+def test_stages_without_profiler():
+    metrics = Metrics()
+    with metrics.stage("read"):
+        pass
+    assert metrics.histograms[("stage_seconds", (("stage", "read"),))].count == 1
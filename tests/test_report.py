@@ -0,0 +1,85 @@
+import math
+
+import numpy as np
+import pytest
+
+import report
+from models import Offer
+from report import build_report, chart_name, kde_matrix, offers_hash, price_grid
+
+
+PRICE_LISTS = [[10.0, 12.0, 11.0, 30.0], [], [100.0], [5.0, 5.0]]
+
+
+def naive_kde(prices, grid):
+    values = np.log(prices)
+    bandwidth = max(1.06 * values.std() * len(values) ** -0.2, report.MIN_BANDWIDTH)
+    z = (grid[:, None] - values[None, :]) / bandwidth
+    return np.exp(-0.5 * z * z).sum(axis=1) / (len(values) * bandwidth * math.sqrt(2 * math.pi))
+
+
+def test_price_grid():
+    grid = price_grid(PRICE_LISTS, n_points=100)
+    assert len(grid) == 100
+    assert grid[0] < math.log(5.0) and grid[-1] > math.log(100.0)
+    assert len(price_grid([[], []])) == 0
+
+
+@pytest.mark.parametrize("chunk_rows", [report.KERNEL_CHUNK_ROWS, 3])
+def test_kde_matrix_is_the_kde_of_each_product(chunk_rows, monkeypatch):
+    # Small chunks split the offers of a product between chunks
+    monkeypatch.setattr(report, "KERNEL_CHUNK_ROWS", chunk_rows)
+    grid = price_grid(PRICE_LISTS, n_points=2000)
+    densities = kde_matrix(PRICE_LISTS, grid)
+    assert densities.shape == (4, 2000)
+    assert not densities[1].any()
+    for row in (0, 2, 3):
+        np.testing.assert_allclose(densities[row], naive_kde(np.array(PRICE_LISTS[row]), grid), atol=1e-9)
+        # A density over the log prices
+        assert densities[row].sum() * (grid[1] - grid[0]) == pytest.approx(1.0, abs=0.02)
+
+
+def test_offers_hash_and_chart_name():
+    offers = [Offer(10.0, "https://a.com"), Offer(12.0, "https://b.com")]
+    assert offers_hash(offers, 11.0) == offers_hash(offers[::-1], 11.0)
+    assert offers_hash(offers, 11.0) != offers_hash(offers, 12.0)
+    assert offers_hash(offers, 11.0) != offers_hash(offers[:1], 11.0)
+    assert chart_name("Reel", 42) == "42.png"
+    assert chart_name("Reel", "") == chart_name("Reel") != chart_name("Rod")
+
+
+@pytest.fixture
+def drawn(monkeypatch):
+    charts = []
+
+    def render_charts(chunk):
+        for file_name, *_ in chunk:
+            open(file_name, 'wb').close()
+            charts.append(file_name)
+        return [c[0] for c in chunk]
+
+    monkeypatch.setattr(report, "render_charts", render_charts)
+    return charts
+
+
+def test_unchanged_charts_are_not_drawn_again(tmp_path, drawn):
+    price_dict = {"Reel": [Offer(10.0, "https://a.com"), Offer(12.0, "https://b.com")],
+                  "Rod": [Offer(None, "https://c.com")], "Hook": [Offer(1.0, "https://d.com")]}
+    id_keyword = {"Reel": (1, 11.0, "SKU"), "Rod": (2, 20.0, "SKU2")}
+    out_dir = str(tmp_path / "report")
+    assert build_report(price_dict, id_keyword, out_dir, workers=1) == 2
+    assert sorted(f.rsplit("/", 1)[1] for f in drawn) == sorted(["1.png", chart_name("Hook")])
+    assert build_report(price_dict, id_keyword, out_dir, workers=1) == 0
+    price_dict["Reel"].append(Offer(9.0, "https://e.com"))
+    assert build_report(price_dict, id_keyword, out_dir, workers=1) == 1
+    assert build_report(price_dict, id_keyword, out_dir, workers=1, force=True) == 2
+    index = (tmp_path / "report" / "index.html").read_text(encoding="utf-8")
+    assert "3 offers, min 9.0, median 10.0, current 11.0" in index
+    assert "1 offers, min -, median -, current 20.0" in index
+
+
+def test_charts_are_drawn_without_a_display(tmp_path):
+    pytest.importorskip("matplotlib")
+    price_dict = {"Reel": [Offer(10.0, "https://a.com"), Offer(12.0, "https://b.com")]}
+    assert build_report(price_dict, {"Reel": (1, 11.0, "SKU")}, str(tmp_path), workers=1) == 1
+    assert (tmp_path / "1.png").stat().st_size > 0
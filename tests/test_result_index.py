@@ -0,0 +1,77 @@
+import json
+import os
+
+import pytest
+
+from conftest import make_item, make_response
+from result_index import ResultIndex, index_name
+from task_post import write_results_json
+
+
+ID_KEYWORD = {"Reel A": (101, 10.0, "A"), "Reel B": (102, 20.0, "B")}
+
+RESPONSES = [
+    make_response([("task-1", "Reel A", [make_item("Reel A", 9.0)])]),
+    make_response([("task-2", "Reel B", [make_item("Reel B", 19.0)]),
+                   ("task-3", "Reel A", [make_item("Reel A", 8.0)])]),
+]
+
+
+@pytest.fixture
+def results_file(tmp_path):
+    file_name = str(tmp_path / "results.json")
+    write_results_json(iter(RESPONSES), file_name, id_keyword=ID_KEYWORD)
+    return file_name
+
+
+def test_get_by_task_id(results_file):
+    with ResultIndex(results_file) as index:
+        assert index.get("task-1") == RESPONSES[0]
+        assert index.get("task-3") == RESPONSES[1]
+        assert index.get("task-4") is None
+
+
+def test_contains(results_file):
+    with ResultIndex(results_file) as index:
+        assert index.contains("task-2")
+        assert not index.contains("task-4")
+
+
+def test_by_keyword_in_written_order(results_file):
+    with ResultIndex(results_file) as index:
+        assert index.by_keyword("Reel A") == RESPONSES
+        assert index.by_keyword("Reel B") == [RESPONSES[1]]
+        assert index.by_keyword("Reel Z") == []
+
+
+def test_by_product(results_file):
+    with ResultIndex(results_file) as index:
+        assert index.by_product(101) == RESPONSES
+        assert index.by_product("102") == [RESPONSES[1]]
+        assert index.by_product(103) == []
+
+
+def test_by_product_without_product_entries(tmp_path):
+    file_name = str(tmp_path / "results.json")
+    write_results_json(iter(RESPONSES), file_name)
+    with ResultIndex(file_name) as index:
+        assert index.by_product(102) == []
+        assert index.by_product(102, ID_KEYWORD) == [RESPONSES[1]]
+
+
+def test_appended_results_are_indexed(results_file):
+    extra = make_response([("task-4", "Reel B", [make_item("Reel B", 18.0)])])
+    with open(results_file, 'a', encoding="utf-8", newline='') as file:
+        file.write(json.dumps(extra, indent=4))
+    with ResultIndex(results_file, id_keyword=ID_KEYWORD) as index:
+        assert index.get("task-4") == extra
+        assert index.get("task-1") == RESPONSES[0]
+        assert index.by_product(102) == [RESPONSES[1], extra]
+
+
+def test_results_without_an_index_are_indexed(results_file):
+    os.remove(index_name(results_file))
+    with ResultIndex(results_file) as index:
+        assert index.contains("task-3")
+        # The id and the keyword of each task, without the product IDs
+        assert index.count == 6
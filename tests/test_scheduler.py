@@ -0,0 +1,81 @@
+import time
+
+import pytest
+
+from scheduler import (HIGH_PRIORITY, MIN_POST_DELAY, NORMAL_PRIORITY, TASK_COST, TASK_TURNAROUND, Scheduler,
+                       ids_rule, load_previous_prices, price_changed_rule, scheduler_from_config, tag_rule,
+                       threshold_rule)
+
+
+def product(product_id=1, price=10.0, tags="", qty=0):
+    return {"ID": product_id, "Variant Price": price, "Tags": tags, "Variant Inventory Qty": qty}
+
+
+def test_rules():
+    assert ids_rule({"1"})(product(1)) and not ids_rule({2})(product(1))
+    assert tag_rule("best seller")(product(tags="Sale, Best Seller"))
+    assert not tag_rule("Best Seller")(product(tags="Best Sellers"))
+    assert threshold_rule("Variant Inventory Qty", 50)(product(qty=50))
+    assert not threshold_rule("Variant Inventory Qty", 50)(product(qty=""))
+    changed = price_changed_rule({1: 10.0}, tolerance=0.01)
+    assert changed(product(1, 10.5)) and not changed(product(1, 10.005)) and not changed(product(2, 99.0))
+
+
+def test_load_previous_prices(tmp_path):
+    file_name = tmp_path / "results.csv"
+    file_name.write_text("ID,Product Name,Current Price\n1,Reel,10.5\n,Unknown,-1\n2,Rod,x\n", encoding="utf-8")
+    assert load_previous_prices(str(file_name)) == {1: 10.5}
+    assert load_previous_prices(str(tmp_path / "missing.csv")) == {}
+
+
+def test_priority_and_projection():
+    scheduler = Scheduler(rules=[ids_rule({2})])
+    assert scheduler.priority_for(product(1), 2) == NORMAL_PRIORITY
+    assert scheduler.priority_for(product(2), 2) == HIGH_PRIORITY
+    assert scheduler.planned == {NORMAL_PRIORITY: 2, HIGH_PRIORITY: 2}
+    assert scheduler.projected_cost() == pytest.approx(2 * TASK_COST[NORMAL_PRIORITY] + 2 * TASK_COST[HIGH_PRIORITY])
+    assert scheduler.projected_latency() == TASK_TURNAROUND[NORMAL_PRIORITY]
+    assert scheduler.wait_time(60) == TASK_TURNAROUND[NORMAL_PRIORITY]
+
+
+def test_configured_priority():
+    assert Scheduler(priority=HIGH_PRIORITY).priority_for(product()) == HIGH_PRIORITY
+
+
+def test_close_deadline_uses_high_priority():
+    scheduler = Scheduler(deadline=time.time() + TASK_TURNAROUND[NORMAL_PRIORITY] / 2)
+    assert scheduler.priority_for(product()) == HIGH_PRIORITY
+    assert 0 < scheduler.wait_time() <= TASK_TURNAROUND[NORMAL_PRIORITY] / 2
+
+
+def test_post_delay_spreads_the_batches_before_the_deadline():
+    assert Scheduler().post_delay(10) == MIN_POST_DELAY
+    scheduler = Scheduler(deadline=time.time() + 1000 + TASK_TURNAROUND[HIGH_PRIORITY])
+    scheduler.priority_for(product(), 100)
+    assert scheduler.post_delay(1) == MIN_POST_DELAY
+    assert scheduler.post_delay(11) == pytest.approx(1000 * 0.8 / 10, rel=0.01)
+
+
+def test_report():
+    scheduler = Scheduler()
+    scheduler.priority_for(product())
+    scheduler.record_post(dict(cost=0.001, tasks=[dict(id="1")]))
+    scheduler.record_ready("1")
+    scheduler.record_ready("unknown")
+    report = scheduler.report()
+    assert report["actual_cost"] == pytest.approx(0.001)
+    assert report["normal_tasks"] == 1
+    assert 0 <= report["actual_latency_max"] < 1
+
+
+def test_scheduler_from_config(tmp_path):
+    file_name = tmp_path / "results.csv"
+    file_name.write_text("ID,Product Name,Current Price\n3,Reel,10.0\n", encoding="utf-8")
+    scheduler = scheduler_from_config(dict(ids=[1], tags=["Sale"], thresholds={"Variant Inventory Qty": 5},
+                                           deadline=3600), str(file_name))
+    assert len(scheduler.rules) == 4
+    assert scheduler.deadline == pytest.approx(time.time() + 3600, abs=5)
+    assert [scheduler.priority_for(p) for p in (product(1), product(2, tags="Sale"), product(2, qty=9),
+                                                product(3, 12.0), product(3, 10.0))] == \
+        [HIGH_PRIORITY] * 4 + [NORMAL_PRIORITY]
+    assert len(scheduler_from_config(dict(price_changed=False), str(file_name)).rules) == 0
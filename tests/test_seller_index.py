@@ -0,0 +1,82 @@
+import math
+
+import pytest
+
+from models import Offer
+from seller_index import SellerIndex, index_products, normalize_domain
+
+
+ID_KEYWORD = {"Reel A": (1, 100.0, "A"), "Reel B": (2, 50.0, "B"), "Reel C": (3, None, "C")}
+
+
+@pytest.fixture
+def index():
+    index = SellerIndex(ID_KEYWORD)
+    products = [
+        ("Reel A", [Offer(90.0, "https://cheap.com/a", seller="Cheap Shop"),
+                    Offer(110.0, "https://www.dear.com/a", seller="Dear"),
+                    Offer(80.0, "https://cheap.com/a2", seller="cheap  shop")]),
+        ("Reel B", [Offer(40.0, None, seller="Cheap Shop", domain="cheap.com"),
+                    Offer(55.0, "https://dear.com/b", seller="Dear"),
+                    Offer(None, "https://dear.com/b2", seller="Dear")]),
+        # No price of ours, the offers are not comparable
+        ("Reel C", [Offer(10.0, "https://cheap.com/c", seller="Cheap Shop")]),
+    ]
+    for _ in index_products(products, index):
+        pass
+    return index
+
+
+def stats_by_name(stats):
+    return {s["name"]: s for s in stats}
+
+
+def test_seller_stats(index):
+    stats = stats_by_name(index.seller_stats(min_offers=1))
+    cheap, dear = stats["Cheap Shop"], stats["Dear"]
+    assert (cheap["offers"], cheap["products"], cheap["undercuts"]) == (3, 3, 3)
+    assert cheap["undercut_amount"] == pytest.approx(10 + 20 + 10)
+    assert cheap["mean_ratio"] == pytest.approx((0.9 + 0.8 + 0.8) / 3, abs=1e-4)
+    assert cheap["median_ratio"] == pytest.approx(0.8)
+    assert (dear["offers"], dear["products"], dear["undercuts"]) == (2, 2, 0)
+    assert dear["median_ratio"] == pytest.approx((1.1 + 1.1) / 2)
+
+
+def test_min_offers_leaves_out_small_sellers(index):
+    assert [s["name"] for s in index.seller_stats(min_offers=3)] == ["Cheap Shop"]
+
+
+def test_stats_by_domain(index):
+    stats = stats_by_name(index.seller_stats(by="domain", min_offers=1))
+    assert stats["cheap.com"]["offers"] == 3
+    assert stats["dear.com"]["offers"] == 2
+
+
+def test_undercutters_are_sorted(index):
+    assert [s["name"] for s in index.undercutters(min_offers=1)] == ["Cheap Shop", "Dear"]
+
+
+def test_offers_of_a_seller(index):
+    rows = index.offers_of("CHEAP SHOP")
+    assert index.arrays["price"][rows].tolist()[:3] == [80.0, 40.0, 90.0]
+    assert len(index.offers_of("Nobody")) == 0
+
+
+def test_frozen_index_can_not_be_added_to(index):
+    index.freeze()
+    with pytest.raises(RuntimeError):
+        index.add("Reel A", [])
+
+
+def test_save_and_load(index, tmp_path):
+    file_name = str(tmp_path / "sellers.npz")
+    index.save(file_name)
+    loaded = SellerIndex.load(file_name)
+    assert loaded.seller_stats(min_offers=1) == index.seller_stats(min_offers=1)
+    assert math.isnan(loaded.arrays["our_price"][2])
+
+
+def test_normalize_domain():
+    assert normalize_domain("WWW.Shop.com.") == "shop.com"
+    assert normalize_domain(None, "https://www.shop.com:8080/p") == "shop.com"
+    assert normalize_domain(None) == "(unknown)"
@@ -0,0 +1,53 @@
+from snapshot import MAX_AGE, SnapshotStore
+
+
+def product(title, price, barcode="123"):
+    return {"Title": title, "Variant Price": price, "Variant Barcode": barcode}
+
+
+CATALOG = [product("Reel A", 10.0), product("Reel B", 20.0), product("Reel C", 30.0)]
+
+
+def test_first_diff_adds_every_product(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot.npz"))
+    diff = store.diff(CATALOG, now=0)
+    assert diff.added.tolist() == [True, True, True]
+    assert diff.to_post == {"Reel A", "Reel B", "Reel C"}
+    assert diff.removed == []
+
+
+def test_diff_after_commit(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot.npz"))
+    store.diff(CATALOG, now=0)
+    store.commit(["Reel A", "Reel B", "Reel C"], now=0)
+
+    catalog = [product("Reel A", 10.0), product("Reel B", 25.0), product("Reel D", 40.0)]
+    diff = store.diff(catalog, now=10)
+    assert diff.to_post == {"Reel B", "Reel D"}
+    assert dict(zip(diff.keywords, diff.added.tolist())) == {"Reel A": False, "Reel B": False, "Reel D": True}
+    assert dict(zip(diff.keywords, diff.changed.tolist()))["Reel B"]
+    assert diff.removed == ["Reel C"]
+
+
+def test_cells_read_in_other_types_are_unchanged(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot.npz"))
+    store.diff([product("Reel A", 10.0, barcode=123.0)], now=0)
+    store.commit(["Reel A"], now=0)
+    assert store.diff([product("Reel A", 10.0, barcode="123")], now=1).to_post == set()
+
+
+def test_products_are_stale_after_max_age(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot.npz"))
+    store.diff(CATALOG, now=0)
+    store.commit(["Reel A", "Reel B", "Reel C"], now=0)
+    assert store.diff(CATALOG, now=MAX_AGE - 1).to_post == set()
+    diff = store.diff(CATALOG, now=MAX_AGE + 1)
+    assert diff.stale.all() and diff.to_post == {"Reel A", "Reel B", "Reel C"}
+
+
+def test_products_that_were_not_posted_stay_changed(tmp_path):
+    store = SnapshotStore(str(tmp_path / "snapshot.npz"))
+    store.diff(CATALOG, now=0)
+    # Reel C was deferred by the budget
+    store.commit(["Reel A", "Reel B"], now=0)
+    assert store.diff(CATALOG, now=1).to_post == {"Reel C"}
@@ -0,0 +1,48 @@
+import urls
+from urls import StringTable, canonical_url, intern_url, reset_urls
+
+
+def test_tracking_parameters_are_dropped():
+    assert canonical_url("https://www.example.com/p/1?utm_source=google&gclid=x&srsltid=y") == \
+        "https://www.example.com/p/1"
+
+
+def test_other_parameters_are_kept_sorted():
+    assert canonical_url("https://example.com/p?variant=2&skuId=9&utm_medium=cpc") == \
+        "https://example.com/p?skuId=9&variant=2"
+
+
+def test_scheme_host_port_fragment_and_path_are_normalized():
+    assert canonical_url("HTTPS://Example.COM.:443/a//b/./c/../d#reviews") == "https://example.com/a/b/d"
+    assert canonical_url("http://example.com:8080/a/") == "http://example.com:8080/a/"
+
+
+def test_redirects_are_replaced_by_their_target():
+    url = "https://click.example.net/r?dl_target_url=https%3A%2F%2FShop.com%2Fitem%3Futm_source%3Dx"
+    assert canonical_url(url) == "https://shop.com/item"
+
+
+def test_urls_that_are_not_http_are_unchanged():
+    assert canonical_url("mailto:someone@example.com") == "mailto:someone@example.com"
+    assert canonical_url("not a url") == "not a url"
+
+
+def test_equal_urls_are_one_string():
+    first = intern_url("https://example.com/p/1?utm_source=a")
+    second = intern_url("https://EXAMPLE.com/p/1?utm_source=b")
+    assert first == "https://example.com/p/1" and first is second
+    assert intern_url(None) is None and intern_url("") is None
+
+
+def test_string_table_ids():
+    table = StringTable(["a", "b"])
+    assert table.intern("b") == 1 and table.intern("c") == 2
+    assert table.names == ["a", "b", "c"] and len(table) == 3
+
+
+def test_reset_keeps_only_the_given_urls():
+    kept = intern_url("https://example.com/kept")
+    intern_url("https://example.com/dropped")
+    reset_urls([kept])
+    assert urls.URLS.names == [kept]
+    assert intern_url("https://example.com/kept") is kept
@@ -0,0 +1,143 @@
+"""
+This module canonicalizes the URLs of the offers and interns them, so that the same
+listing is one string however the shopping results tag it.
+
+canonical_url lowercases the scheme and the host, drops the default port, the fragment,
+the "." and ".." segments and the empty segments of the path, and the tracking
+parameters of the query (utm_*, gclid, srsltid, the eBay and affiliate parameters, see
+TRACKING_PARAMS). The other parameters are kept as they are written, sorted, since they
+may select the variant of the product (variant, skuId, ...). Affiliate redirects whose
+target is a parameter (REDIRECT_PARAMS) are replaced by their target.
+
+The offers parse their URLs to the canonical form (see models.ShoppingItem), and the
+URLs of the offers that are kept are interned in URLS (see share_url), a StringTable
+shared by the whole process: each distinct URL gets an integer id and is stored once,
+and the offers of every product hold that one string. The offers that are dropped, e.g.
+beyond max_offers, are not interned. The table only grows during a run; a long-running
+process (see daemon.py) calls reset_urls after each output so that it only keeps the
+URLs of the offers it still holds.
+
+Example:
+    url = intern_url("https://www.Example.com/p/1?utm_source=google&variant=2#reviews")
+    # "https://www.example.com/p/1?variant=2", and URLS.ids[url] is its id
+"""
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Sequence
+from urllib.parse import unquote, urlsplit, urlunsplit
+
+
+# Query parameters that only track the click, compared in lowercase
+TRACKING_PARAMS = frozenset((
+    "gclid", "gclsrc", "dclid", "gbraid", "wbraid", "fbclid", "msclkid", "yclid", "srsltid", "_ga", "_gl",
+    "mc_cid", "mc_eid", "cm_mmc", "gpla", "gao", "ats", "affiliateid", "aff_short_key", "aff_platform",
+    "aff_trace_key", "terminal_id", "chn", "mkevt", "mkcid", "mkrid", "campid", "toolid", "customid",
+))
+
+# Prefixes of the tracking parameters, e.g. utm_source, utm_campaign
+TRACKING_PREFIXES = ("utm_", "pk_", "mtm_", "_randl_")
+
+# Parameters of affiliate redirects whose value is the URL of the listing
+REDIRECT_PARAMS = frozenset(("dl_target_url",))
+
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+
+
+class StringTable:
+    """ Interns strings to consecutive integer ids.
+
+    Args:
+        names (Sequence[str]): The strings of the ids 0, 1, ..., e.g. of a saved table.
+    """
+
+    def __init__(self, names: Sequence[str] = ()):
+        self.names: List[str] = list(names)
+        self.ids: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+        self._lock = Lock()
+
+    def intern(self, name: str) -> int:
+        """ Returns the id of name, adding it to the table if needed. """
+        i = self.ids.get(name)
+        if i is None:
+            # The threads that parse results at the same time must not give a string two ids
+            with self._lock:
+                i = self.ids.get(name)
+                if i is None:
+                    i = self.ids[name] = len(self.names)
+                    self.names.append(name)
+        return i
+
+    def string(self, name: str) -> str:
+        """ Returns the string of the table equal to name, so that equal strings are one object. """
+        return self.names[self.intern(name)]
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+
+# The canonical URLs of the offers of the process
+URLS = StringTable()
+
+
+def reset_urls(keep: Iterable[str] = ()) -> None:
+    """ Starts a new URLS with the URLs of keep, e.g. of the offers that are still held.
+    The calls that are interning a URL at the same time finish with the previous table.
+    """
+    global URLS
+    URLS = StringTable(dict.fromkeys(keep))
+
+
+def _path(path: str) -> str:
+    """ Removes the empty, "." and ".." segments of a path, keeping its trailing slash. """
+    segments: List[str] = list()
+    for segment in path.split("/"):
+        if segment == "..":
+            if segments:
+                segments.pop()
+        elif segment and segment != ".":
+            segments.append(segment)
+    trailing = "/" if path.endswith("/") and segments else ""
+    return "/" + "/".join(segments) + trailing
+
+
+def _is_tracking(key: str) -> bool:
+    key = unquote(key).lower()
+    return key in TRACKING_PARAMS or key.startswith(TRACKING_PREFIXES)
+
+
+def canonical_url(url: str) -> str:
+    """ Returns the canonical form of url, see the module docstring. URLs that are not
+    http(s) are returned unchanged.
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+    scheme = parts.scheme.lower()
+    if scheme not in DEFAULT_PORTS or not parts.hostname:
+        return url
+    params = [p for p in parts.query.split("&") if p]
+    for param in params:
+        key, _, value = param.partition("=")
+        if unquote(key).lower() in REDIRECT_PARAMS:
+            target = unquote(value)
+            if target.lower().startswith(("http://", "https://")):
+                return canonical_url(target)
+    host = parts.hostname.rstrip(".")
+    if port is not None and str(port) != DEFAULT_PORTS[scheme]:
+        host = f"{host}:{port}"
+    query = "&".join(sorted(p for p in params if not _is_tracking(p.partition("=")[0])))
+    return urlunsplit((scheme, host, _path(parts.path), query, ""))
+
+
+def intern_url(url: Optional[str]) -> Optional[str]:
+    """ Returns the canonical url interned in URLS, or None if there is no url. """
+    if not url:
+        return None
+    return URLS.string(canonical_url(url))
+
+
+def share_url(url: Optional[str]) -> Optional[str]:
+    """ Returns the string of URLS equal to url, which is canonical already, or None if there is no url. """
+    return URLS.string(url) if url else None
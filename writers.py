@@ -0,0 +1,242 @@
+"""
+This module has the writers of the output stage. Each writer receives the offers of one
+product at a time, writes them right away and only keeps an open file (or one row group
+for Parquet), so the output never needs to be held in memory.
+
+    CompetitorCsvWriter: the original output file, one row per product with alternating
+                         price and URL columns.
+    CsvWriter, ParquetWriter and XlsxWriter: one row per offer with the OFFER_COLUMNS.
+
+read_offers reads the files of CsvWriter and ArchiveWriter back.
+
+Example:
+    with open_writer("offers.xlsx") as writer:
+        write_products(price_dict.items(), id_keyword, [writer])
+"""
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+import csv
+import os
+
+from models import Offer
+
+
+# Schema of the CSV, Parquet and xlsx exports
+OFFER_COLUMNS = ['ID', 'Product Name', 'Current Price', 'Rank', 'Price', 'Currency', 'Seller', 'Domain', 'URL']
+
+# Rows buffered by ParquetWriter before writing a row group
+PARQUET_ROW_GROUP_SIZE = 50000
+
+# Values of ID and Current Price for keywords that are not in the product data
+UNMATCHED_ID = ""
+UNMATCHED_PRICE = -1
+
+
+class ProductWriter:
+    """ Base class of the writers, used as a context manager. """
+
+    def write(self, product_id: Any, keyword: str, current_price: Any, offers: Sequence[Offer]) -> None:
+        """ Writes the offers of a product.
+
+        Args:
+            product_id (Any): The ID of the product, UNMATCHED_ID if the keyword is not in the product data.
+            keyword (str): The product name.
+            current_price (Any): The Variant Price of the product, UNMATCHED_PRICE if it is not known.
+            offers (Sequence[Offer]): The competitor offers.
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self) -> "ProductWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+
+def offer_rows(product_id: Any, keyword: str, current_price: Any, offers: Sequence[Offer]) -> List[List]:
+    """ Returns the rows of a product in the OFFER_COLUMNS schema. """
+    return [[product_id, keyword, current_price, o.rank, o.price, o.currency, o.seller, o.domain, o.url]
+            for o in offers]
+
+
+class CompetitorCsvWriter(ProductWriter):
+    """ Writes the output file of write_output_csv. """
+
+    header = ['ID', 'Product Name', 'Current Price', 'Competitor Prices, URLs']
+
+    def __init__(self, file_name: str):
+        self.file = open(file_name, 'w+', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.header)
+
+    def write(self, product_id: Any, keyword: str, current_price: Any, offers: Sequence[Offer]) -> None:
+        row: List[Any] = [product_id, keyword, current_price]
+        for offer in offers:
+            row.append(offer.price)
+            row.append(offer.url)
+        self.writer.writerow(row)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class CsvWriter(ProductWriter):
+    """ Writes one row per offer with the OFFER_COLUMNS. """
+
+    def __init__(self, file_name: str):
+        self.file = open(file_name, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(OFFER_COLUMNS)
+
+    def write(self, product_id: Any, keyword: str, current_price: Any, offers: Sequence[Offer]) -> None:
+        self.writer.writerows(offer_rows(product_id, keyword, current_price, offers))
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ArchiveWriter(CsvWriter):
+    """ Same as CsvWriter, with a row without offer for the products without offers, so that
+    read_offers yields every product that was written.
+    """
+
+    def write(self, product_id: Any, keyword: str, current_price: Any, offers: Sequence[Offer]) -> None:
+        if offers:
+            super().write(product_id, keyword, current_price, offers)
+        else:
+            self.writer.writerow([product_id, keyword, current_price] + [""] * (len(OFFER_COLUMNS) - 3))
+
+
+class ParquetWriter(ProductWriter):
+    """ Writes one row per offer with the OFFER_COLUMNS, needs pyarrow. The rows are
+    written in row groups of row_group_size.
+    """
+
+    def __init__(self, file_name: str, row_group_size: int = PARQUET_ROW_GROUP_SIZE):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is needed for Parquet exports, install it with: pip install pyarrow")
+        self.pa = pyarrow
+        self.schema = pyarrow.schema([
+            ('ID', pyarrow.string()), ('Product Name', pyarrow.string()), ('Current Price', pyarrow.float64()),
+            ('Rank', pyarrow.int64()), ('Price', pyarrow.float64()), ('Currency', pyarrow.string()),
+            ('Seller', pyarrow.string()), ('Domain', pyarrow.string()), ('URL', pyarrow.string())])
+        self.writer = pyarrow.parquet.ParquetWriter(file_name, self.schema)
+        self.row_group_size = row_group_size
+        self.columns: List[List] = [[] for _ in OFFER_COLUMNS]
+
+    def write(self, product_id: Any, keyword: str, current_price: Any, offers: Sequence[Offer]) -> None:
+        # The IDs of the product data are numbers, unmatched ones are empty strings
+        product_id = str(product_id) if product_id != UNMATCHED_ID else None
+        current_price = current_price if current_price != UNMATCHED_PRICE else None
+        for row in offer_rows(product_id, keyword, current_price, offers):
+            for column, value in zip(self.columns, row):
+                column.append(value)
+        if len(self.columns[0]) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self) -> None:
+        if self.columns[0]:
+            self.writer.write_table(self.pa.Table.from_arrays(
+                [self.pa.array(c, type=f.type) for c, f in zip(self.columns, self.schema)], schema=self.schema))
+            self.columns = [[] for _ in OFFER_COLUMNS]
+
+    def close(self) -> None:
+        self._flush()
+        self.writer.close()
+
+
+class XlsxWriter(ProductWriter):
+    """ Writes one row per offer with the OFFER_COLUMNS to a spreadsheet. The workbook is
+    opened in openpyxl's write-only mode, which streams the rows to the file instead of
+    keeping the cells in memory.
+    """
+
+    def __init__(self, file_name: str, sheet_name: str = "Offers"):
+        from openpyxl import Workbook
+        self.file_name = file_name
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet(sheet_name)
+        self.sheet.append(OFFER_COLUMNS)
+
+    def write(self, product_id: Any, keyword: str, current_price: Any, offers: Sequence[Offer]) -> None:
+        for row in offer_rows(product_id, keyword, current_price, offers):
+            self.sheet.append(row)
+
+    def close(self) -> None:
+        self.workbook.save(self.file_name)
+
+
+WRITERS = {".csv": CsvWriter, ".parquet": ParquetWriter, ".xlsx": XlsxWriter}
+
+
+def open_writer(file_name: str) -> ProductWriter:
+    """ Returns the writer for the extension of file_name (.csv, .parquet or .xlsx). """
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in WRITERS:
+        raise ValueError(f"Unknown output format {file_name!r}, expected one of {', '.join(WRITERS)}")
+    return WRITERS[extension](file_name)
+
+
+def read_offers(file_name: str) -> Iterator[Tuple[str, List[Offer]]]:
+    """ Yields the keyword and offers of each product of a file written by CsvWriter or
+    ArchiveWriter, e.g. to write the products again. The rows of a product are consecutive, as CsvWriter writes them.
+    """
+    with open(file_name, 'r', encoding='utf-8', newline='') as file:
+        reader = csv.reader(file)
+        next(reader, None)
+        keyword, offers = None, []
+        for row in reader:
+            if len(row) < len(OFFER_COLUMNS):
+                continue
+            if row[1] != keyword:
+                if keyword is not None:
+                    yield keyword, offers
+                keyword, offers = row[1], []
+            if not any(row[3:]):
+                # A product without offers, see ArchiveWriter
+                continue
+            offers.append(Offer(_number(row[4], float), row[8] or None, row[5] or None, row[7] or None,
+                                row[6] or None, _number(row[3], int)))
+        if keyword is not None:
+            yield keyword, offers
+
+
+def _number(text: str, convert):
+    try:
+        return convert(text)
+    except ValueError:
+        return None
+
+
+def write_products(products: Iterable[Tuple[str, Sequence[Offer]]], id_keyword: Dict[str, Tuple],
+                   writers: Sequence[ProductWriter]) -> Tuple[int, int]:
+    """ Writes the offers of each product with each writer as the products come.
+
+    Args:
+        products (Iterable[Tuple[str, Sequence[Offer]]]): The keyword and offers of each
+                                                           product, e.g. price_dict.items().
+        id_keyword (Dict[str, Tuple]): Mapping of keywords to (ID, price, ...), see task_post.read_xlsx.
+        writers (Sequence[ProductWriter]): The writers.
+
+    Returns:
+        Tuple[int, int]: The number of products written and how many of them were not in id_keyword.
+    """
+    n_products = 0
+    n_unmatched = 0
+    for keyword, offers in products:
+        n_products += 1
+        product: Optional[Tuple] = id_keyword.get(keyword)
+        if product is None:
+            # Results of a keyword that is no longer in the product data
+            n_unmatched += 1
+            product_id, current_price = UNMATCHED_ID, UNMATCHED_PRICE
+        else:
+            product_id, current_price = product[0], product[1]
+        for writer in writers:
+            writer.write(product_id, keyword, current_price, offers)
+    return n_products, n_unmatched